@@ -0,0 +1,192 @@
+"""
+Minified, fingerprinted bundles of the block's static files.  The build
+step writes each bundle under a name holding the hash of its contents,
+with a manifest mapping bundle names to file names:
+
+	python edx_mfu/assets.py /edx/var/edxapp/staticfiles/edx_mfu
+
+It needs nothing but the source tree.  Once the directory is served at
+ASSET_URL and named by ASSET_DIR, views link the bundles instead of
+inlining them, and as the names change with the contents the files can
+be cached by browsers for good.  Without those settings, or when the
+manifest cannot be read, views inline the source files as before.
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import sys
+
+from config import get_setting
+
+log = logging.getLogger(__name__)
+
+#bundle names, and the package files they are built from.
+BUNDLES = {
+	'edx_mfu.css': ('static/css/edx_mfu.css',),
+	'edx_mfu.js':  ('static/js/src/edx_mfu.js',),
+	'studio.js':   ('static/js/src/studio.js',),
+}
+
+MANIFEST = 'manifest.json'
+
+_manifest = dict()
+
+def bundle_url(name):
+	"""Returns the URL of a built bundle, or None if the bundle is to be
+	inlined.
+
+	Keyword arguments:
+	name: one of BUNDLES.
+	"""
+	url = get_setting('ASSET_URL')
+	directory = get_setting('ASSET_DIR')
+	if not url or not directory:
+		return None
+
+	manifest = load_manifest(directory)
+	if name not in manifest:
+		return None
+	return url.rstrip('/') + '/' + manifest[name]
+
+def load_manifest(directory):
+	"""Returns the manifest of a build directory, read once per process,
+	or an empty manifest if it cannot be read.
+
+	Keyword arguments:
+	directory: the build directory.
+	"""
+	if directory not in _manifest:
+		try:
+			with open(os.path.join(directory, MANIFEST)) as f:
+				_manifest[directory] = json.load(f)
+		except (IOError, ValueError):
+			log.warning("No asset manifest in %s, inlining assets.",
+				directory, exc_info=True)
+			_manifest[directory] = dict()
+	return _manifest[directory]
+
+def build(directory):
+	"""Builds every bundle into a directory and writes its manifest.
+	Returns the manifest.
+
+	Keyword arguments:
+	directory: the build directory, created if missing.
+	"""
+	if not os.path.isdir(directory):
+		os.makedirs(directory)
+
+	root = os.path.dirname(os.path.abspath(__file__))
+	manifest = dict()
+	for name, paths in sorted(BUNDLES.items()):
+		sources = []
+		for path in paths:
+			with open(os.path.join(root, path)) as f:
+				sources.append(f.read())
+
+		base, ext = os.path.splitext(name)
+		minify = minify_css if ext == '.css' else minify_js
+		content = '\n'.join(minify(source) for source in sources)
+
+		filename = base + '.' + hashlib.sha1(content).hexdigest()[:12] + ext
+		with open(os.path.join(directory, filename), 'w') as f:
+			f.write(content)
+		manifest[name] = filename
+
+	with open(os.path.join(directory, MANIFEST), 'w') as f:
+		json.dump(manifest, f, indent=1, sort_keys=True)
+	return manifest
+
+def minify_css(source):
+	"""Removes comments and needless whitespace from a style sheet."""
+	source = re.sub(r'/\*.*?\*/', '', source, flags=re.S)
+	source = re.sub(r'\s+', ' ', source)
+	source = re.sub(r'\s*([{};,>])\s*', r'\1', source)
+	source = re.sub(r':\s+', ':', source)
+	return source.replace(';}', '}').strip()
+
+def minify_js(source):
+	"""Removes comments, indentation and blank lines from a script.
+	Strings and regular expressions are copied as they are, and line
+	breaks are kept so that statements without semicolons still end.
+	"""
+	out = []
+	i = 0
+	n = len(source)
+	while i < n:
+		c = source[i]
+		if c in '\'"':
+			end = _literal_end(source, i, c)
+			out.append(source[i:end])
+			i = end
+		elif source.startswith('//', i):
+			i = source.find('\n', i)
+			if i < 0:
+				i = n
+		elif source.startswith('/*', i):
+			end = source.find('*/', i + 2)
+			i = n if end < 0 else end + 2
+			_space(out)
+		elif c == '/' and _regex_allowed(out):
+			end = _literal_end(source, i, '/')
+			out.append(source[i:end])
+			i = end
+		elif c == '\n':
+			while out and out[-1] in ' \t':
+				out.pop()
+			if out and out[-1] != '\n':
+				out.append('\n')
+			i += 1
+		elif c in ' \t\r':
+			_space(out)
+			i += 1
+		else:
+			out.append(c)
+			i += 1
+	return ''.join(out).strip()
+
+def _literal_end(source, start, quote):
+	"""Returns the index after a string or regular expression literal."""
+	i = start + 1
+	in_class = False
+	while i < len(source):
+		c = source[i]
+		if c == '\\':
+			i += 2
+			continue
+		if c == '\n':
+			return i
+		if quote == '/' and c == '[':
+			in_class = True
+		elif quote == '/' and c == ']':
+			in_class = False
+		elif c == quote and not in_class:
+			i += 1
+			if quote == '/':
+				while i < len(source) and source[i].isalpha():
+					i += 1
+			return i
+		i += 1
+	return i
+
+def _regex_allowed(out):
+	"""Returns True if a slash after the output so far starts a regular
+	expression rather than a division.
+	"""
+	text = ''.join(out[-16:]).rstrip()
+	if not text:
+		return True
+	if text[-1] in '(,=:[!&|?{};+-*%<>~^\n':
+		return True
+	return re.search(r'\b(return|typeof|case|in)$', text) is not None
+
+def _space(out):
+	if out and out[-1] not in ' \n':
+		out.append(' ')
+
+if __name__ == '__main__':
+	if len(sys.argv) != 2:
+		sys.exit("usage: assets.py BUILD_DIRECTORY")
+	for name, filename in sorted(build(sys.argv[1]).items()):
+		print name, filename
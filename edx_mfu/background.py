@@ -0,0 +1,75 @@
+"""
+Runs tasks outside of the request.  Tasks are named by the dotted path
+of a module level function so they can be handed to any queue.  By
+default they run on a small pool of local threads and are retried with
+a growing delay when they fail, so tasks must be idempotent.
+
+A different queue can be plugged in with the TASK_BACKEND setting: the
+dotted path of a callable taking (task, args, retries) which arranges
+for the task to be run with the given arguments.
+"""
+import importlib
+import logging
+import threading
+import time
+
+from multiprocessing.pool import ThreadPool
+
+from django.db import close_old_connections
+
+from config import get_setting
+
+log = logging.getLogger(__name__)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def enqueue(task, *args):
+	"""Queues a task to be run in the background.
+
+	Keyword arguments:
+	task: the dotted path of a module level function.
+	args: JSON serializable arguments for the task.
+	"""
+	retries = get_setting('TASK_MAX_RETRIES')
+	backend = get_setting('TASK_BACKEND')
+	if backend:
+		resolve(backend)(task, args, retries)
+	else:
+		_local_pool().apply_async(run_task, (task, args, retries))
+
+def run_task(task, args, retries=0):
+	"""Runs a task, retrying it with exponential backoff when it fails.
+	Returns the result of the task, or None if every attempt failed.
+
+	Keyword arguments:
+	task:    the dotted path of a module level function.
+	args:    the arguments for the task.
+	retries: how many times to retry a failed task.
+	"""
+	func = resolve(task)
+	try:
+		for attempt in range(retries + 1):
+			try:
+				return func(*args)
+			except Exception:
+				if attempt == retries:
+					log.error("Task %s failed after %d attempts.",
+						task, attempt + 1, exc_info=True)
+					return None
+				log.warning("Task %s failed, retrying.", task, exc_info=True)
+				time.sleep(get_setting('TASK_RETRY_DELAY') * 2 ** attempt)
+	finally:
+		close_old_connections()
+
+def resolve(path):
+	"""Returns the object named by a dotted path."""
+	module, name = path.rsplit('.', 1)
+	return getattr(importlib.import_module(module), name)
+
+def _local_pool():
+	global _pool
+	with _pool_lock:
+		if _pool is None:
+			_pool = ThreadPool(get_setting('TASK_WORKERS'))
+		return _pool
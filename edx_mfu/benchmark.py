@@ -0,0 +1,486 @@
+"""
+A benchmark of the block on synthetic courses.  A course of students, each
+with a submission of files of a given size, is created in the database and
+in a FileSystemStorage in a temporary directory, and the block is driven
+through a fake runtime.  Each scenario is run a number of times after a
+warm up, and its wall time, database queries and response size are
+reported as JSON, optionally compared with the results of an earlier run:
+
+	./manage.py lms mfu_benchmark --settings=test --students 1000 \
+		--files 3 --file-size 65536 --output after.json --baseline before.json
+
+The command runs on a test database created for the run, SQLite under the
+test settings.  Scenarios that change submissions restore them before
+each run, outside of the timing, and background tasks run inline so the
+cost of the bulk handlers is measured with them.
+"""
+import collections
+import datetime
+import json
+import os
+import platform
+import pytz
+import random
+import shutil
+import tempfile
+import time
+
+import django
+
+from courseware.models import StudentModule
+
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext, override_settings
+
+from opaque_keys.edx.locations import Location, SlashSeparatedCourseKey
+
+from student.models import UserProfile
+
+from webob import Request
+from webob.multidict import MultiDict
+
+from xblock.field_data import DictFieldData
+from xblock.fields import ScopeIds
+
+import background
+import grading_cache
+from bulk import BulkStateChange
+from config import get_setting
+from mfu import MultipleFileUploadXBlock
+from models import Job
+
+STUDENTS = 100
+FILES = 3
+FILE_SIZE = 64 * 1024
+REPEAT = 5
+WARMUP = 1
+#share of the baseline time a scenario may slow down or speed up by
+#before it counts as changed.
+THRESHOLD = 0.1
+
+#usernames of the synthetic students start with this.
+USERNAME_PREFIX = 'edx_mfu_benchmark_'
+
+#settings the benchmark runs with, before the settings of each scenario.
+SETTINGS = {
+	'TASK_BACKEND':            'edx_mfu.benchmark.run_inline',
+	'PREBUILD_SUBMISSION_ZIP': False,
+	'GRADING_CACHE':           None,
+	'ZIP_CACHE':               None,
+	'INSTRUMENTATION':         (),
+}
+
+class FakeRuntime(object):
+	"""
+	The parts of the LMS runtime the block uses.
+	"""
+	def __init__(self, course_id, user_is_staff, role):
+		self.course_id = course_id
+		self.user_is_staff = user_is_staff
+		self.role = role
+
+	def get_user_role(self):
+		return self.role
+
+class FakeRequest(object):
+	"""
+	A request holding parameters only, which may be uploads.
+	"""
+	def __init__(self, **params):
+		self.params = MultiDict(params)
+
+class Upload(object):
+	"""
+	An uploaded file, as the LMS hands it to handlers.
+	"""
+	def __init__(self, filename, content):
+		self.file = ContentFile(content, name=filename)
+
+class SyntheticCourse(object):
+	"""
+	A block with students and their submissions, created in the database
+	and in default_storage.  Every other submission is graded.
+	"""
+	def __init__(self, students, files, file_size):
+		self.students = students
+		self.files = files
+		self.file_size = file_size
+		self.course_id = SlashSeparatedCourseKey.from_deprecated_string(
+			'edx_mfu/benchmark/run')
+		self.location = Location(
+			'edx_mfu', 'benchmark', 'run', 'edx_mfu', 'benchmark', None)
+		self.module_ids = []
+
+		#random, so files do not compress, but the same on every run.
+		rand = random.Random(0)
+		self._noise = ''.join(chr(rand.getrandbits(8)) for _ in range(2**16))
+
+	def create(self):
+		"""Creates the students, their student modules and submissions."""
+		chunk_size = get_setting('BULK_CHUNK_SIZE')
+		for i in range(0, self.students, chunk_size):
+			User.objects.bulk_create([
+				User(
+					username=USERNAME_PREFIX + '%06d' % n,
+					email=USERNAME_PREFIX + '%06d@example.com' % n
+				)
+				for n in range(i, min(i + chunk_size, self.students))
+			])
+
+		users = list(User.objects.filter(username__startswith=USERNAME_PREFIX)
+			.order_by('username'))
+		for i in range(0, len(users), chunk_size):
+			chunk = users[i:i + chunk_size]
+			UserProfile.objects.bulk_create([
+				UserProfile(user=user, name=user.username) for user in chunk
+			])
+			StudentModule.objects.bulk_create([
+				StudentModule(
+					module_state_key=self.location,
+					course_id=self.course_id,
+					student=user,
+					state='{}'
+				)
+				for user in chunk
+			])
+
+		self.module_ids = list(self.modules().order_by('id')
+			.values_list('id', flat=True))
+		self.seed()
+
+	def seed(self, module_ids=None):
+		"""Stores a new submission for students, replacing their state.
+
+		Keyword arguments:
+		module_ids: the student modules to seed, all of them by default.
+		"""
+		if module_ids is None:
+			module_ids = self.module_ids
+		staff = self.block()
+		positions = dict((module_id, n)
+			for n, module_id in enumerate(self.module_ids))
+		chunk_size = get_setting('BULK_CHUNK_SIZE')
+		for i in range(0, len(module_ids), chunk_size):
+			with transaction.atomic():
+				for module_id in module_ids[i:i + chunk_size]:
+					state = self.state(staff, positions[module_id])
+					StudentModule.objects.filter(pk=module_id).update(
+						state=json.dumps(state),
+						modified=_now()
+					)
+		grading_cache.bump(self.location)
+
+	def state(self, staff, n):
+		"""Returns the state of the nth student, storing their files."""
+		uploaded = dict()
+		for i in range(self.files):
+			staff.store_file(
+				uploaded,
+				ContentFile(self.content(n, i)),
+				'file%d.bin' % i
+			)
+
+		state = dict(
+			uploaded_files=uploaded,
+			annotated_files=dict(),
+			is_submitted=True,
+			submission_time=str(_now())
+		)
+		if n % 2 == 0:
+			state.update(
+				score=n % 100,
+				comment='Graded by the benchmark.',
+				score_approved=True,
+				score_published=True
+			)
+		return state
+
+	def content(self, n, i):
+		"""Returns the contents of the ith file of the nth student."""
+		header = '%08d%08d' % (n, i)
+		repeats = self.file_size // len(self._noise) + 1
+		return (header + self._noise * repeats)[:self.file_size]
+
+	def block(self, module_id=None):
+		"""Returns the block as seen by an instructor, or by the student
+		of a student module.
+
+		Keyword arguments:
+		module_id: (optional) the student module of the student.
+		"""
+		if module_id is None:
+			fields = dict()
+			user_id = 'staff'
+			runtime = FakeRuntime(self.course_id, True, 'instructor')
+		else:
+			module = StudentModule.objects.get(pk=module_id)
+			fields = json.loads(module.state)
+			user_id = module.student_id
+			runtime = FakeRuntime(self.course_id, False, 'student')
+
+		fields.update(display_name='Benchmark', points=100)
+		block = MultipleFileUploadXBlock(
+			runtime,
+			DictFieldData(fields),
+			ScopeIds(user_id, 'edx_mfu', self.location, self.location)
+		)
+		block.location = self.location
+		block.xmodule_runtime = runtime
+		return block
+
+	def modules(self):
+		return StudentModule.objects.filter(
+			course_id=self.course_id,
+			module_state_key=self.location
+		)
+
+	def delete(self):
+		"""Deletes the students and everything created for them."""
+		Job.objects.filter(location=unicode(self.location)).delete()
+		self.modules().delete()
+		UserProfile.objects.filter(
+			user__username__startswith=USERNAME_PREFIX).delete()
+		User.objects.filter(username__startswith=USERNAME_PREFIX).delete()
+
+def _first_student(course):
+	return course.block(course.module_ids[0]),
+
+def _staff(course):
+	return course.block(),
+
+def _staff_request(course):
+	return course.block(), Request.blank(
+		'/?module_id=%d' % course.module_ids[0])
+
+def _reseed_first_student(course):
+	course.seed(course.module_ids[:1])
+	return _staff_request(course)
+
+def _submit_all(course):
+	BulkStateChange(course.course_id, course.location).run(
+		dict(is_submitted=True))
+	return _staff(course)
+
+def _reseed_all(course):
+	course.seed()
+	return _staff(course)
+
+def _upload_request(course):
+	return course.block(course.module_ids[0]), FakeRequest(
+		uploadedFile=Upload('upload.bin', course.content(0, course.files)))
+
+Scenario = collections.namedtuple('Scenario', 'settings before run')
+
+#each scenario: the MFU settings it runs with, a function returning the
+#arguments of a run, not timed, and the timed run.
+SCENARIOS = collections.OrderedDict([
+	('student_view', Scenario(
+		{},
+		_first_student,
+		lambda block: block.student_view()
+	)),
+	('upload_file', Scenario(
+		{},
+		_upload_request,
+		lambda block, request: block.student_upload_file(request)
+	)),
+	('staff_grading_data', Scenario(
+		{},
+		_staff,
+		lambda block: block.get_staff_grading_data(None)
+	)),
+	('staff_grading_data_cached', Scenario(
+		{'GRADING_CACHE': 'local'},
+		_staff,
+		lambda block: block.get_staff_grading_data(None)
+	)),
+	('download_zipped', Scenario(
+		{},
+		_staff_request,
+		lambda block, request: block.staff_download_zipped(request)
+	)),
+	('download_zipped_cached', Scenario(
+		{'ZIP_CACHE': 'local'},
+		_staff_request,
+		lambda block, request: block.staff_download_zipped(request)
+	)),
+	('remove_submission', Scenario(
+		{},
+		_reseed_first_student,
+		lambda block, request: block.staff_remove_submission(request)
+	)),
+	('reopen_all_submissions', Scenario(
+		{},
+		_submit_all,
+		lambda block: block.staff_reopen_all_submissions(Request.blank('/'))
+	)),
+	('remove_all_submissions', Scenario(
+		{},
+		_reseed_all,
+		lambda block: block.staff_remove_all_submissions(Request.blank('/'))
+	)),
+])
+
+def run_suite(students=STUDENTS, files=FILES, file_size=FILE_SIZE,
+		scenarios=None, repeat=REPEAT, warmup=WARMUP):
+	"""Runs scenarios on a synthetic course and returns the results.  The
+	database must be one that can be written to freely.
+
+	Keyword arguments:
+	students:  the number of students in the course.
+	files:     the number of files each student submitted.
+	file_size: the size of each file in bytes.
+	scenarios: the names of the scenarios to run, all by default.
+	repeat:    the number of timed runs of each scenario.
+	warmup:    the number of runs of each scenario before timing it.
+	"""
+	directory = tempfile.mkdtemp(prefix='edx_mfu_benchmark')
+	settings = dict(
+		SETTINGS,
+		ZIP_CACHE_DIR=os.path.join(directory, 'zip_cache')
+	)
+	results = collections.OrderedDict()
+	try:
+		with override_settings(
+				MEDIA_ROOT=os.path.join(directory, 'media'),
+				DEFAULT_FILE_STORAGE=
+					'django.core.files.storage.FileSystemStorage',
+				EDX_MFU=settings):
+			course = SyntheticCourse(students, files, file_size)
+			course.create()
+			try:
+				for name in scenarios or SCENARIOS:
+					scenario = SCENARIOS[name]
+					with override_settings(
+							EDX_MFU=dict(settings, **scenario.settings)):
+						results[name] = measure(
+							course, scenario, repeat, warmup)
+			finally:
+				course.delete()
+	finally:
+		shutil.rmtree(directory, ignore_errors=True)
+
+	return {
+		'parameters': {
+			'students':  students,
+			'files':     files,
+			'file_size': file_size,
+			'repeat':    repeat,
+			'warmup':    warmup,
+		},
+		'environment': {
+			'python':   platform.python_version(),
+			'django':   django.get_version(),
+			'database': connection.vendor,
+			'platform': platform.platform(),
+		},
+		'results': results,
+	}
+
+def measure(course, scenario, repeat, warmup):
+	"""Runs a scenario and returns its wall time in milliseconds, its
+	database queries and the size of its response, each as the median of
+	the timed runs.
+
+	Keyword arguments:
+	course:   the SyntheticCourse to run on.
+	scenario: the Scenario to run.
+	repeat:   the number of timed runs.
+	warmup:   the number of runs before timing.
+	"""
+	times = []
+	queries = []
+	sizes = []
+	for i in range(warmup + repeat):
+		args = scenario.before(course)
+		with CaptureQueriesContext(connection) as captured:
+			start = time.time()
+			size = _consume(scenario.run(*args))
+			elapsed = (time.time() - start) * 1000
+		if i >= warmup:
+			times.append(elapsed)
+			queries.append(len(captured))
+			sizes.append(size)
+
+	return collections.OrderedDict([
+		('median_ms', _median(times)),
+		('min_ms',    min(times)),
+		('max_ms',    max(times)),
+		('queries',   _median(queries)),
+		('bytes',     _median(sizes)),
+	])
+
+def compare(results, baseline, threshold=THRESHOLD):
+	"""Compares the median times of two runs.  Returns, for each scenario,
+	the times, the change as a share of the baseline time, and a verdict:
+	'slower', 'faster', 'unchanged' or 'new'.
+
+	Keyword arguments:
+	results:   the results of run_suite.
+	baseline:  the results of an earlier run.
+	threshold: the share of the baseline time within which a scenario
+	           is unchanged.
+	"""
+	comparison = collections.OrderedDict()
+	for name, result in results['results'].items():
+		before = baseline['results'].get(name)
+		if before is None:
+			comparison[name] = {'median_ms': result['median_ms'],
+				'verdict': 'new'}
+			continue
+
+		change = (result['median_ms'] - before['median_ms']) / \
+			max(before['median_ms'], 0.001)
+		if change > threshold:
+			verdict = 'slower'
+		elif change < -threshold:
+			verdict = 'faster'
+		else:
+			verdict = 'unchanged'
+		comparison[name] = {
+			'median_ms':          result['median_ms'],
+			'baseline_median_ms': before['median_ms'],
+			'change':             round(change, 4),
+			'verdict':            verdict,
+		}
+	return comparison
+
+def run_inline(task, args, retries):
+	"""A TASK_BACKEND running tasks at once, in the handler queuing
+	them.
+	"""
+	background.resolve(task)(*args)
+
+def _consume(result):
+	"""Reads the response of a handler or the fragment of a view to the
+	end.  Returns its size in bytes.
+	"""
+	status = getattr(result, 'status_int', 200)
+	if status >= 400:
+		raise RuntimeError('Scenario failed with status %d.' % status)
+
+	app_iter = getattr(result, 'app_iter', None)
+	if app_iter is None:
+		return len(getattr(result, 'content', '') or '')
+
+	size = 0
+	try:
+		for block in app_iter:
+			size += len(block)
+	finally:
+		close = getattr(app_iter, 'close', None)
+		if close is not None:
+			close()
+	return size
+
+def _median(values):
+	values = sorted(values)
+	middle = len(values) // 2
+	if len(values) % 2:
+		return values[middle]
+	return (values[middle - 1] + values[middle]) / 2.0
+
+def _now():
+	return datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
@@ -0,0 +1,130 @@
+"""
+Reference counted, content addressed file storage.  Files are keyed by
+the sha1 of their contents alone, so identical files uploaded by any
+number of students are stored once.  The FileBlob table holds a count of
+the file lists referring to each file, and the file is removed from
+storage when the last reference is dropped.
+
+A row whose count reaches zero is kept until its file is deleted, which
+happens once the transaction dropping the reference has committed, so a
+rollback never loses a file still referred to.  The deletion locks the
+row again and gives up if a reference was added meanwhile; adding a
+reference locks the same row, so an upload either revives the file
+before it is deleted or finds the row gone and writes the file again.
+On Django 1.8, which cannot defer work to a commit, files are deleted
+when the drop itself commits, so references must not be dropped inside
+a transaction of the caller.
+"""
+import collections
+
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import F
+
+from config import get_setting
+from models import FileBlob
+
+#keys per query, below the bound parameter limit of sqlite.
+KEY_CHUNK_SIZE = 500
+
+def blob_storage_path(key):
+	"""Returns the storage path of a content addressed file.
+
+	Keyword arguments:
+	key: the sha1 of the contents of the file.
+	"""
+	return '/'.join((get_setting('BLOB_STORAGE_PREFIX'), key[:2], key))
+
+def add_reference(key):
+	"""Records a new reference to a file.  Must be called before the file
+	is written so a concurrent drop_reference cannot remove it.  Returns
+	True if the file had no reference, in which case it may be missing
+	from storage.
+
+	Keyword arguments:
+	key: the sha1 of the contents of the file.
+	"""
+	with transaction.atomic():
+		#waits for a deletion of the file holding the row.
+		blob, created = FileBlob.objects.select_for_update() \
+			.get_or_create(key=key)
+		FileBlob.objects.filter(pk=blob.pk).update(refcount=F('refcount') + 1)
+	return created or blob.refcount == 0
+
+def drop_reference(key):
+	"""Removes a reference to a file, deleting the file from storage when
+	no references remain.  Returns True if that was the last reference.
+
+	Keyword arguments:
+	key: the sha1 of the contents of the file.
+	"""
+	return bool(drop_references([key]))
+
+def drop_references(keys):
+	"""Removes one reference to a file for each time its key appears,
+	locking and updating the files together.  Returns the keys of the
+	files left without references, which are deleted.
+
+	Keyword arguments:
+	keys: an iterable of file keys, which may repeat.
+	"""
+	counts = collections.Counter(keys)
+	unreferenced = set()
+	if not counts:
+		return unreferenced
+
+	with transaction.atomic():
+		for chunk in _chunks(list(counts)):
+			#lock the rows so no reference can be added while dropping.
+			blobs = FileBlob.objects.select_for_update().filter(key__in=chunk)
+			for blob in blobs:
+				refcount = max(blob.refcount - counts[blob.key], 0)
+				FileBlob.objects.filter(pk=blob.pk).update(refcount=refcount)
+				if refcount == 0:
+					unreferenced.add(blob.key)
+
+	_after_commit(lambda: delete_unreferenced(unreferenced))
+	return unreferenced
+
+def delete_unreferenced(keys):
+	"""Deletes files and their rows if they still have no references.
+	Each file is deleted while its row is locked, so a reference added
+	meanwhile keeps it.
+
+	Keyword arguments:
+	keys: the keys of files which lost their last reference.
+	"""
+	for key in keys:
+		with transaction.atomic():
+			blob = FileBlob.objects.select_for_update().filter(key=key).first()
+			if blob is None or blob.refcount > 0:
+				continue
+			default_storage.delete(blob_storage_path(key))
+			blob.delete()
+
+def blob_keys(keys):
+	"""Returns the subset of keys which refer to content addressed files.
+
+	Keyword arguments:
+	keys: an iterable of file keys.
+	"""
+	found = set()
+	for chunk in _chunks(list(keys)):
+		found.update(FileBlob.objects.filter(key__in=chunk)
+			.values_list('key', flat=True))
+	return found
+
+def _after_commit(func):
+	"""Runs a function once the current transaction commits, or at once
+	outside of a transaction.
+	"""
+	on_commit = getattr(transaction, 'on_commit', None)
+	if on_commit is not None:
+		on_commit(func)
+	else:
+		func()
+
+def _chunks(keys):
+	"""Splits a list of keys into lists small enough for one query."""
+	return [keys[i:i + KEY_CHUNK_SIZE]
+		for i in range(0, len(keys), KEY_CHUNK_SIZE)]
@@ -0,0 +1,136 @@
+"""
+Changes the state of every student of a block at once.  Student modules
+are streamed in chunks, their state is changed in memory and each chunk
+is written in one transaction.  Files removed by the change are
+collected and deleted in a single phase once their chunk is written.
+"""
+import json
+
+from courseware.models import StudentModule
+
+from django.core.files.storage import default_storage
+from django.db import transaction
+
+import blob_store
+import grading_cache
+import zip_cache
+from config import get_setting
+from file_management_mixin import _file_storage_path, get_file_metadata
+from unit_of_work import compare_and_set
+
+class BulkStateChange(object):
+	"""
+	Sets fields in the state of every student module of a block.
+	"""
+	def __init__(self, course_id, location, chunk_size=None):
+		self.course_id = course_id
+		self.location = location
+		self.chunk_size = chunk_size or get_setting('BULK_CHUNK_SIZE')
+
+	def modules(self):
+		"""Returns a query over the student modules of the block."""
+		return StudentModule.objects.filter(
+			course_id=self.course_id,
+			module_state_key=self.location
+		)
+
+	def run(self, fields, remove_files=(), after=0, progress=None):
+		"""Sets fields in the state of every student, then deletes the
+		files held in the removed file lists.  Returns the number of
+		modules changed.
+
+		Keyword arguments:
+		fields:       the fields to set.
+		remove_files: names of file list fields whose files are deleted.
+		after:        only modules with a greater id are changed.
+		progress:     called with the last module id and the number of
+		              modules read after each chunk is written.
+		"""
+		deletion = FileDeletion(self.location.to_deprecated_string())
+		changed = 0
+		last_id = after
+		while True:
+			chunk = list(self.modules().filter(id__gt=last_id)
+				.order_by('id')[:self.chunk_size])
+
+			dirty = []
+			for module in chunk:
+				state = json.loads(module.state)
+				for name in remove_files:
+					deletion.add(state.get(name))
+				if any(state.get(k, _MISSING) != v for k, v in fields.iteritems()):
+					state.update(fields)
+					dirty.append((module, state))
+
+			write_states(dirty, fields)
+			changed += len(dirty)
+			if dirty:
+				grading_cache.bump(self.location)
+
+			#the chunk is written, so its files are no longer referred to.
+			deletion.run()
+
+			if chunk:
+				last_id = chunk[-1].id
+				if progress is not None:
+					progress(last_id, len(chunk))
+			if len(chunk) < self.chunk_size:
+				return changed
+
+class FileDeletion(object):
+	"""
+	Collects the files of many file lists and deletes them together:
+	content addressed files are looked up and released together, other
+	files are deleted from storage.
+	"""
+	def __init__(self, location):
+		self.location = location
+		self.filelists = []
+
+	def add(self, filelist):
+		"""Adds the files of a file list to the deletion.
+
+		Keyword arguments:
+		filelist: A dictionary containing file metadata.
+		"""
+		if filelist:
+			self.filelists.append(filelist)
+
+	def run(self):
+		"""Deletes every collected file and cached archive."""
+		if get_setting('CONTENT_ADDRESSED_STORAGE'):
+			blobs = blob_store.blob_keys(
+				key for filelist in self.filelists for key in filelist)
+		else:
+			blobs = set()
+
+		references = []
+		for filelist in self.filelists:
+			zip_cache.discard(zip_cache.fingerprint(self.location, filelist))
+			for key, metadata in get_file_metadata(filelist).iteritems():
+				if key in blobs:
+					references.append(key)
+				else:
+					default_storage.delete(_file_storage_path(
+						self.location, key, metadata.filename))
+
+		blob_store.drop_references(references)
+		self.filelists = []
+
+def write_states(changes, fields):
+	"""Writes the state of student modules in one transaction.  Each
+	module is written with compare_and_set, so a change made to one of
+	them since it was read is kept.
+
+	Keyword arguments:
+	changes: pairs of a student module, as read, and its new state.
+	fields:  the fields changed in every module.
+	"""
+	if not changes:
+		return
+
+	with transaction.atomic():
+		for module, state in changes:
+			compare_and_set(module, state, fields)
+
+_MISSING = object()
@@ -0,0 +1,84 @@
+"""
+Operator level settings for the MFU XBlock.  These are read from the
+EDX_MFU dictionary in the Django settings, for example:
+
+	EDX_MFU = {
+		'CONTENT_ADDRESSED_STORAGE': True,
+	}
+"""
+import os
+import tempfile
+
+from django.conf import settings
+
+DEFAULTS = {
+	#store uploads once per unique content, shared between file lists.
+	'CONTENT_ADDRESSED_STORAGE': False,
+	#storage directory holding content addressed files.
+	'BLOB_STORAGE_PREFIX':       'edx_mfu/blobs',
+	#'python', 'x-accel-redirect' or 'x-sendfile'.  The offloaded modes
+	#hand the transfer of downloads to the front end proxy.
+	'FILE_SERVING_MODE':         'python',
+	#internal proxy location mapped onto the root of default_storage.
+	'X_ACCEL_REDIRECT_PREFIX':   '/edx_mfu_protected/',
+	#threads reading and compressing files ahead of the zip writers, one
+	#pool per process; 0 reads them in the writer.
+	'ZIP_WORKERS':               4,
+	#files read ahead of the zip writer; each is held in up to 1mb of
+	#memory.
+	'ZIP_READ_AHEAD':            16,
+	#where built zip archives are cached: 'local', 'storage' or None.
+	'ZIP_CACHE':                 None,
+	'ZIP_CACHE_DIR':             os.path.join(
+		tempfile.gettempdir(), 'edx_mfu_zip_cache'),
+	'ZIP_CACHE_MAX_BYTES':       2**30, # 1gb
+	#internal proxy location mapped onto ZIP_CACHE_DIR.
+	'ZIP_CACHE_X_ACCEL_PREFIX':  '/edx_mfu_zip_cache/',
+	#dotted path of a callable queueing background tasks; None runs them
+	#on TASK_WORKERS local threads.
+	'TASK_BACKEND':              None,
+	'TASK_WORKERS':              2,
+	'TASK_MAX_RETRIES':          3,
+	#seconds before the first retry, doubled on each retry.
+	'TASK_RETRY_DELAY':          1,
+	#seconds a resumable upload may take before it is removed.
+	'CHUNKED_UPLOAD_EXPIRY':     86400,
+	#build the archive of a submission in the background on submit, into
+	#a zip cache shared with the task workers.
+	'PREBUILD_SUBMISSION_ZIP':   False,
+	#student modules fetched per query when streaming grading data.
+	'GRADING_CHUNK_SIZE':        500,
+	#student modules changed per transaction by reopen and remove all.
+	'BULK_CHUNK_SIZE':           500,
+	#seconds without progress after which a job is run again.
+	'JOB_STALE_AFTER':           300,
+	#times a student state write is retried after a conflict.
+	'STATE_WRITE_RETRIES':       3,
+	#seconds the watermark of grading changes is held behind now, at
+	#least the longest write transaction.
+	'GRADING_CHANGES_LAG':       60,
+	#'local', the name of a Django cache, or None: see grading_cache.
+	'GRADING_CACHE':             'local',
+	#seconds a cached grading table is kept.
+	'GRADING_CACHE_TIMEOUT':     3600,
+	#reload templates and static files when they change, None for DEBUG.
+	'RESOURCE_RELOAD':           None,
+	#load templates and static files when the block is imported.
+	'WARM_RESOURCES':            False,
+	#where built asset bundles are served and stored, see assets.py.
+	'ASSET_URL':                 None,
+	'ASSET_DIR':                 None,
+	#sinks measurements of handler calls are sent to, see
+	#instrumentation.py; none disables measuring.
+	'INSTRUMENTATION':           (),
+	'STATSD_ADDRESS':            'localhost:8125',
+	'STATSD_PREFIX':             'edx_mfu',
+}
+
+def get_setting(name):
+	"""Returns an MFU setting, falling back to its default.
+
+	Keyword arguments:
+	name: the name of the setting.
+	"""
+	return getattr(settings, 'EDX_MFU', {}).get(name, DEFAULTS[name])
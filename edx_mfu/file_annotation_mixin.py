@@ -18,6 +18,8 @@ from xblock.fields import XBlockMixin, Scope, Dict
 
 from webob.response import Response
 
+from unit_of_work import unit_of_work
+
 from django.core.files import File
 from django.core.files.storage import default_storage
 from django.template import Context, Template
@@ -36,6 +38,7 @@ class FileAnnotationMixin(XBlockMixin):
 	)	
 
 	@XBlock.handler
+	@unit_of_work
 	def staff_upload_annotated(self, request, suffix=''):
 		self.validate_staff_request(request)
 
@@ -61,17 +64,102 @@ class FileAnnotationMixin(XBlockMixin):
 			"timestamp": uploaded.timestamp
 		})
 
+	@XBlock.handler
+	def staff_upload_annotated_init(self, request, suffix=''):
+		"""Starts a resumable upload of an annotated file.
+
+		Keyword arguments:
+		request: holds the module_id for a student module, the filename
+		         and the size of the file.
+		suffix:  not used.
+		"""
+		self.validate_staff_request(request)
+
+		owner = self.upload_owner(request.params['module_id'])
+		upload_id = self.begin_chunked_upload(
+			request.params.get('filename'),
+			request.params.get('size'),
+			owner
+		)
+
+		return Response(json_body=self.chunked_upload_status(upload_id, owner))
+
+	@XBlock.handler
+	def staff_upload_annotated_chunk(self, request, suffix=''):
+		"""Stores a chunk of a resumable upload of an annotated file.
+
+		Keyword arguments:
+		request: holds the module_id for a student module and the offset
+		         of the chunk, the body is the chunk.
+		suffix:  the id of the upload.
+		"""
+		self.validate_staff_request(request)
+
+		return Response(json_body=self.store_chunk(
+			suffix,
+			request.params.get('offset'),
+			request.body_file,
+			self.upload_owner(request.params['module_id'])
+		))
+
+	@XBlock.handler
+	def staff_upload_annotated_status(self, request, suffix=''):
+		"""Returns the number of bytes received for a resumable upload of
+		an annotated file.
+
+		Keyword arguments:
+		request: holds the module_id for a student module.
+		suffix:  the id of the upload.
+		"""
+		self.validate_staff_request(request)
+
+		return Response(json_body=self.chunked_upload_status(
+			suffix, self.upload_owner(request.params['module_id'])))
+
+	@XBlock.handler
+	@unit_of_work
+	def staff_upload_annotated_finalize(self, request, suffix=''):
+		"""Adds a completed resumable upload to a students annotated
+		files.
+
+		Keyword arguments:
+		request: holds the module_id for a student module.
+		suffix:  the id of the upload.
+		"""
+		self.validate_staff_request(request)
+
+		module_id = request.params['module_id']
+		annotated_list = self.annotated_file_list(module_id)
+
+		key, uploaded = self.finish_chunked_upload(
+			annotated_list,
+			suffix,
+			self.upload_owner(module_id)
+		)
+
+		self.set_student_state(
+			module_id, 
+			annotated_files=annotated_list
+		)
+
+		return Response(json_body={
+			"sha1":      key, 
+			"filename":  uploaded.filename,
+			"timestamp": uploaded.timestamp
+		})
+
 	@XBlock.handler
 	def student_download_annotated(self, request, suffix=''):
 		"""Returns a temporary download link for an annotated file.
 
 		Keyword arguments:
-		request: not used
+		request: may hold conditional and Range headers.
 		suffix:  the hash of the file.
 		"""
-		return self.download_file(self.annotated_files, suffix)
+		return self.download_file(self.annotated_files, suffix, request)
 
 	@XBlock.handler
+	@unit_of_work
 	def staff_download_annotated(self, request, suffix=''):
 		"""Returns a temporary download link for an annotated file.
 
@@ -83,11 +171,13 @@ class FileAnnotationMixin(XBlockMixin):
 
 		return self.download_file(
 			self.annotated_file_list(request.params['module_id']), 
-			suffix
+			suffix,
+			request
 		)
 	
 	#For downloading the entire assingment for one student.
 	@XBlock.handler
+	@unit_of_work
 	def staff_download_annotated_zipped(self, request, suffix=''):
 		"""Returns all annotated files in a zip file.
 
@@ -98,12 +188,13 @@ class FileAnnotationMixin(XBlockMixin):
 		#assert self.is_course_staff()
 		self.validate_staff_request(request)
 
-		module = StudentModule.objects.get(pk=request.params['module_id'])
-		state = json.loads(module.state)
+		module = self.get_module(request.params['module_id'])
+		state = self.get_student_state(module.id)
 
 		return self.download_zipped(
 			state['annotated_files'], 
-			self.display_name + "-" + module.student.username + "annotated"
+			self.display_name + "-" + module.student.username + "annotated",
+			request
 		)
 
 	@XBlock.handler
@@ -116,10 +207,12 @@ class FileAnnotationMixin(XBlockMixin):
 		"""
 		return self.download_zipped(
 			self.annotated_files, 
-			self.display_name + "-annotated"
+			self.display_name + "-annotated",
+			request
 		)
 
 	@XBlock.handler
+	@unit_of_work
 	def staff_delete_annotated(self, request, suffix=''):
 		"""
 		"""
@@ -10,6 +10,11 @@ import mimetypes
 import os
 import pkg_resources
 import pytz
+import tempfile
+import threading
+import uuid
+
+from multiprocessing.pool import ThreadPool
 
 from xblock.core import XBlock
 from xblock.fields import XBlockMixin
@@ -17,21 +22,34 @@ from xblock.fields import XBlockMixin
 from webob.response import Response
 import webob.exc as ExceptionResponse
 
+from django.core.cache import cache
 from django.core.files import File
+from django.core.files.base import ContentFile
 from django.core.files.storage import default_storage
 from django.template import Context, Template
+from django.utils.dateparse import parse_datetime
 
 from functools import partial
 
-from zipfile import ZipFile
-import StringIO
+from zipstream import ZipMember, stream_zip, iter_chunks, \
+	compress_member, compression_for
+from prefetch import prefetch
 
 from collections import namedtuple
 
+import background
+import blob_store
+import zip_cache
+from file_serving import serve_file, parse_timestamp
+from config import get_setting
+
 FileMetaData = namedtuple('FileMetaData', 'filename mimetype timestamp')
 
 log = logging.getLogger(__name__)
 
+_zip_pool = None
+_zip_pool_lock = threading.Lock()
+
 class FileManagementMixin(object):
 	"""
 	A mixin to handle file management for the MFU XBlock.
@@ -45,34 +63,269 @@ class FileManagementMixin(object):
 				comment='The body of the request must include a file.'
 				)
 
-		upload_key = _get_key(upload.file)
+		return self.store_file(filelist, upload.file, upload.file.name)
 
-		metadata = FileMetaData(
-			upload.file.name,
-			mimetypes.guess_type(upload.file.name)[0],
-			str( _now() )
-		)
+	def store_file(self, filelist, fileobj, filename):
+		"""Saves the contents of a file-like object to a list of files.
 
-		filelist[upload_key] = metadata
+		The file is read only once: it is hashed and size-counted while
+		being copied to a spooled temporary file, which is then handed to
+		storage.
 
-		path = _file_storage_path(
-			self.location.to_deprecated_string(),
-			upload_key,
-			upload.file.name
-		)
+		Keyword arguments:
+		filelist: A dictionary containing file metadata.
+		fileobj:  a readable file-like object.
+		filename: the name the file is saved under.
+		"""
+		spool, sha1, size = _spool_file(fileobj)
+		try:
+			self._discard_cached_zip(filelist)
+			content_addressed = get_setting('CONTENT_ADDRESSED_STORAGE')
+			if content_addressed:
+				upload_key = sha1.hexdigest()
+			else:
+				upload_key = _get_key(sha1)
+
+			metadata = FileMetaData(
+				filename,
+				mimetypes.guess_type(filename)[0],
+				str( _now() )
+			)
+
+			revived = False
+			if content_addressed:
+				#a file list holds one reference no matter how often
+				#the same file is uploaded to it.
+				if upload_key not in filelist:
+					revived = blob_store.add_reference(upload_key)
+				path = blob_store.blob_storage_path(upload_key)
+			else:
+				path = _file_storage_path(
+					self.location.to_deprecated_string(),
+					upload_key,
+					filename
+				)
 
-		if not default_storage.exists(path):
-			default_storage.save(path, File(upload.file))
+			filelist[upload_key] = metadata
+
+			if revived or not default_storage.exists(path):
+				stored = File(spool, name=filename)
+				stored.size = size
+				saved = default_storage.save(path, stored)
+				if saved != path:
+					#the same contents were saved meanwhile, or the
+					#storage would not keep the name.
+					default_storage.delete(saved)
+					if not default_storage.exists(path):
+						raise IOError(
+							"Storage saved " + path + " as " + saved + ".")
+		finally:
+			spool.close()
 
 		#Need to return key and metadata so staff can append it to list.
 		return (upload_key, metadata)
 
-	def download_file(self, filelist, key):
-		"""Returns a file specified by a key.
+	def file_storage_path(self, key, filename):
+		"""Returns the storage path of a file in a file list.
+
+		Keyword arguments:
+		key:      the hash of the file.
+		filename: the name of the file.
+		"""
+		return self.file_storage_paths({key: (filename, None, None)})[key]
+
+	def file_storage_paths(self, filelist):
+		"""Returns a dictionary of storage paths for every file in a
+		file list, keyed by hash.
+
+		Keyword arguments:
+		filelist: A dictionary containing file metadata.
+		"""
+		return storage_paths(self.location.to_deprecated_string(), filelist)
+
+	def upload_owner(self, module_id=None):
+		"""Returns who a resumable upload belongs to: the requesting user
+		and, for staff uploads, the student module it is for.
+
+		Keyword arguments:
+		module_id: (optional) the student module of a staff upload.
+		"""
+		owner = unicode(self.scope_ids.user_id)
+		if module_id is not None:
+			owner += '/' + unicode(module_id)
+		return owner
+
+	def begin_chunked_upload(self, filename, size, owner):
+		"""Starts a resumable upload made of chunks sent one at a time.
+		Returns the id of the upload.
+
+		Keyword arguments:
+		filename: the name of the file being uploaded.
+		size:     the size of the file in bytes.
+		owner:    who the upload belongs to, see upload_owner.
+		"""
+		if not filename:
+			raise ExceptionResponse.HTTPBadRequest(
+				detail='No filename.',
+				comment='A chunked upload must be started with a filename.'
+				)
+		try:
+			size = int(size)
+		except (TypeError, ValueError):
+			size = 0
+		if size <= 0:
+			raise ExceptionResponse.HTTPBadRequest(
+				detail='Invalid size.',
+				comment='A chunked upload must be started with its size.'
+				)
+
+		upload_id = uuid.uuid4().hex
+		manifest = {
+			"filename": filename,
+			"size":     size,
+			"owner":    owner,
+			"started":  str( _now() )
+		}
+		default_storage.save(
+			self._chunked_upload_path(upload_id, 'manifest.json'),
+			ContentFile(json.dumps(manifest))
+		)
+		_schedule_upload_cleanup(self.location.to_deprecated_string())
+
+		return upload_id
+
+	def store_chunk(self, upload_id, offset, chunk, owner):
+		"""Stores the next chunk of a resumable upload.  Chunks must be
+		sent in order; the offset of a chunk must be the number of bytes
+		already received, and the chunk must not run past the size of the
+		file.  Returns the upload status.
+
+		Keyword arguments:
+		upload_id: the id returned by begin_chunked_upload.
+		offset:    the position of the chunk in the file.
+		chunk:     a file-like object holding the chunk.
+		owner:     who the upload belongs to, see upload_owner.
+		"""
+		try:
+			offset = int(offset)
+		except (TypeError, ValueError):
+			raise ExceptionResponse.HTTPBadRequest(
+				detail='Invalid offset.',
+				comment='The offset of a chunk must be a whole number.'
+				)
+
+		status = self.chunked_upload_status(upload_id, owner)
+		if offset != status['received']:
+			raise ExceptionResponse.HTTPConflict(
+				detail='Chunk out of order.',
+				comment='Expected a chunk at offset ' +
+					str(status['received']) + '.'
+				)
+
+		spool, sha1, size = _spool_file(chunk)
+		try:
+			if size == 0:
+				raise ExceptionResponse.HTTPBadRequest(
+					detail='Empty chunk.',
+					comment='The body of the request must hold the chunk.'
+					)
+			if offset + size > status['size']:
+				raise ExceptionResponse.HTTPBadRequest(
+					detail='Chunk past the end of the file.',
+					comment='The file is ' + str(status['size']) +
+						' bytes long.'
+					)
+			stored = File(spool, name=upload_id)
+			stored.size = size
+			default_storage.save(
+				self._chunked_upload_path(upload_id, _chunk_name(offset)),
+				stored
+			)
+		finally:
+			spool.close()
+
+		status['received'] += size
+		return status
+
+	def chunked_upload_status(self, upload_id, owner):
+		"""Returns the filename, size and number of bytes received so far
+		of a resumable upload.  Uploads of someone else, and uploads
+		started more than CHUNKED_UPLOAD_EXPIRY seconds ago, are not
+		found; expired uploads are removed.
+
+		Keyword arguments:
+		upload_id: the id returned by begin_chunked_upload.
+		owner:     who the upload belongs to, see upload_owner.
+		"""
+		location = self.location.to_deprecated_string()
+		manifest = _chunked_upload_manifest(location, upload_id)
+		if manifest is not None and _upload_expired(manifest):
+			discard_chunked_upload(location, upload_id)
+			manifest = None
+		if manifest is None or manifest.get('owner') != owner:
+			raise ExceptionResponse.HTTPNotFound(
+				detail="Upload not found",
+				comment='No upload matching id ' + upload_id + ' found.'
+				)
+
+		chunks = _chunk_names(location, upload_id)
+		if chunks:
+			last = chunks[-1]
+			received = int(last) + default_storage.size(
+				self._chunked_upload_path(upload_id, last))
+		else:
+			received = 0
+
+		return {
+			"upload_id": upload_id,
+			"filename":  manifest['filename'],
+			"size":      manifest['size'],
+			"received":  received
+		}
+
+	def finish_chunked_upload(self, filelist, upload_id, owner):
+		"""Joins the chunks of a complete resumable upload and saves the
+		file to a list of files, as upload_file does.  The chunks are
+		removed.
+
+		Keyword arguments:
+		filelist:  A dictionary containing file metadata.
+		upload_id: the id returned by begin_chunked_upload.
+		owner:     who the upload belongs to, see upload_owner.
+		"""
+		status = self.chunked_upload_status(upload_id, owner)
+		if status['size'] != status['received']:
+			raise ExceptionResponse.HTTPConflict(
+				detail='Upload incomplete.',
+				comment='Received ' + str(status['received']) + ' of ' +
+					str(status['size']) + ' bytes.'
+				)
+
+		location = self.location.to_deprecated_string()
+		paths = [self._chunked_upload_path(upload_id, name)
+			for name in _chunk_names(location, upload_id)]
+		result = self.store_file(
+			filelist,
+			_ChunkReader(paths),
+			status['filename']
+		)
+		discard_chunked_upload(location, upload_id)
+
+		return result
+
+	def _chunked_upload_path(self, upload_id, name):
+		"""Returns the storage path of a part of a resumable upload."""
+		return _chunked_upload_path(
+			self.location.to_deprecated_string(), upload_id, name)
+
+	def download_file(self, filelist, key, request=None):
+		"""Returns a file specified by a key.  When the request is given,
+		conditional and Range requests are answered with 304 and 206.
 
 		Keyword arguments:
 		filelist: a list of all files for this students submission.
-		filename: the name of the zip file.
+		key:      the hash of the file.
+		request:  (optional) the request for the file.
 		"""
 		assert filelist is not None
 
@@ -84,11 +337,6 @@ class FileManagementMixin(object):
 
 		#get file info
 		metadata = get_file_metadata(filelist, key)
-		path = _file_storage_path(
-			self.location.to_deprecated_string(),
-			key,
-			metadata.filename
-		)
 
 		#check for file existance.
 		if metadata is None:
@@ -97,25 +345,25 @@ class FileManagementMixin(object):
 				detail="Error retriving file.  See log.",
 				)
 
-		#set up download
-		BLOCK_SIZE = 2**10 * 8  # 8kb
-		foundFile = default_storage.open(path)
-		app_iter = iter(partial(foundFile.read, BLOCK_SIZE), '')
-
-		return Response(
-			app_iter =             app_iter,
-			content_type =         metadata.mimetype,
-			content_disposition = "attachment; filename=" + metadata.filename
+		return serve_file(
+			request,
+			self.file_storage_path(key, metadata.filename),
+			metadata.mimetype,
+			metadata.filename,
+			key,
+			parse_timestamp(metadata.timestamp)
 		)
 
 	#TODO: Filename based on requestor and submittor
-	def download_zipped(self, filelist, filename="assignment"):
+	def download_zipped(self, filelist, filename="assignment", request=None):
 		"""Return a response containg all files for this submission in
-		a zip file.
+		a zip file.  Archives are served from the zip cache when the file
+		list has not changed since they were built.
 
 		Keyword arguments:
 		filelist: a list of all files for this students submission.
 		filename: the name of the zip file.
+		request:  (optional) the request for the archive.
 		"""
 		assert filelist is not None
 
@@ -125,25 +373,50 @@ class FileManagementMixin(object):
 				comment='There are no files of that type available.'
 				)
 
-		#buffer to create zip file in memory.
-		buff = StringIO.StringIO()
-		assignment_zip = ZipFile(buff, mode='w')
-
-		for key, metadata in get_file_metadata(filelist).iteritems():
-			path = _file_storage_path(
-				self.location.to_deprecated_string(),
-				key,
-				metadata.filename
-			)
-			afile = default_storage.open(path)
+		location = self.location.to_deprecated_string()
+		fingerprint = zip_cache.fingerprint(location, filelist)
+		cached = zip_cache.lookup(fingerprint)
+		if cached is not None:
+			storage, path = cached
+			try:
+				return serve_file(
+					request,
+					path,
+					'application/zip',
+					filename + '.zip',
+					fingerprint,
+					storage =      storage,
+					accel_prefix = zip_cache.accel_prefix()
+				)
+			except (IOError, OSError):
+				#evicted since the lookup, build it again.
+				pass
+
+		response = Response(
+			app_iter =            zip_cache.tee(
+				fingerprint, stream_zip(compressed_members(
+					zip_members(location, filelist)))),
+			content_type =        'application/zip',
+			content_disposition = 'attachment; filename=' + filename + '.zip'
+		)
+		response.headers['ETag'] = '"' + fingerprint + '"'
+		return response
 
-			assignment_zip.writestr(metadata.filename, afile.read())
+	def download_zipped_folders(self, folders, filename):
+		"""Return a response containing the files of many file lists in
+		a zip file, each in its own folder.
 
-		assignment_zip.close()
-		buff.seek(0)
+		Keyword arguments:
+		folders:  an iterable of (folder, filelist) pairs.
+		filename: the name of the zip file.
+		"""
+		location = self.location.to_deprecated_string()
+		members = (member
+			for folder, filelist in folders if filelist
+			for member in zip_members(location, filelist, folder))
 
 		return Response(
-			body =                buff.read(),
+			app_iter =            stream_zip(compressed_members(members)),
 			content_type =        'application/zip',
 			content_disposition = 'attachment; filename=' + filename + '.zip'
 		)
@@ -157,29 +430,138 @@ class FileManagementMixin(object):
 		"""
 		if key not in filelist:
 			return filelist
-		else:
-			metadata = get_file_metadata(filelist, key)
-
-		path = _file_storage_path(
-			self.location.to_deprecated_string(),
-			key,
-			metadata.filename
-		)
 
-		default_storage.delete(path)
+		self._discard_cached_zip(filelist)
+		self.delete_all({key: filelist[key]})
 		del filelist[key]
 
 		return filelist
 
 	def delete_all(self, filelist):
-		"""Removes all files in the supplied filelist
+		"""Removes all files in the supplied filelist, and empties it.
+		Content addressed files only lose a reference, and are deleted from
+		storage when no file list refers to them.
 
 		Keyword arguments:
 		filelist: A dictionary containint file metadata.
 		"""
-		for key in filelist.keys():
-			self.delete_file(filelist, key)
+		if not filelist:
+			return
+
+		self._discard_cached_zip(filelist)
+		if get_setting('CONTENT_ADDRESSED_STORAGE'):
+			blobs = blob_store.blob_keys(filelist.keys())
+		else:
+			blobs = set()
+
+		for key, path in self.file_storage_paths(filelist).iteritems():
+			if key in blobs:
+				blob_store.drop_reference(key)
+			else:
+				default_storage.delete(path)
+		filelist.clear()
+
+	def _discard_cached_zip(self, filelist):
+		"""Removes the cached archive of a file list about to change."""
+		if filelist:
+			zip_cache.discard(zip_cache.fingerprint(
+				self.location.to_deprecated_string(), filelist))
+
+def storage_paths(location, filelist):
+	"""Returns a dictionary of storage paths for every file in a file
+	list, keyed by hash.  Content addressed files are looked up in a
+	single query.
 
+	Keyword arguments:
+	location: the location of the block owning the files.
+	filelist: A dictionary containing file metadata.
+	"""
+	if get_setting('CONTENT_ADDRESSED_STORAGE'):
+		blobs = blob_store.blob_keys(filelist.keys())
+	else:
+		blobs = set()
+
+	paths = dict()
+	for key, metadata in get_file_metadata(filelist).iteritems():
+		if key in blobs:
+			paths[key] = blob_store.blob_storage_path(key)
+		else:
+			paths[key] = _file_storage_path(
+				location, key, metadata.filename)
+	return paths
+
+def zip_members(location, filelist, folder=''):
+	"""Yields a ZipMember for each file in a file list, by filename,
+	compressed or not depending on its mimetype.  Files are only opened
+	from storage when the member is read.
+
+	Keyword arguments:
+	location: the location of the block owning the files.
+	filelist: A dictionary containing file metadata.
+	folder:   (optional) a directory in the archive for the files.
+	"""
+	paths = storage_paths(location, filelist)
+	files = sorted(get_file_metadata(filelist).iteritems(),
+		key=lambda item: (item[1].filename, item[0]))
+	for key, metadata in files:
+		yield ZipMember(
+			folder + metadata.filename,
+			_lazy_chunks(paths[key]),
+			compression = compression_for(metadata.mimetype),
+			date_time =   parse_timestamp(metadata.timestamp)
+		)
+
+def compressed_members(members):
+	"""Reads and compresses members on a pool of threads, ahead of the
+	archive writer, and yields them in their original order.  A member
+	that cannot be read is left out, so one missing file does not cut
+	the archive short.
+
+	Keyword arguments:
+	members: an iterable of ZipMember.
+	"""
+	compressed = prefetch(
+		(partial(_compress_or_skip, member) for member in members),
+		_zip_workers(),
+		depth = get_setting('ZIP_READ_AHEAD')
+	)
+	return (member for member in compressed if member is not None)
+
+def build_cached_zip(location, filelist):
+	"""Builds the archive of a file list into the zip cache, unless it is
+	already there.  Returns the fingerprint of the archive.
+
+	Keyword arguments:
+	location: the location of the block owning the files.
+	filelist: A dictionary containing file metadata.
+	"""
+	fingerprint = zip_cache.fingerprint(location, filelist)
+	if zip_cache.lookup(fingerprint) is None:
+		for chunk in zip_cache.tee(fingerprint, stream_zip(
+				compressed_members(zip_members(location, filelist)))):
+			pass
+	return fingerprint
+
+def _compress_or_skip(member):
+	"""Returns a member compressed, or None if it could not be read."""
+	try:
+		return compress_member(member)
+	except Exception:
+		log.warning("Left %s out of an archive, it could not be read.",
+			member.arcname, exc_info=True)
+		return None
+
+def _zip_workers():
+	"""Returns the pool of threads compressing archive members, shared by
+	every download of the process, or None when ZIP_WORKERS is 0.
+	"""
+	global _zip_pool
+	if not get_setting('ZIP_WORKERS'):
+		return None
+	with _zip_pool_lock:
+		if _zip_pool is None:
+			_zip_pool = ThreadPool(get_setting('ZIP_WORKERS'))
+		return _zip_pool
 
 def _file_storage_path(url, key, filename):
 	assert url.startswith("i4x://")
@@ -187,13 +569,148 @@ def _file_storage_path(url, key, filename):
 	path += os.path.splitext(filename)[1]
 	return path
 
-def _get_key(file):
-	BLOCK_SIZE = 2**10 * 8  # 8kb
+def _spool_file(fileobj):
+	"""Copies a file-like object into a spooled temporary file in a
+	single pass.  Small files stay in memory, large ones spill to disk.
+
+	Returns the spooled file (rewound), the sha1 of the contents and the
+	size of the contents in bytes.
+	"""
+	BLOCK_SIZE = 2**10 * 64  # 64kb
+	SPOOL_SIZE = 2**20 * 4   # 4mb kept in memory before spilling to disk
 	sha1 = hashlib.sha1()
-	for block in iter(partial(file.read, BLOCK_SIZE), ''):
+	size = 0
+	spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+	for block in iter(partial(fileobj.read, BLOCK_SIZE), b''):
 		sha1.update(block)
-	file.seek(0)
+		size += len(block)
+		spool.write(block)
+	spool.seek(0)
+
+	return (spool, sha1, size)
+
+def _lazy_chunks(path):
+	"""Yields the contents of a file in storage, opening it on first use."""
+	for chunk in iter_chunks(default_storage.open(path)):
+		yield chunk
+
+def _chunked_upload_root(location):
+	"""Returns the storage directory of the resumable uploads of a block."""
+	assert location.startswith("i4x://")
+	return location[6:] + '/chunked/'
+
+def _chunked_upload_path(location, upload_id, name):
+	"""Returns the storage path of a part of a resumable upload."""
+	if not upload_id.isalnum():
+		raise ExceptionResponse.HTTPBadRequest(
+			detail='Invalid upload id.')
+	return _chunked_upload_root(location) + upload_id + '/' + name
+
+def _chunked_upload_manifest(location, upload_id):
+	"""Returns the manifest of a resumable upload, or None."""
+	path = _chunked_upload_path(location, upload_id, 'manifest.json')
+	if not default_storage.exists(path):
+		return None
+	return json.loads(default_storage.open(path).read())
+
+def _chunk_names(location, upload_id):
+	"""Returns the names of the stored chunks of an upload, in order."""
+	_, files = default_storage.listdir(
+		_chunked_upload_path(location, upload_id, ''))
+	return sorted(name for name in files if name.isdigit())
+
+def _upload_expired(manifest):
+	started = parse_datetime(manifest['started'])
+	return started is None or started < _now() - datetime.timedelta(
+		seconds=get_setting('CHUNKED_UPLOAD_EXPIRY'))
+
+def discard_chunked_upload(location, upload_id):
+	"""Removes everything stored for a resumable upload, including files
+	the storage renamed on a collision.
+
+	Keyword arguments:
+	location:  the location of the block.
+	upload_id: the id of the upload.
+	"""
+	_delete_tree(_chunked_upload_path(location, upload_id, ''))
+
+def _delete_tree(prefix):
+	"""Deletes every file in storage below a directory."""
+	try:
+		directories, files = default_storage.listdir(prefix)
+	except OSError: #nothing was stored.
+		return
+	for name in files:
+		default_storage.delete(prefix + name)
+	for name in directories:
+		_delete_tree(prefix + name + '/')
+
+def remove_stale_uploads(location):
+	"""Removes the resumable uploads of a block which expired before
+	being finished.  Returns the number removed.
 
+	Keyword arguments:
+	location: the location of the block.
+	"""
+	root = _chunked_upload_root(location)
+	if not default_storage.exists(root):
+		return 0
+
+	removed = 0
+	uploads, _ = default_storage.listdir(root)
+	for upload_id in uploads:
+		if not upload_id.isalnum():
+			continue
+		manifest = _chunked_upload_manifest(location, upload_id)
+		#an upload without a manifest is being started or discarded.
+		if manifest is not None and _upload_expired(manifest):
+			discard_chunked_upload(location, upload_id)
+			removed += 1
+	return removed
+
+def _schedule_upload_cleanup(location):
+	"""Queues a removal of the block's stale uploads, at most once per
+	CHUNKED_UPLOAD_EXPIRY.
+	"""
+	if not cache.add('edx_mfu.upload_cleanup.' + location, True,
+			get_setting('CHUNKED_UPLOAD_EXPIRY')):
+		return
+	try:
+		background.enqueue('edx_mfu.tasks.remove_stale_uploads', location)
+	except Exception:
+		log.warning("Could not queue upload cleanup.", exc_info=True)
+
+def _chunk_name(offset):
+	"""Returns the name of a chunk, zero padded so names sort by offset."""
+	return '%016d' % int(offset)
+
+class _ChunkReader(object):
+	"""
+	A read-only file-like object over a sequence of stored chunks.
+	"""
+	def __init__(self, paths):
+		self.paths = list(paths)
+		self.current = None
+
+	def read(self, size=-1):
+		while True:
+			if self.current is None:
+				if not self.paths:
+					return b''
+				self.current = default_storage.open(self.paths.pop(0))
+
+			data = self.current.read(size)
+			if data:
+				return data
+
+			self.current.close()
+			self.current = None
+
+def _get_key(sha1):
+	"""Returns the storage key for a file given the sha1 of its contents.
+	The upload time is mixed in so that each upload is stored seperately.
+	"""
+	sha1 = sha1.copy()
 	sha1.update(str(_now()))
 	return sha1.hexdigest()
 
@@ -0,0 +1,282 @@
+"""
+Helpers for serving files from storage over HTTP, with support for
+conditional requests (ETag, Last-Modified) and byte ranges.
+
+The transfer itself can be offloaded to the front end proxy with the
+FILE_SERVING_MODE setting:
+
+	'python':           stream the file from the worker.  Files in local
+	                    storage are sent with wsgi.file_wrapper when the
+	                    server provides it.
+	'x-accel-redirect': return an X-Accel-Redirect header (nginx) pointing
+	                    below X_ACCEL_REDIRECT_PREFIX.
+	'x-sendfile':       return an X-Sendfile header (apache, lighttpd)
+	                    holding the local path of the file.
+"""
+import datetime
+import pytz
+import urllib
+import uuid
+
+from email.utils import formatdate
+from calendar import timegm
+
+from webob.response import Response
+
+from django.core.files.storage import default_storage
+
+from config import get_setting
+
+BLOCK_SIZE = 2**10 * 8  # 8kb
+
+#more ranges than this in one request are answered with the whole file.
+MAX_RANGES = 16
+
+def serve_file(request, path, content_type, filename, etag,
+		last_modified=None, storage=None, accel_prefix=None):
+	"""Returns a response streaming a file from storage.  Answers
+	conditional requests with 304 and Range requests with 206.
+
+	Keyword arguments:
+	request:       the request, or None to always send the whole file.
+	path:          the storage path of the file.
+	content_type:  the mimetype of the file.
+	filename:      the name the file is downloaded as.
+	etag:          a strong entity tag for the file, without quotes.
+	last_modified: (optional) a datetime when the file last changed.
+	storage:       (optional) the storage holding the file, by default
+	               default_storage.
+	accel_prefix:  (optional) the proxy location mapped onto the root of
+	               the storage, by default X_ACCEL_REDIRECT_PREFIX.
+	"""
+	storage = storage or default_storage
+	etag = '"' + etag + '"'
+	headers = [('ETag', etag), ('Accept-Ranges', 'bytes')]
+	if last_modified is not None:
+		headers.append(('Last-Modified', _http_date(last_modified)))
+
+	offloaded = _offload_header(storage, path, accel_prefix)
+	if offloaded is not None:
+		#the proxy answers conditional and Range requests itself.
+		response = Response(
+			content_type =        content_type,
+			content_disposition = "attachment; filename=" + filename
+		)
+		response.headerlist.extend(headers)
+		response.headers[offloaded[0]] = offloaded[1]
+		response.content_length = None
+		return response
+
+	if request is not None and _not_modified(request, etag, last_modified):
+		return Response(status=304, headerlist=headers)
+
+	size = storage.size(path)
+	ranges = None
+	if request is not None and _if_range_matches(request, etag, last_modified):
+		ranges = parse_range_header(request.headers.get('Range'), size)
+
+	if ranges == []:
+		headers.append(('Content-Range', 'bytes */' + str(size)))
+		return Response(status=416, headerlist=headers)
+
+	response = Response(
+		content_type =        content_type,
+		content_disposition = "attachment; filename=" + filename
+	)
+	response.headerlist.extend(headers)
+
+	if ranges is None:
+		response.app_iter = _iter_file(request, storage, path, size)
+		response.content_length = size
+	elif len(ranges) == 1:
+		start, end = ranges[0]
+		response.status = 206
+		response.app_iter = _iter_range(storage, path, start, end)
+		response.content_length = end - start + 1
+		response.headers['Content-Range'] = _content_range(start, end, size)
+	else:
+		boundary = uuid.uuid4().hex
+		parts = [(start, end, _part_header(boundary, content_type, start, end, size))
+			for start, end in ranges]
+		trailer = '\r\n--' + boundary + '--\r\n'
+
+		response.status = 206
+		response.headers['Content-Type'] = \
+			'multipart/byteranges; boundary=' + boundary
+		response.app_iter = _iter_multipart(storage, path, parts, trailer)
+		response.content_length = len(trailer) + sum(
+			len(header) + end - start + 1 for start, end, header in parts)
+
+	return response
+
+def parse_range_header(header, size):
+	"""Parses a Range header into a list of inclusive (start, end) byte
+	positions.  Returns None if there is no usable header, in which case
+	the whole file is sent, and an empty list if no range can be
+	satisfied.
+
+	Keyword arguments:
+	header: the value of the Range header.
+	size:   the size of the file in bytes.
+	"""
+	if not header or not header.strip().startswith('bytes='):
+		return None
+
+	specs = header.strip()[len('bytes='):].split(',')
+	if len(specs) > MAX_RANGES:
+		return None
+
+	ranges = []
+	for spec in specs:
+		start, sep, end = spec.strip().partition('-')
+		#positions are digits only, so '--5' or '-1-2' are not ranges.
+		if not sep or start == end == '' or \
+				not (start == '' or start.isdigit()) or \
+				not (end == '' or end.isdigit()):
+			return None
+
+		if start == '': #suffix range, the last n bytes.
+			length = int(end)
+			if length == 0 or size == 0:
+				continue
+			ranges.append((max(size - length, 0), size - 1))
+		else:
+			start = int(start)
+			end = int(end) if end else None
+			if end is not None and end < start:
+				return None
+			if start < size: #ranges past the end are unsatisfiable.
+				if end is None or end >= size:
+					end = size - 1
+				ranges.append((start, end))
+
+	return ranges
+
+def parse_timestamp(timestamp):
+	"""Returns the datetime for a FileMetaData timestamp, or None.
+
+	Keyword arguments:
+	timestamp: a string produced by str() on a UTC datetime.
+	"""
+	try:
+		return datetime.datetime.strptime(
+			timestamp[:19], '%Y-%m-%d %H:%M:%S').replace(tzinfo=pytz.utc)
+	except (TypeError, ValueError):
+		return None
+
+def _not_modified(request, etag, last_modified):
+	"""Returns True if the client already holds the current file."""
+	if_none_match = request.headers.get('If-None-Match')
+	if if_none_match is not None:
+		tags = [tag.strip() for tag in if_none_match.split(',')]
+		return '*' in tags or etag in tags or ('W/' + etag) in tags
+
+	since = request.if_modified_since
+	if since is not None and last_modified is not None:
+		return last_modified.replace(microsecond=0) <= since
+	return False
+
+def _if_range_matches(request, etag, last_modified):
+	"""Returns True unless an If-Range header names another version."""
+	if_range = request.headers.get('If-Range')
+	if if_range is None:
+		return True
+	if_range = if_range.strip()
+	if if_range.startswith('"'):
+		return if_range == etag
+	return last_modified is not None and \
+		if_range == _http_date(last_modified)
+
+def _http_date(value):
+	return formatdate(timegm(value.utctimetuple()), usegmt=True)
+
+def _content_range(start, end, size):
+	return 'bytes %d-%d/%d' % (start, end, size)
+
+def _part_header(boundary, content_type, start, end, size):
+	return ('\r\n--' + boundary + '\r\n' +
+		'Content-Type: ' + (content_type or 'application/octet-stream') + '\r\n' +
+		'Content-Range: ' + _content_range(start, end, size) + '\r\n\r\n')
+
+def _offload_header(storage, path, accel_prefix):
+	"""Returns the header handing a file to the proxy, or None when files
+	are served from python.
+	"""
+	mode = get_setting('FILE_SERVING_MODE')
+	if mode == 'x-accel-redirect':
+		prefix = accel_prefix or get_setting('X_ACCEL_REDIRECT_PREFIX')
+		#quote() cannot take unicode outside of ASCII.
+		return ('X-Accel-Redirect', urllib.quote(_encode(prefix + path)))
+	elif mode == 'x-sendfile':
+		local_path = _local_path(storage, path)
+		if local_path is not None:
+			return ('X-Sendfile', _encode(local_path))
+	return None
+
+def _encode(value):
+	"""Returns a header value as UTF-8 bytes."""
+	if isinstance(value, unicode):
+		return value.encode('utf-8')
+	return value
+
+def _local_path(storage, path):
+	"""Returns the filesystem path of a file, or None if the storage
+	does not keep files on the local disk.
+	"""
+	try:
+		return storage.path(path)
+	except NotImplementedError:
+		return None
+
+def _iter_file(request, storage, path, size):
+	"""Returns an iterator over a whole file.  Local files are handed to
+	the server's wsgi.file_wrapper, which can use sendfile.
+	"""
+	file_wrapper = None
+	if request is not None:
+		file_wrapper = request.environ.get('wsgi.file_wrapper')
+
+	if file_wrapper is not None:
+		local_path = _local_path(storage, path)
+		if local_path is not None:
+			return file_wrapper(open(local_path, 'rb'), BLOCK_SIZE)
+
+	return _iter_range(storage, path, 0, size - 1)
+
+def _iter_range(storage, path, start, end):
+	"""Returns an iterator over bytes start to end (inclusive) of a file
+	in storage.
+	"""
+	return _iter_parts(storage.open(path), [(start, end, None)], None)
+
+def _iter_multipart(storage, path, parts, trailer):
+	"""Returns an iterator over a multipart/byteranges body, seeking in a
+	single open file.
+	"""
+	return _iter_parts(storage.open(path), parts, trailer)
+
+def _iter_parts(afile, parts, trailer):
+	"""Yields ranges of a file, each after its header, then the trailer.
+	The file is opened by the caller so that a missing file fails before
+	the response is returned.
+	"""
+	try:
+		for start, end, header in parts:
+			if header:
+				yield header
+			for block in _read_range(afile, start, end):
+				yield block
+		if trailer:
+			yield trailer
+	finally:
+		afile.close()
+
+def _read_range(afile, start, end):
+	afile.seek(start)
+	remaining = end - start + 1
+	while remaining > 0:
+		block = afile.read(min(BLOCK_SIZE, remaining))
+		if not block:
+			break
+		remaining -= len(block)
+		yield block
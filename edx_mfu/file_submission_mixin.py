@@ -18,6 +18,8 @@ from xblock.fields import XBlockMixin, Scope, Dict
 
 from webob.response import Response
 
+from unit_of_work import unit_of_work
+
 from django.core.files import File
 from django.core.files.storage import default_storage
 from django.template import Context, Template
@@ -43,11 +45,13 @@ class FileSubmissionMixin(XBlockMixin):
 		request: holds the file to be added to the submission.
 		suffix:  not used.
 		"""
+		self.validate_upload_allowed()
 
 		key, uploaded = self.upload_file(
 			self.uploaded_files, 
 			request.params['uploadedFile']
 		)
+		self.save_student_state()
 		
 		return Response(json_body={
 			"sha1":      key, 
@@ -55,17 +59,85 @@ class FileSubmissionMixin(XBlockMixin):
 			"timestamp": uploaded.timestamp
 		})
 		
+	@XBlock.handler
+	def student_upload_init(self, request, suffix=''):
+		"""Starts a resumable upload of a file for submission.
+
+		Keyword arguments:
+		request: holds the filename and the size of the file.
+		suffix:  not used.
+		"""
+		self.validate_upload_allowed()
+		owner = self.upload_owner()
+		upload_id = self.begin_chunked_upload(
+			request.params.get('filename'),
+			request.params.get('size'),
+			owner
+		)
+
+		return Response(json_body=self.chunked_upload_status(upload_id, owner))
+
+	@XBlock.handler
+	def student_upload_chunk(self, request, suffix=''):
+		"""Stores a chunk of a resumable upload.
+
+		Keyword arguments:
+		request: holds the offset of the chunk, the body is the chunk.
+		suffix:  the id of the upload.
+		"""
+		self.validate_upload_allowed()
+		return Response(json_body=self.store_chunk(
+			suffix,
+			request.params.get('offset'),
+			request.body_file,
+			self.upload_owner()
+		))
+
+	@XBlock.handler
+	def student_upload_status(self, request, suffix=''):
+		"""Returns the number of bytes received for a resumable upload.
+
+		Keyword arguments:
+		request: not used.
+		suffix:  the id of the upload.
+		"""
+		return Response(json_body=self.chunked_upload_status(
+			suffix, self.upload_owner()))
+
+	@XBlock.handler
+	def student_upload_finalize(self, request, suffix=''):
+		"""Adds a completed resumable upload to the submission.
+
+		Keyword arguments:
+		request: not used.
+		suffix:  the id of the upload.
+		"""
+		self.validate_upload_allowed()
+		key, uploaded = self.finish_chunked_upload(
+			self.uploaded_files,
+			suffix,
+			self.upload_owner()
+		)
+		self.save_student_state()
+
+		return Response(json_body={
+			"sha1":      key, 
+			"filename":  uploaded.filename,
+			"timestamp": uploaded.timestamp
+		})
+
 	@XBlock.handler
 	def student_download_file(self, request, suffix=''):
 		"""Returns a temporary download link for a file.
 
 		Keyword arguments:
-		request: not used
+		request: may hold conditional and Range headers.
 		suffix:  the hash of the file.
 		"""
-		return self.download_file(self.uploaded_files, suffix)
+		return self.download_file(self.uploaded_files, suffix, request)
 
 	@XBlock.handler
+	@unit_of_work
 	def staff_download_file(self, request, suffix=''):
 		"""Returns a temporary download link for a file.
 
@@ -77,10 +149,12 @@ class FileSubmissionMixin(XBlockMixin):
 
 		return self.download_file(
 			self.uploaded_file_list(request.params['module_id']),
-			suffix
+			suffix,
+			request
 		 )
 	
 	@XBlock.handler
+	@unit_of_work
 	def staff_download_zipped(self, request, suffix=''):
 		"""Returns all uploaded files in a zip file.
 
@@ -94,7 +168,38 @@ class FileSubmissionMixin(XBlockMixin):
 		module = self.get_module(module_id)
 		return self.download_zipped(
 			self.uploaded_file_list(module_id), 
-			self.display_name + "-" + module.student.username
+			self.display_name + "-" + module.student.username,
+			request
+		)
+
+	@XBlock.handler
+	def staff_download_all_zipped(self, request, suffix=''):
+		"""Returns the files of every student in one zip file, with a
+		folder for each student, by username.
+
+		Keyword arguments:
+		request: may hold annotated=1 to include annotated files.
+		suffix:  not used.
+		"""
+		self.validate_staff_request()
+
+		include_annotated = request.params.get('annotated') in ('1', 'true')
+		query = StudentModule.objects.filter(
+			course_id=self.xmodule_runtime.course_id,
+			module_state_key=self.location
+		).select_related('student').order_by('student__username', 'id')
+
+		def folders():
+			for module in query.iterator():
+				state = json.loads(module.state)
+				folder = module.student.username + '/'
+				yield (folder, state.get('uploaded_files'))
+				if include_annotated:
+					yield (folder + 'annotated/', state.get('annotated_files'))
+
+		return self.download_zipped_folders(
+			folders(),
+			self.display_name + "-all"
 		)
 
 	@XBlock.handler
@@ -107,7 +212,8 @@ class FileSubmissionMixin(XBlockMixin):
 		"""
 		return self.download_zipped(
 			self.uploaded_files, 
-			self.display_name + "assignment"
+			self.display_name + "assignment",
+			request
 		)
 
 	@XBlock.handler
@@ -120,9 +226,11 @@ class FileSubmissionMixin(XBlockMixin):
 		"""
 		assert self.upload_allowed()
 		self.delete_file(self.uploaded_files, suffix)
+		self.save_student_state()
 		return Response(status = 204)
 
 	@XBlock.handler
+	@unit_of_work
 	def staff_delete_file(self, request, suffix=''):
 		"""Removes an uploaded file from the assignemnt
 
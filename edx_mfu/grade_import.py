@@ -0,0 +1,176 @@
+"""
+Enters the grades of many students at once, from a CSV file with
+username, score and comment columns (such as the grade export) or a JSON
+list of objects with the same keys.  Every row is checked before anything
+is written, and the batch is written in one transaction: a batch with an
+invalid row, or a row which could not be written, is rejected as a whole.
+"""
+import codecs
+import csv
+import json
+import math
+
+from StringIO import StringIO
+
+from django.db import transaction
+
+import grading_cache
+from config import get_setting
+from grading import FORMULA_PREFIXES, GradingDataLoader
+from unit_of_work import compare_and_set
+
+class GradeImport(object):
+	"""
+	A batch of grades for the students of a block.
+	"""
+	def __init__(self, block):
+		self.block = block
+		self.loader = GradingDataLoader(block)
+		self.max_score = block.max_score()
+		self.approved = block.is_instructor()
+
+	def run(self, entries):
+		"""Checks and enters a batch of grades.  Returns (number of grades
+		entered, errors); nothing is entered if there are errors.  Raises
+		HTTPConflict, having entered nothing, if a student's state keeps
+		changing while it is written.
+
+		Keyword arguments:
+		entries: (line, username, score, comment) for each row, as
+		         returned by parse_grades.
+		"""
+		grades, errors = self.validate(entries)
+		if errors:
+			return 0, errors
+
+		fields = dict(
+			score_published=False,
+			score_approved=self.approved
+		)
+		changes = []
+		for module, score, comment in grades:
+			change = dict(fields, score=score, comment=comment)
+			state = json.loads(module.state)
+			state.update(change)
+			changes.append((module, state, change))
+
+		#one transaction, so a conflict on any row enters nothing.
+		with transaction.atomic():
+			for module, state, change in changes:
+				compare_and_set(module, state, change)
+		grading_cache.bump(self.block.location)
+
+		return len(changes), []
+
+	def validate(self, entries):
+		"""Returns (module, score, comment) for each valid row with a
+		score, and a list of errors for the invalid rows.  Rows without
+		a score are skipped.
+
+		Keyword arguments:
+		entries: (line, username, score, comment) for each row.
+		"""
+		entries = [entry for entry in entries if entry[2] not in (None, '')]
+		modules = self.modules([entry[1] for entry in entries])
+
+		grades = []
+		errors = []
+		seen = set()
+		for line, username, score, comment in entries:
+			module = modules.get(username)
+			if module is None:
+				errors.append(_error(line, username, 'No such student.'))
+				continue
+			if username in seen:
+				errors.append(_error(line, username, 'Student graded twice.'))
+				continue
+			seen.add(username)
+
+			try:
+				score = float(score)
+			except (TypeError, ValueError):
+				errors.append(_error(line, username, 'Score is not a number.'))
+				continue
+			if math.isnan(score) or not 0 <= score <= self.max_score:
+				errors.append(_error(line, username,
+					'Score must be between 0 and ' + str(self.max_score) + '.'))
+				continue
+
+			if not self.loader.row(module)['may_grade']:
+				errors.append(_error(line, username,
+					'The grade may not be changed.'))
+				continue
+
+			grades.append((module, score, comment or ''))
+		return grades, errors
+
+	def modules(self, usernames):
+		"""Returns the student modules of the block for a list of
+		usernames, keyed by username, fetched a chunk at a time.
+
+		Keyword arguments:
+		usernames: the usernames to look up.
+		"""
+		usernames = list(set(usernames))
+		chunk_size = get_setting('BULK_CHUNK_SIZE')
+		modules = dict()
+		for i in range(0, len(usernames), chunk_size):
+			for module in self.loader.modules().filter(
+					student__username__in=usernames[i:i + chunk_size]):
+				modules[module.student.username] = module
+		return modules
+
+def parse_grades(body, content_type):
+	"""Returns (line, username, score, comment) for each row of a CSV or
+	JSON batch of grades.  The line of a CSV row is its line in the file,
+	the line of a JSON row its position in the list, counting from 1.
+	Raises ValueError if the batch cannot be read.
+
+	Keyword arguments:
+	body:         the batch.
+	content_type: application/json for JSON, anything else is CSV.
+	"""
+	if content_type == 'application/json':
+		rows = json.loads(body)
+		if isinstance(rows, dict):
+			rows = rows.get('grades')
+		if not isinstance(rows, list) or \
+				not all(isinstance(row, dict) for row in rows):
+			raise ValueError('Expected a list of grades.')
+		return [
+			(line, row.get('username'), row.get('score'), row.get('comment'))
+			for line, row in enumerate(rows, 1)
+		]
+
+	if body.startswith(codecs.BOM_UTF8):
+		body = body[len(codecs.BOM_UTF8):]
+	reader = csv.DictReader(StringIO(body))
+	try:
+		if not reader.fieldnames or \
+				not set(['username', 'score']) <= set(reader.fieldnames):
+			raise ValueError('Expected username and score columns.')
+		entries = []
+		for row in reader:
+			entries.append((
+				reader.line_num,
+				_decode(row['username']),
+				_decode(row['score']),
+				_decode(row.get('comment'))
+			))
+	except csv.Error as e:
+		raise ValueError('Line %d: %s' % (reader.line_num, e))
+	return entries
+
+def _decode(value):
+	"""Returns a CSV cell as stripped unicode, or None if it is missing.
+	The quote the grade export puts before text read as a formula is
+	removed.
+	"""
+	if value is None:
+		return None
+	if value.startswith("'") and value[1:].startswith(FORMULA_PREFIXES):
+		value = value[1:]
+	return value.decode('utf-8').strip()
+
+def _error(line, username, message):
+	return {'line': line, 'username': username, 'message': message}
@@ -0,0 +1,162 @@
+"""
+Publishes approved grades outside of the request.  The state of each
+student module is the queue: a grade is waiting to be published while it
+is approved and score_published is false.  Approving grades schedules one
+background run for the block, however many grades were approved, and the
+run publishes every waiting grade a chunk of students at a time.
+
+A grade is published the way the LMS publishes any grade: the block is
+bound to the student, as the instructor tasks of the LMS do for
+rescoring, and its runtime is sent a 'grade' event, out of the
+max_score() the block has when the grade is published.  Only then is the
+grade marked published, with a conditional UPDATE on the state it was
+approved in.  A grade changed while being published is left for the next
+run, and a grade the runtime failed to publish stays waiting.
+"""
+import datetime
+import json
+import logging
+import pytz
+
+from courseware.models import StudentModule
+
+from django.core.cache import cache
+
+from opaque_keys.edx.keys import CourseKey, UsageKey
+
+import background
+import grading_cache
+from config import get_setting
+
+log = logging.getLogger(__name__)
+
+def schedule(block):
+	"""Queues a run publishing the waiting grades of a block, unless one is
+	already queued.
+
+	Keyword arguments:
+	block: the block whose grades are published.
+	"""
+	location = unicode(block.location)
+	if not cache.add(_scheduled_key(location), True, SCHEDULE_TIMEOUT):
+		return
+	try:
+		background.enqueue(
+			'edx_mfu.tasks.publish_grades',
+			unicode(block.xmodule_runtime.course_id),
+			location
+		)
+	except Exception:
+		cache.delete(_scheduled_key(location))
+		raise
+
+def publish_grades(course_id, location):
+	"""Publishes every waiting grade of a block.  Returns the number of
+	grades published.
+
+	Keyword arguments:
+	course_id: the course key of the block.
+	location:  the usage key of the block.
+	"""
+	#grades approved from now on need another run.
+	cache.delete(_scheduled_key(location))
+
+	course_key = CourseKey.from_string(course_id)
+	usage_key = UsageKey.from_string(location)
+	waiting = StudentModule.objects.filter(
+		course_id=course_key,
+		module_state_key=usage_key,
+		state__contains='"score_approved": true'
+	).filter(state__contains='"score_published": false')
+
+	descriptor = None
+	chunk_size = get_setting('BULK_CHUNK_SIZE')
+	published = 0
+	last_id = 0
+	while True:
+		chunk = list(waiting.filter(id__gt=last_id)
+			.select_related('student').order_by('id')[:chunk_size])
+		if chunk and descriptor is None:
+			descriptor = _load_descriptor(usage_key)
+
+		for module in chunk:
+			try:
+				if publish_grade(module, _bind(descriptor, course_key, module.student)):
+					published += 1
+			except Exception:
+				#the grade stays waiting for the next run.
+				log.exception("Could not publish the grade of %s for %s",
+					module.student.username, location)
+
+		if len(chunk) < chunk_size:
+			break
+		last_id = chunk[-1].id
+
+	if published:
+		grading_cache.bump(location)
+	log.info("Published %d grades for %s", published, location)
+	return published
+
+def publish_grade(module, block):
+	"""Publishes the grade of a student module if it is approved and not
+	yet published.  Returns True if it was published.
+
+	Keyword arguments:
+	module: the student module, as read.
+	block:  the block, bound to the student of the module.
+	"""
+	state = json.loads(module.state)
+	if state.get('score_published') or not state.get('score_approved') or \
+			state.get('score') is None:
+		return False
+
+	block.runtime.publish(block, 'grade', {
+		'value': state['score'],
+		'max_value': block.max_score(),
+	})
+
+	#the runtime saves the student module itself, so only the state tells
+	#whether the grade changed meanwhile.
+	state['score_published'] = True
+	return bool(StudentModule.objects.filter(
+		pk=module.id,
+		state=module.state
+	).update(
+		state=json.dumps(state),
+		modified=_now()
+	))
+
+#seconds a scheduled run blocks further runs, should its task be lost.
+SCHEDULE_TIMEOUT = 300
+
+def _scheduled_key(location):
+	return 'edx_mfu.grade_publishing.' + location
+
+#the LMS runtime is imported by the runs only, as it is not there in
+#Studio.
+def _load_descriptor(usage_key):
+	from xmodule.modulestore.django import modulestore
+	return modulestore().get_item(usage_key)
+
+def _bind(descriptor, course_key, student):
+	"""Returns the block of a descriptor bound to a student, with the
+	runtime of the LMS.
+	"""
+	from courseware.model_data import DjangoKeyValueStore, FieldDataCache
+	from courseware.module_render import get_module_for_descriptor_internal
+	from xblock.runtime import KvsFieldData
+
+	field_data_cache = FieldDataCache.cache_for_descriptor_descendents(
+		course_key, student, descriptor)
+	return get_module_for_descriptor_internal(
+		user=student,
+		descriptor=descriptor,
+		student_data=KvsFieldData(DjangoKeyValueStore(field_data_cache)),
+		course_id=course_key,
+		track_function=lambda event_type, event: None,
+		xqueue_callback_url_prefix='',
+		request_token=None
+	)
+
+def _now():
+	return datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
@@ -0,0 +1,375 @@
+"""
+Loads the data shown to staff in the grading table.
+"""
+import base64
+import csv
+import datetime
+import json
+import pytz
+
+from StringIO import StringIO
+
+from courseware.models import StudentModule
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+import webob.exc as ExceptionResponse
+
+from xmodule.util.duedate import get_extended_due_date
+
+import grading_cache
+from config import get_setting
+from file_management_mixin import get_file_metadata
+
+SORT_KEYS = ('username', 'submission_time', 'score')
+
+FILTERS = {
+	'submitted':      lambda row: bool(row['submitted']),
+	'needs_approval': lambda row: bool(row['needs_approval']),
+	'ungraded':       lambda row: row['score'] is None,
+}
+
+MAX_PAGE_SIZE = 500
+
+CSV_COLUMNS = ('username', 'fullname', 'score', 'max_score', 'comment',
+	'approved', 'published', 'submitted', 'submission_time', 'module_id')
+
+#text cells starting with these are quoted with a ', so spreadsheets do
+#not run them as formulas.
+FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+class GradingDataLoader(object):
+	"""
+	Packages the student modules of a block for display to staff.  The
+	modules, their students and the students' profiles are fetched in a
+	single query, and everything that depends only on the request (the
+	requestor's role, the due date) is computed once.
+	"""
+	def __init__(self, block):
+		self.block = block
+		self.instructor = block.is_instructor()
+		self.due = get_extended_due_date(block)
+		self.now = _now()
+
+	def modules(self):
+		"""Returns a query over the student modules of the block, with
+		each student and profile joined in.
+		"""
+		return StudentModule.objects.filter(
+			course_id=self.block.xmodule_runtime.course_id,
+			module_state_key=self.block.location
+		).select_related('student', 'student__profile')
+
+	def iter_modules(self, chunk_size=500):
+		"""Yields every student module of the block, fetching them chunk
+		by chunk in primary key order so that only one chunk is held in
+		memory at a time.
+
+		Keyword arguments:
+		chunk_size: the number of modules fetched per query.
+		"""
+		last_id = 0
+		while True:
+			chunk = list(self.modules().filter(id__gt=last_id)
+				.order_by('id')[:chunk_size])
+			for module in chunk:
+				yield module
+			if len(chunk) < chunk_size:
+				return
+			last_id = chunk[-1].id
+
+	def iter_json(self, max_score, chunk_size=500):
+		"""Yields the grading data as a JSON document, a chunk of students
+		at a time.  Produces the same document as json.dumps on the data
+		returned by staff_grading_data.
+
+		Keyword arguments:
+		max_score:  the maximum score of the block.
+		chunk_size: the number of students serialized per chunk.
+		"""
+		yield '{"max_score": ' + json.dumps(max_score) + ', "assignments": ['
+		separator = ''
+		batch = []
+		for module in self.iter_modules(chunk_size):
+			batch.append(json.dumps(self.row(module)))
+			if len(batch) == chunk_size:
+				yield separator + ', '.join(batch)
+				separator = ', '
+				batch = []
+		if batch:
+			yield separator + ', '.join(batch)
+		yield ']}'
+
+	def iter_csv(self, max_score, chunk_size=500):
+		"""Yields the grading data as a UTF-8 CSV file, a chunk of students
+		at a time.  The file can be edited and sent back to the grade
+		import, which reads the username, score and comment columns.
+
+		Keyword arguments:
+		max_score:  the maximum score of the block.
+		chunk_size: the number of students written per chunk.
+		"""
+		out = StringIO()
+		writer = csv.writer(out)
+		writer.writerow(CSV_COLUMNS)
+		for i, module in enumerate(self.iter_modules(chunk_size), 1):
+			row = self.row(module)
+			writer.writerow([_csv_value(value) for value in (
+				row['username'],
+				row['fullname'],
+				row['score'],
+				max_score,
+				row['comment'],
+				row['approved'],
+				row['published'],
+				row['submitted'],
+				row['submission_time'],
+				row['module_id']
+			)])
+			if i % chunk_size == 0:
+				yield out.getvalue()
+				out.seek(0)
+				out.truncate()
+		yield out.getvalue()
+
+	def rows(self, modules=None):
+		"""Returns the grading data of every student.
+
+		Keyword arguments:
+		modules: (optional) the student modules to package, by default
+		         every module of the block.
+		"""
+		if modules is None:
+			modules = self.modules()
+		return [self.row(module) for module in modules]
+
+	def page(self, page=1, page_size=50, sort='username', filters=(),
+			cursor=None):
+		"""Returns one page of grading data, sorted and filtered, with the
+		total number of matching students.  Sorting by username and
+		filtering on submitted are done by the database, so only the
+		page is loaded; other sorts and filters work on the grading table
+		of every student, from the grading cache.
+
+		Keyword arguments:
+		page:      the page number, starting at 1.
+		page_size: the number of students on a page.
+		sort:      one of SORT_KEYS, prefixed with '-' to reverse it.
+		filters:   names from FILTERS, all of which must match.
+		cursor:    (optional) the next_cursor of the previous page, in
+		           place of a page number.  Only for username sorts
+		           handled by the database, others answer 400.
+		"""
+		try:
+			page = max(int(page), 1)
+			page_size = min(max(int(page_size), 1), MAX_PAGE_SIZE)
+		except (TypeError, ValueError):
+			raise ExceptionResponse.HTTPBadRequest(
+				detail='Invalid page.',
+				comment='page and page_size must be whole numbers.'
+				)
+
+		reverse = sort.startswith('-')
+		sort_key = sort.lstrip('-')
+		if sort_key not in SORT_KEYS or not set(filters) <= set(FILTERS):
+			raise ExceptionResponse.HTTPBadRequest(
+				detail='Invalid sort or filter.',
+				comment='sort must be one of ' + ', '.join(SORT_KEYS) +
+					' and filters any of ' + ', '.join(FILTERS) + '.'
+				)
+
+		by_database = sort_key == 'username' and \
+			set(filters) <= set(['submitted'])
+		if cursor and not by_database:
+			raise ExceptionResponse.HTTPBadRequest(
+				detail='Invalid cursor.',
+				comment='A cursor can only be used when sorting by username, '
+					'filtering on submitted at most.'
+				)
+
+		result = {
+			'page':        page,
+			'page_size':   page_size,
+			'sort':        sort,
+			'filters':     list(filters),
+			'next_cursor': None,
+		}
+
+		if by_database:
+			modules = self.modules()
+			if 'submitted' in filters:
+				#state is always written by json.dumps, so the key and value
+				#appear exactly like this.
+				modules = modules.filter(state__contains='"is_submitted": true')
+			result['total'] = modules.count()
+			order = ('-student__username', '-id') if reverse else \
+				('student__username', 'id')
+			modules = modules.order_by(*order)
+			if cursor:
+				modules = modules.filter(_after_cursor(cursor, reverse))
+			else:
+				modules = modules[(page - 1) * page_size:]
+
+			rows = self.rows(modules[:page_size + 1])
+			if len(rows) > page_size:
+				rows = rows[:page_size]
+				result['next_cursor'] = _make_cursor(rows[-1])
+			result['assignments'] = rows
+			return result
+
+		rows = [row for row in grading_cache.cached_rows(self)
+			if all(FILTERS[name](row) for name in filters)]
+		#students without a value always come last.
+		missing = [row for row in rows if row[sort_key] is None]
+		rows = sorted(
+			(row for row in rows if row[sort_key] is not None),
+			key=lambda row: (row[sort_key], row['username']),
+			reverse=reverse
+		) + missing
+		result['total'] = len(rows)
+		result['assignments'] = rows[(page - 1) * page_size:page * page_size]
+		return result
+
+	def changes(self, since=None):
+		"""Returns the grading data of students whose module changed at
+		or after a watermark, and the watermark to send next time.
+
+		A module is stamped when it is written, but only seen once its
+		transaction commits, possibly after a module stamped later was
+		returned.  The watermark is therefore held GRADING_CHANGES_LAG
+		seconds behind now: as long as no write transaction takes longer
+		than that, every change is returned by the call which is passed
+		the watermark of the call before it.  Rows changed after the
+		watermark are returned again by the next call.
+
+		Keyword arguments:
+		since: (optional) the watermark returned by the last call.  All
+		       students are returned without it.
+		"""
+		modules = self.modules()
+		if since:
+			since_time = parse_datetime(since)
+			if since_time is None:
+				raise ExceptionResponse.HTTPBadRequest(
+					detail='Invalid watermark.',
+					comment='since must be a watermark returned by a previous call.'
+					)
+			modules = modules.filter(modified__gte=since_time)
+
+		modules = list(modules.order_by('modified'))
+		settled = self.now - datetime.timedelta(
+			seconds=get_setting('GRADING_CHANGES_LAG'))
+		if modules:
+			watermark = min(modules[-1].modified, settled).isoformat()
+		elif since:
+			watermark = since
+		else:
+			watermark = settled.isoformat()
+
+		return {
+			'assignments': self.rows(modules),
+			'watermark':   watermark,
+		}
+
+	def row(self, module):
+		"""Packages data from a student module for display to staff.
+
+		Keyword arguments:
+		module: a student module, with its student and profile loaded.
+		"""
+		return self.finish_row(self.module_row(module))
+
+	def module_row(self, module):
+		"""Returns the part of a student's grading data which depends only
+		on their student module, and not on who is asking or when.
+
+		Keyword arguments:
+		module: a student module, with its student and profile loaded.
+		"""
+		state = json.loads(module.state)
+
+		uploaded = []
+		if (state.get('is_submitted')):
+			for sha1, metadata in get_file_metadata(state.get("uploaded_files")).iteritems():
+				uploaded.append({
+					"sha1":      sha1, 
+					"filename":  metadata.filename,
+					"timestamp": metadata.timestamp
+				})
+
+		annotated = []
+		for sha1, metadata in get_file_metadata(state.get("annotated_files")).iteritems():
+			annotated.append({
+				"sha1":      sha1, 
+				"filename":  metadata.filename,
+				"timestamp": metadata.timestamp
+			})
+
+		return {
+			'module_id':       module.id,
+			'username':        module.student.username,
+			'fullname':        module.student.profile.name,
+			'uploaded':        uploaded,
+			'annotated':       annotated,
+			'timestamp':       state.get("uploaded_files_last_timestamp"),
+			'published':       state.get("score_published"),
+			'score':           state.get('score'),
+			'approved':        state.get('score_approved'),
+			'comment':         state.get("comment", ''),
+
+			'submitted':       state.get('is_submitted'),
+			'submission_time': state.get('submission_time')
+		}
+
+	def finish_row(self, row):
+		"""Adds what the requestor may do to a row from module_row.
+
+		Keyword arguments:
+		row: the row, which is changed in place.
+		"""
+		#can a grade be entered
+		may_grade = (self.instructor or not row['approved']) 
+		if self.due is not None:
+			may_grade = may_grade and (row['submitted'] or (self.due < self.now)) 
+
+		row['needs_approval'] = self.instructor and row['score'] is not None \
+							   and not row['approved']
+		row['may_grade'] = may_grade
+		return row
+
+def _csv_value(value):
+	"""Returns a value as a CSV cell: UTF-8, empty for None, and text that
+	a spreadsheet would read as a formula quoted.
+	"""
+	if value is None:
+		return ''
+	if isinstance(value, unicode):
+		value = value.encode('utf-8')
+	if isinstance(value, str) and value.startswith(FORMULA_PREFIXES):
+		value = "'" + value
+	return value
+
+def _make_cursor(row):
+	"""Returns an opaque cursor pointing after a row."""
+	return base64.urlsafe_b64encode(
+		json.dumps([row['username'], row['module_id']]))
+
+def _after_cursor(cursor, reverse):
+	"""Returns a filter on student modules after (or, for a reversed
+	sort, before) a cursor.
+	"""
+	try:
+		username, module_id = json.loads(
+			base64.urlsafe_b64decode(str(cursor)))
+	except (TypeError, ValueError):
+		raise ExceptionResponse.HTTPBadRequest(detail='Invalid cursor.')
+
+	if reverse:
+		return Q(student__username__lt=username) | \
+			Q(student__username=username, id__lt=module_id)
+	return Q(student__username__gt=username) | \
+		Q(student__username=username, id__gt=module_id)
+
+def _now():
+	return datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
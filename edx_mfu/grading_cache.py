@@ -0,0 +1,183 @@
+"""
+A cache of the grading table of each block.  The rows of the table, as
+built by GradingDataLoader.module_row, are kept compressed in a Django
+cache with the generation of the block they were built at.  Writes to
+student state move the block to a new generation, so a cached table of
+the current generation is served without touching the database.  When
+the generation has moved on, only the rows of student modules whose
+modification time or state changed since they were cached are built
+again.  The state is compared as well because the modification time may
+only be kept to the second.
+
+	GRADING_CACHE:         'local' for a cache in the memory of each
+	                       process, the name of a Django cache, or None.
+	GRADING_CACHE_TIMEOUT: seconds a table is kept.
+
+A 'local' cache cannot see generations moved by other processes, so its
+tables are also checked against the number and latest modification time
+of the block's student modules, in one query.  A table built within the
+second of the latest modification is not trusted this way, as a later
+write in that second would not move the summary.
+
+Usernames and full names are cached with the rows.  Changes to them do
+not move the generation: they show once the table is refreshed, or
+after GRADING_CACHE_TIMEOUT.
+"""
+import hashlib
+import json
+import logging
+import uuid
+import zlib
+
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.db.models import Count, Max
+from django.utils import timezone
+
+from config import get_setting
+
+log = logging.getLogger(__name__)
+
+_local_cache = LocMemCache('edx_mfu_grading', {})
+
+def cached_rows(loader):
+	"""Returns the grading data of every student of a block, as
+	GradingDataLoader.rows does.
+
+	Keyword arguments:
+	loader: the GradingDataLoader of the block.
+	"""
+	cache = grading_cache()
+	if cache is None:
+		return loader.rows()
+
+	location = unicode(loader.block.location)
+	generation = current_generation(location)
+	entry = _load(cache.get(_table_key(location)))
+	modules = loader.modules()
+
+	if get_setting('GRADING_CACHE') == 'local':
+		summary = modules.aggregate(count=Count('id'), modified=Max('modified'))
+		summary = [summary['count'], _timestamp(summary['modified'])]
+	else:
+		summary = None
+
+	if entry is not None and entry['generation'] == generation and \
+			entry['summary'] == summary and _settled(entry):
+		rows = entry['rows']
+	else:
+		built = _timestamp(timezone.now())
+		rows = _refresh(loader, modules, entry)
+		cache.set(
+			_table_key(location),
+			_dump({
+				'generation': generation,
+				'summary': summary,
+				'built': built,
+				'rows': rows
+			}),
+			get_setting('GRADING_CACHE_TIMEOUT')
+		)
+
+	return [loader.finish_row(dict(row)) for version, row in
+		sorted(rows.values(), key=lambda cached: cached[1]['module_id'])]
+
+def bump(location):
+	"""Moves a block to a new generation, after its student state was
+	written.
+
+	Keyword arguments:
+	location: the usage key of the block.
+	"""
+	cache = grading_cache()
+	if cache is not None:
+		cache.set(_generation_key(unicode(location)), uuid.uuid4().hex, None)
+
+def current_generation(location):
+	"""Returns the generation of a block, starting a new one if the cache
+	holds none.
+
+	Keyword arguments:
+	location: the usage key of the block, as unicode.
+	"""
+	cache = grading_cache()
+	key = _generation_key(location)
+	generation = cache.get(key)
+	if generation is None:
+		cache.add(key, uuid.uuid4().hex, None)
+		generation = cache.get(key)
+	return generation
+
+def grading_cache():
+	"""Returns the cache of grading tables, or None if it is disabled."""
+	name = get_setting('GRADING_CACHE')
+	if name is None:
+		return None
+	if name == 'local':
+		return _local_cache
+	return caches[name]
+
+def _refresh(loader, modules, entry):
+	"""Returns the rows of a block keyed by module id, reusing the rows of
+	a cached table for modules whose modification time and state are
+	unchanged since.
+	"""
+	cached = entry['rows'] if entry is not None else dict()
+	rows = dict()
+	stale = []
+	for module_id, modified, state, username, fullname in modules.values_list(
+			'id', 'modified', 'state', 'student__username', 'student__profile__name'):
+		key = str(module_id)
+		if key in cached and cached[key][0] == _version(modified, state):
+			rows[key] = cached[key]
+			rows[key][1].update(username=username, fullname=fullname)
+		else:
+			stale.append(module_id)
+
+	chunk_size = get_setting('GRADING_CHUNK_SIZE')
+	for i in range(0, len(stale), chunk_size):
+		for module in modules.filter(id__in=stale[i:i + chunk_size]):
+			rows[str(module.id)] = [
+				_version(module.modified, module.state),
+				loader.module_row(module)
+			]
+	return rows
+
+def _settled(entry):
+	"""Returns whether a write made since a table was built would have
+	moved its summary: the table was built in a later second than the
+	latest modification.
+	"""
+	summary = entry['summary']
+	if summary is None or summary[1] is None:
+		return True
+	return entry.get('built', '')[:19] > summary[1][:19]
+
+def _version(modified, state):
+	"""Returns what a cached row is checked against: the modification
+	time and a digest of the state of its student module.
+	"""
+	if isinstance(state, unicode):
+		state = state.encode('utf-8')
+	return (_timestamp(modified) or '') + ' ' + hashlib.sha1(state or '').hexdigest()
+
+def _dump(entry):
+	return zlib.compress(json.dumps(entry))
+
+def _load(data):
+	if data is None:
+		return None
+	try:
+		return json.loads(zlib.decompress(data))
+	except (ValueError, zlib.error):
+		log.warning("Discarding unreadable grading cache entry.")
+		return None
+
+def _timestamp(modified):
+	return modified.isoformat() if modified is not None else None
+
+def _generation_key(location):
+	return 'edx_mfu.grading.generation.' + location
+
+def _table_key(location):
+	return 'edx_mfu.grading.table.' + location
@@ -0,0 +1,336 @@
+"""
+Measures the handlers of the block: the wall time of each call, the
+database queries it ran and the calls it made to the file storage, with
+the bytes saved and read and the time spent in storage.  Measurements are
+handed to the sinks named by the INSTRUMENTATION setting:
+
+	'log':       a log line per call.
+	'statsd':    StatsD metrics sent over UDP to STATSD_ADDRESS, each
+	             named STATSD_PREFIX.handler.<handler>.<metric>.
+	'histogram': histograms kept in the process, see histograms().
+
+or the dotted path of a callable taking a Measurement.  With no sinks,
+the default, a handler call costs one settings lookup.
+
+Storage is measured by wrapping the methods of the class of
+default_storage once, on the first measured call.  Only the reads made
+while the handler runs are counted, not those of a response streamed
+after it returns.
+"""
+import bisect
+import collections
+import contextlib
+import functools
+import logging
+import socket
+import threading
+import time
+
+from django.core.files.storage import default_storage
+from django.db import connection
+from django.utils.functional import empty
+
+import background
+from config import get_setting
+
+log = logging.getLogger(__name__)
+
+#storage methods measured, and the metric each is counted under.
+STORAGE_METHODS = ('open', 'save', 'delete', 'exists', 'size', 'listdir')
+
+#upper bounds of the histogram buckets.
+BUCKETS = [2 ** i for i in range(-4, 41)]
+
+_local = threading.local()
+_histograms = dict()
+_histograms_lock = threading.Lock()
+_install_lock = threading.Lock()
+_installed = []
+_socket = []
+
+class Measurement(object):
+	"""
+	What a handler call did.  Times are in milliseconds.
+	"""
+	def __init__(self, handler):
+		self.handler = handler
+		self.wall_time = 0.0
+		self.queries = 0
+		self.query_time = 0.0
+		self.storage_calls = collections.Counter()
+		self.storage_bytes = 0
+		self.storage_time = 0.0
+		self.error = False
+		#set while a storage method runs, so the methods it calls itself
+		#are not counted again.
+		self.in_storage = False
+
+	def metrics(self):
+		"""Returns (name, value) for each metric of the call."""
+		metrics = [
+			('time', self.wall_time),
+			('queries', self.queries),
+			('query_time', self.query_time),
+			('storage_calls', sum(self.storage_calls.values())),
+			('storage_bytes', self.storage_bytes),
+			('storage_time', self.storage_time),
+		]
+		for method, calls in sorted(self.storage_calls.items()):
+			metrics.append(('storage.' + method, calls))
+		return metrics
+
+class Histogram(object):
+	"""
+	The distribution of a metric, in buckets with power of two bounds.
+	"""
+	def __init__(self):
+		self.buckets = [0] * (len(BUCKETS) + 1)
+		self.count = 0
+		self.total = 0.0
+		self.min = None
+		self.max = None
+
+	def record(self, value):
+		self.buckets[bisect.bisect_left(BUCKETS, value)] += 1
+		self.count += 1
+		self.total += value
+		self.min = value if self.min is None else min(self.min, value)
+		self.max = value if self.max is None else max(self.max, value)
+
+	def mean(self):
+		return self.total / self.count if self.count else None
+
+	def percentile(self, percent):
+		"""Returns the upper bound of the bucket holding a percentile, or
+		the largest value if that is lower.
+
+		Keyword arguments:
+		percent: the percentile, 0 to 100.
+		"""
+		if not self.count:
+			return None
+		rank = percent / 100.0 * self.count
+		seen = 0
+		for i, count in enumerate(self.buckets):
+			seen += count
+			if count and seen >= rank:
+				return min(BUCKETS[i], self.max) if i < len(BUCKETS) else self.max
+		return self.max
+
+def instrumented(cls):
+	"""Class decorator measuring every XBlock handler of a class,
+	including those of its mixins.
+	"""
+	for name in dir(cls):
+		func = getattr(getattr(cls, name, None), '__func__', None)
+		if getattr(func, '_is_xblock_handler', False):
+			setattr(cls, name, _measured(name, func))
+	return cls
+
+def histograms():
+	"""Returns the histograms of the 'histogram' sink, keyed by
+	handler.<handler>.<metric>.
+	"""
+	with _histograms_lock:
+		return dict(_histograms)
+
+def reset():
+	"""Empties the histograms of the 'histogram' sink."""
+	with _histograms_lock:
+		_histograms.clear()
+
+def meter_storage(storage_class):
+	"""Measures the calls made to a storage class.  Safe to call more than
+	once.
+
+	Keyword arguments:
+	storage_class: a Django Storage class.
+	"""
+	for method in STORAGE_METHODS:
+		func = getattr(getattr(storage_class, method, None), '__func__', None)
+		if func is not None and not getattr(func, '_edx_mfu_metered', False):
+			setattr(storage_class, method, _metered(method, func))
+
+def log_sink(measurement):
+	log.info(
+		"%s: %.1fms, %d queries in %.1fms, %d storage calls, %d bytes "
+		"in %.1fms%s",
+		measurement.handler,
+		measurement.wall_time,
+		measurement.queries,
+		measurement.query_time,
+		sum(measurement.storage_calls.values()),
+		measurement.storage_bytes,
+		measurement.storage_time,
+		' (failed)' if measurement.error else ''
+	)
+
+def statsd_sink(measurement):
+	prefix = get_setting('STATSD_PREFIX') + '.handler.' + \
+		measurement.handler + '.'
+	lines = []
+	for name, value in measurement.metrics():
+		kind = 'ms' if name.endswith('time') else 'c'
+		lines.append('%s%s:%g|%s' % (prefix, name, value, kind))
+	if measurement.error:
+		lines.append(prefix + 'errors:1|c')
+
+	host, port = get_setting('STATSD_ADDRESS').rsplit(':', 1)
+	try:
+		_statsd_socket().sendto('\n'.join(lines), (host, int(port)))
+	except socket.error:
+		log.debug("Could not send metrics to StatsD.", exc_info=True)
+
+def histogram_sink(measurement):
+	prefix = 'handler.' + measurement.handler + '.'
+	with _histograms_lock:
+		for name, value in measurement.metrics():
+			histogram = _histograms.get(prefix + name)
+			if histogram is None:
+				histogram = _histograms[prefix + name] = Histogram()
+			histogram.record(value)
+
+SINKS = {
+	'log': log_sink,
+	'statsd': statsd_sink,
+	'histogram': histogram_sink,
+}
+
+def _measured(name, func):
+	"""Wraps a handler to measure its calls when there are sinks."""
+	@functools.wraps(func)
+	def measured(self, *args, **kwargs):
+		sinks = get_setting('INSTRUMENTATION')
+		if not sinks or getattr(_local, 'measurement', None) is not None:
+			return func(self, *args, **kwargs)
+
+		_install()
+		measurement = Measurement(name)
+		_local.measurement = measurement
+		start = time.time()
+		try:
+			with _counted_queries(measurement):
+				return func(self, *args, **kwargs)
+		except Exception:
+			measurement.error = True
+			raise
+		finally:
+			measurement.wall_time = (time.time() - start) * 1000
+			_local.measurement = None
+			_emit(sinks, measurement)
+	return measured
+
+@contextlib.contextmanager
+def _counted_queries(measurement):
+	"""Counts the queries run in the block, and their time, into a
+	measurement.
+	"""
+	execute_wrapper = getattr(connection, 'execute_wrapper', None)
+	if execute_wrapper is not None:
+		def count(execute, sql, params, many, context):
+			start = time.time()
+			try:
+				return execute(sql, params, many, context)
+			finally:
+				measurement.queries += 1
+				measurement.query_time += (time.time() - start) * 1000
+		with execute_wrapper(count):
+			yield
+		return
+
+	#before Django 2.0 the debug cursor logs the queries.  The log of the
+	#connection is bounded, so the call gets a log of its own, added to
+	#the connection's afterwards.
+	queries_log = connection.queries_log
+	debug_cursor = connection.force_debug_cursor
+	connection.queries_log = collections.deque()
+	connection.force_debug_cursor = True
+	try:
+		yield
+	finally:
+		queries = connection.queries_log
+		connection.queries_log = queries_log
+		connection.force_debug_cursor = debug_cursor
+		queries_log.extend(queries)
+		measurement.queries = len(queries)
+		measurement.query_time = sum(
+			float(query['time']) for query in queries) * 1000
+
+def _metered(method, func):
+	"""Wraps a storage method to count its calls in the running
+	measurement.
+	"""
+	@functools.wraps(func)
+	def metered(storage, *args, **kwargs):
+		measurement = getattr(_local, 'measurement', None)
+		if measurement is None or measurement.in_storage:
+			return func(storage, *args, **kwargs)
+
+		measurement.in_storage = True
+		start = time.time()
+		try:
+			result = func(storage, *args, **kwargs)
+		finally:
+			measurement.in_storage = False
+			measurement.storage_time += (time.time() - start) * 1000
+			measurement.storage_calls[method] += 1
+
+		if method == 'save':
+			content = args[1] if len(args) > 1 else kwargs.get('content')
+			measurement.storage_bytes += getattr(content, 'size', None) or 0
+		elif method == 'open':
+			result = _MeteredFile(result, measurement)
+		return result
+	metered._edx_mfu_metered = True
+	return metered
+
+class _MeteredFile(object):
+	"""
+	A file opened from storage, counting the bytes read from it.
+	"""
+	def __init__(self, afile, measurement):
+		self._file = afile
+		self._measurement = measurement
+
+	def read(self, *args):
+		start = time.time()
+		data = self._file.read(*args)
+		self._measurement.storage_time += (time.time() - start) * 1000
+		self._measurement.storage_bytes += len(data)
+		return data
+
+	def __iter__(self):
+		return iter(self._file)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self._file.close()
+
+	def __getattr__(self, name):
+		return getattr(self._file, name)
+
+def _install():
+	"""Measures default_storage, once per process."""
+	if _installed:
+		return
+	with _install_lock:
+		if not _installed:
+			if default_storage._wrapped is empty:
+				default_storage._setup()
+			meter_storage(type(default_storage._wrapped))
+			_installed.append(True)
+
+def _emit(sinks, measurement):
+	for sink in sinks:
+		try:
+			(SINKS.get(sink) or background.resolve(sink))(measurement)
+		except Exception:
+			#measuring must never fail the handler.
+			log.warning("Instrumentation sink %s failed.", sink, exc_info=True)
+
+def _statsd_socket():
+	if not _socket:
+		_socket.append(socket.socket(socket.AF_INET, socket.SOCK_DGRAM))
+	return _socket[0]
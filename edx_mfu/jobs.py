@@ -0,0 +1,242 @@
+"""
+Long running staff operations.  A job is recorded in the database and
+run in the background (see background.enqueue).  After each chunk of
+students it saves its progress and a checkpoint, so staff can poll it
+and cancel it, and a job interrupted by a worker restart carries on from
+its checkpoint when it is run again.  Jobs that stop reporting progress
+for JOB_STALE_AFTER seconds are queued again when they are polled, or by
+resume_stale_jobs.
+"""
+import datetime
+import hashlib
+import logging
+import pytz
+import time
+import uuid
+
+from django.core.cache import cache
+from django.db.models import F, Q
+
+import webob.exc as ExceptionResponse
+
+from opaque_keys.edx.keys import CourseKey, UsageKey
+
+import background
+from bulk import BulkStateChange
+from config import get_setting
+from models import Job
+
+log = logging.getLogger(__name__)
+
+#the fields set by each kind of job, and the file lists it deletes.
+JOB_KINDS = {
+	'reopen_all': (
+		dict(is_submitted=False),
+		()
+	),
+	'remove_all': (
+		dict(
+			is_submitted=False,
+			score=None,
+			comment='',
+			score_published=False,
+			score_approved=False,
+			uploaded_files=dict(),
+			annotated_files=dict()
+		),
+		('uploaded_files', 'annotated_files')
+	),
+}
+
+ACTIVE = (Job.QUEUED, Job.RUNNING)
+
+#seconds the submit lock is held, should its request die.
+SUBMIT_LOCK_TIMEOUT = 30
+#times, and seconds between them, a submit waits for the lock.
+SUBMIT_ATTEMPTS = 20
+SUBMIT_WAIT = 0.1
+
+class JobCancelled(Exception):
+	"""Raised in a worker when its job was cancelled or taken over."""
+
+def submit(block, kind):
+	"""Queues a job for every student of a block and returns it.  If a
+	job of the same kind is already queued or running for the block, it
+	is returned instead.  Requests submitting the same job at once are
+	serialized with a lock in the Django cache.
+
+	Keyword arguments:
+	block: the block whose students are changed.
+	kind:  one of JOB_KINDS.
+	"""
+	location = unicode(block.location)
+	key = _submit_key(location, kind)
+	for attempt in range(SUBMIT_ATTEMPTS):
+		job = _active_job(location, kind)
+		if job is not None:
+			return job
+		if cache.add(key, True, SUBMIT_LOCK_TIMEOUT):
+			break
+		#another request is creating the job.
+		time.sleep(SUBMIT_WAIT)
+	else:
+		raise ExceptionResponse.HTTPConflict(
+			detail="A job is being started",
+			comment="Another request is starting this job, try again.")
+
+	try:
+		job = _active_job(location, kind)
+		if job is None:
+			job = Job.objects.create(
+				job_id=uuid.uuid4().hex,
+				kind=kind,
+				course_id=unicode(block.xmodule_runtime.course_id),
+				location=location,
+				modified=_now()
+			)
+			background.enqueue('edx_mfu.jobs.run_job', job.job_id)
+	finally:
+		cache.delete(key)
+	return job
+
+def get_job(block, job_id):
+	"""Returns a job of a block, or None.
+
+	Keyword arguments:
+	block:  the block the job belongs to.
+	job_id: the id of the job.
+	"""
+	return Job.objects.filter(
+		location=unicode(block.location),
+		job_id=job_id
+	).first()
+
+def cancel(job):
+	"""Cancels a job.  A running job stops after its current chunk.
+
+	Keyword arguments:
+	job: the job to cancel.
+	"""
+	Job.objects.filter(pk=job.pk, status__in=ACTIVE).update(
+		status=Job.CANCELLED,
+		modified=_now()
+	)
+	job.refresh_from_db()
+
+def is_stale(job):
+	"""Returns True if an unfinished job has stopped reporting progress."""
+	return job.status in ACTIVE and job.modified < _stale_before()
+
+def resume(job):
+	"""Queues a stale job again.
+
+	Keyword arguments:
+	job: the job to resume.
+	"""
+	log.warning("Resuming job %s from %d.", job.job_id, job.checkpoint)
+	background.enqueue('edx_mfu.jobs.run_job', job.job_id)
+
+def resume_stale_jobs():
+	"""Queues every stale job again.  May be run periodically."""
+	stale = Job.objects.filter(status__in=ACTIVE, modified__lt=_stale_before())
+	for job in stale:
+		resume(job)
+
+def job_status(job):
+	"""Returns the progress of a job for display to staff.
+
+	Keyword arguments:
+	job: the job.
+	"""
+	return {
+		'job_id':   job.job_id,
+		'kind':     job.kind,
+		'status':   job.status,
+		'progress': job.progress,
+		'total':    job.total,
+		'message':  job.message,
+		'created':  job.created.isoformat(),
+	}
+
+def run_job(job_id):
+	"""Runs a job from its checkpoint.  Does nothing if the job is
+	finished, or running elsewhere and not stale.  Failed attempts are
+	raised so the task is retried, until TASK_MAX_RETRIES is passed.
+
+	Keyword arguments:
+	job_id: the id of the job.
+	"""
+	claimed = Job.objects.filter(job_id=job_id).filter(
+		Q(status=Job.QUEUED) |
+		Q(status=Job.RUNNING, modified__lt=_stale_before())
+	).update(
+		status=Job.RUNNING,
+		attempts=F('attempts') + 1,
+		modified=_now()
+	)
+	if not claimed:
+		return
+	job = Job.objects.get(job_id=job_id)
+
+	fields, remove_files = JOB_KINDS[job.kind]
+	change = BulkStateChange(
+		CourseKey.from_string(job.course_id),
+		UsageKey.from_string(job.location)
+	)
+
+	def progress(last_id, count):
+		job.progress += count
+		updated = Job.objects.filter(
+			pk=job.pk,
+			status=Job.RUNNING,
+			attempts=job.attempts
+		).update(
+			progress=job.progress,
+			checkpoint=last_id,
+			modified=_now()
+		)
+		if not updated:
+			raise JobCancelled()
+
+	try:
+		if job.total is None:
+			job.total = change.modules().count()
+			Job.objects.filter(pk=job.pk).update(total=job.total)
+		change.run(fields, remove_files, job.checkpoint, progress)
+	except JobCancelled:
+		log.info("Job %s was cancelled.", job_id)
+		return
+	except Exception as e:
+		if job.attempts > get_setting('TASK_MAX_RETRIES'):
+			status = Job.FAILED
+		else:
+			status = Job.QUEUED
+		Job.objects.filter(pk=job.pk, status=Job.RUNNING).update(
+			status=status,
+			message=unicode(e),
+			modified=_now()
+		)
+		raise
+
+	Job.objects.filter(pk=job.pk, status=Job.RUNNING).update(
+		status=Job.SUCCEEDED,
+		message='',
+		modified=_now()
+	)
+
+def _active_job(location, kind):
+	return Job.objects.filter(
+		location=location,
+		kind=kind,
+		status__in=ACTIVE
+	).first()
+
+def _submit_key(location, kind):
+	return 'edx_mfu.jobs.submit.' + kind + '.' + \
+		hashlib.sha1(location.encode('utf-8')).hexdigest()
+
+def _stale_before():
+	return _now() - datetime.timedelta(seconds=get_setting('JOB_STALE_AFTER'))
+
+def _now():
+	return datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
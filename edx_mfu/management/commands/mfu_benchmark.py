@@ -0,0 +1,97 @@
+"""
+Runs the benchmark of the block on a synthetic course, see
+edx_mfu.benchmark.  The course is built in a test database created for
+the run, so the command refuses to run under settings other than test
+settings.
+"""
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from edx_mfu import benchmark
+
+class Command(BaseCommand):
+	help = "Times the block's handlers on a synthetic course, as JSON."
+
+	def add_arguments(self, parser):
+		parser.add_argument('--students', type=int,
+			default=benchmark.STUDENTS)
+		parser.add_argument('--files', type=int,
+			default=benchmark.FILES, help='Files per student.')
+		parser.add_argument('--file-size', type=int,
+			default=benchmark.FILE_SIZE, help='Bytes per file.')
+		parser.add_argument('--repeat', type=int,
+			default=benchmark.REPEAT, help='Timed runs of each scenario.')
+		parser.add_argument('--warmup', type=int,
+			default=benchmark.WARMUP, help='Runs before timing.')
+		parser.add_argument('--scenario', action='append', dest='scenarios',
+			choices=list(benchmark.SCENARIOS),
+			help='Runs only this scenario; may be repeated.')
+		parser.add_argument('--output',
+			help='Writes the results to this file.')
+		parser.add_argument('--baseline',
+			help='Compares the results with those in this file.')
+		parser.add_argument('--noinput', action='store_false',
+			dest='interactive', default=True,
+			help='Replaces a test database left behind without asking.')
+		parser.add_argument('--threshold', type=float,
+			default=benchmark.THRESHOLD,
+			help='Change in median time, as a share, counted as slower.')
+
+	def handle(self, *args, **options):
+		if not is_test_settings(settings.SETTINGS_MODULE):
+			raise CommandError(
+				'mfu_benchmark creates and destroys a test database; run it '
+				'with test settings, e.g. --settings=test.')
+
+		baseline = None
+		if options['baseline']:
+			with open(options['baseline']) as f:
+				baseline = json.load(f)
+
+		#a test database left behind is only replaced if the user agrees.
+		database = connection.creation.create_test_db(
+			verbosity=0, autoclobber=not options['interactive'])
+		try:
+			results = benchmark.run_suite(
+				students =  options['students'],
+				files =     options['files'],
+				file_size = options['file_size'],
+				scenarios = options['scenarios'],
+				repeat =    options['repeat'],
+				warmup =    options['warmup']
+			)
+		finally:
+			connection.creation.destroy_test_db(database, verbosity=0)
+
+		if baseline is not None:
+			if baseline.get('parameters') != results['parameters']:
+				self.stderr.write(
+					'The baseline was run with other parameters: ' +
+					json.dumps(baseline.get('parameters')))
+			results['comparison'] = benchmark.compare(
+				results, baseline, options['threshold'])
+
+		output = json.dumps(results, indent=2)
+		if options['output']:
+			with open(options['output'], 'w') as f:
+				f.write(output + '\n')
+		else:
+			self.stdout.write(output)
+
+		slower = [name for name, change in
+			results.get('comparison', {}).items()
+			if change['verdict'] == 'slower']
+		if slower:
+			raise CommandError('Slower than the baseline: ' + ', '.join(slower))
+
+def is_test_settings(module):
+	"""Returns True for a settings module named test, e.g. lms.envs.test
+	or cms.envs.test_static_optimized.
+
+	Keyword arguments:
+	module: the dotted name of the settings module.
+	"""
+	return bool(module) and module.rsplit('.', 1)[-1].startswith('test')
@@ -8,18 +8,29 @@ import json
 import logging
 import mimetypes
 import os
-import pkg_resources
 import pytz
 
 from file_management_mixin import FileMetaData, FileManagementMixin, get_file_metadata
 from file_submission_mixin import FileSubmissionMixin
 from file_annotation_mixin import FileAnnotationMixin
+from grade_import import GradeImport, parse_grades
+from grading import GradingDataLoader
+from unit_of_work import StudentStateUnitOfWork, unit_of_work
+from config import get_setting
+import assets
+import background
+import grade_publishing
+import grading_cache
+import instrumentation
+import resources
+import jobs
+import zip_cache
 
 from courseware.models import StudentModule
 
 from django.core.files import File
 #from django.core.files.storage import default_storage
-from django.template import Context, Template
+from django.template import Context
 
 from webob.response import Response
 import webob.exc as ExceptionResponse
@@ -33,6 +44,7 @@ from xmodule.util.duedate import get_extended_due_date
 log = logging.getLogger(__name__)
 
 #test
+@instrumentation.instrumented
 class MultipleFileUploadXBlock(
 	XBlock, 
 	FileManagementMixin, 
@@ -45,6 +57,9 @@ class MultipleFileUploadXBlock(
 	has_score = True
 	icon_class = 'problem'
 
+	#the StudentStateUnitOfWork of the running staff handler.
+	_unit_of_work = None
+
 	display_name = String(
 		default='Multiple File Upload Assignment', scope=Scope.settings,
 		help="This name appears in the horizontal navigation at the top of "
@@ -120,17 +135,6 @@ class MultipleFileUploadXBlock(
 		The primary view of the MultipleFileUploadXBlock, shown to students
 		when viewing courses.
 		"""
-		# Ideally we would do this when the score is entered.  This write on
-		# read pattern is pretty bad.  Currently, though, the code in the
-		# courseware application that handles the grade event will puke if the
-		# user_id for the event is other than the logged in user.
-		if not self.score_published and self.score_approved:
-			self.runtime.publish(self, 'grade', {
-				'value': self.score,
-				'max_value': self.max_score(),
-			})
-			self.score_published = True
-
 		context = {
 			"student_state": json.dumps(self.student_state()),
 			"id": self.location.name.replace('.', '_')
@@ -146,8 +150,8 @@ class MultipleFileUploadXBlock(
 				context
 			)
 		)
-		fragment.add_css(_resource("static/css/edx_mfu.css"))
-		fragment.add_javascript(_resource("static/js/src/edx_mfu.js"))
+		_add_bundle(fragment, 'edx_mfu.css')
+		_add_bundle(fragment, 'edx_mfu.js')
 		#Fragment.add_javascript(_resource("static/js/vendor/date.js"))
 		fragment.add_javascript_url("/static/js/vendor/date.js")		
 		fragment.initialize_js('MultipleFileUploadXBlock')
@@ -205,66 +209,16 @@ class MultipleFileUploadXBlock(
 		Gathers data for display to staff using the Grade Submission
 		button on the lms page.
 		"""
-		def get_student_data(module):
-			"""
-			Packages data from a student module for display to staff.
-			"""
-			state = json.loads(module.state)
-			instructor = self.is_instructor()
-			score = state.get('score')
-			approved = state.get('score_approved')
-			submitted = state.get('is_submitted')
-			submission_time = state.get('submission_time')
-
-			#can a grade be entered
-			due = get_extended_due_date(self)
-			may_grade = (instructor or not approved) 
-			if due is not None:
-				may_grade = may_grade and (submitted or (due < _now())) 
-
-			uploaded = []
-			if (state.get('is_submitted')):
-				for sha1, metadata in get_file_metadata(state.get("uploaded_files")).iteritems():
-					uploaded.append({
-						"sha1":      sha1, 
-						"filename":  metadata.filename,
-						"timestamp": metadata.timestamp
-					})
-
-			annotated = []
-			for sha1, metadata in get_file_metadata(state.get("annotated_files")).iteritems():
-				annotated.append({
-					"sha1":      sha1, 
-					"filename":  metadata.filename,
-					"timestamp": metadata.timestamp
-				})
-
-			return {
-				'module_id':       module.id,
-				'username':        module.student.username,
-				'fullname':        module.student.profile.name,
-				'uploaded':        uploaded,
-				'annotated':       annotated,
-				'timestamp':       state.get("uploaded_files_last_timestamp"),
-				'published':       state.get("score_published"),
-				'score':           score,
-				'approved':        approved,
-				'needs_approval':  instructor and score is not None
-								   and not approved,
-				'may_grade':       may_grade,
-				'comment':         state.get("comment", ''),
-
-				'submitted':       submitted,
-				'submission_time': submission_time
-			}
+		self.flush_student_state()
+		rows = grading_cache.cached_rows(GradingDataLoader(self))
 
-		query = StudentModule.objects.filter(
-			course_id=self.xmodule_runtime.course_id,
-			module_state_key=self.location
-		)
+		#picks up grades approved before publishing was queued.
+		if any(row['approved'] and not row['published'] and
+				row['score'] is not None for row in rows):
+			self.schedule_grade_publishing()
 
 		return {
-			'assignments': [get_student_data(module) for module in query],
+			'assignments': rows,
 			'max_score': self.max_score(),
 		}
 
@@ -292,7 +246,7 @@ class MultipleFileUploadXBlock(
 					context
 				)
 			)
-			fragment.add_javascript(_resource("static/js/src/studio.js"))
+			_add_bundle(fragment, 'studio.js')
 			fragment.initialize_js('MultipleFileUploadXBlock')
 			return fragment
 		except:  # pragma: NO COVER
@@ -307,12 +261,64 @@ class MultipleFileUploadXBlock(
 
 	@XBlock.handler
 	def get_staff_grading_data(self, request, suffix=''):
+		"""Returns the grading data of every student.  With stream=1 the
+		JSON is streamed as it is produced from the database, a chunk of
+		students at a time, so memory stays flat for large courses.
+		"""
 		#assert self.is_course_staff()
 		if not self.is_course_staff():
 			return Response(status=403)
+
+		if request is not None and request.params.get('stream') in ('1', 'true'):
+			return Response(
+				app_iter =     GradingDataLoader(self).iter_json(
+					self.max_score(), get_setting('GRADING_CHUNK_SIZE')),
+				content_type = 'application/json'
+			)
 		return Response(json_body=self.staff_grading_data())
 
 	@XBlock.handler
+	def get_staff_grading_page(self, request, suffix=''):
+		"""Returns one page of the grading table, for large courses.
+
+		Keyword arguments:
+		request: may hold page or cursor, page_size, sort (username,
+		         submission_time or score, prefixed with - to reverse)
+		         and filter, repeated for each of submitted,
+		         needs_approval and ungraded.
+		suffix:  not used.
+		"""
+		if not self.is_course_staff():
+			return Response(status=403)
+
+		data = GradingDataLoader(self).page(
+			page =      request.params.get('page', 1),
+			page_size = request.params.get('page_size', 50),
+			sort =      request.params.get('sort', 'username'),
+			filters =   request.params.getall('filter'),
+			cursor =    request.params.get('cursor')
+		)
+		data['max_score'] = self.max_score()
+		return Response(json_body=data)
+
+	@XBlock.handler
+	def get_staff_grading_changes(self, request, suffix=''):
+		"""Returns the rows of the grading table which changed since the
+		last call, so the table can be patched instead of reloaded.
+
+		Keyword arguments:
+		request: may hold since, the watermark returned by the last call.
+		suffix:  not used.
+		"""
+		if not self.is_course_staff():
+			return Response(status=403)
+
+		data = GradingDataLoader(self).changes(request.params.get('since'))
+		data['max_score'] = self.max_score()
+		return Response(json_body=data)
+
+	@XBlock.handler
+	@unit_of_work
 	def staff_enter_grade(self, request, suffix=''):
 		if not self.is_course_staff():
 			return Response(status=403)
@@ -327,6 +333,7 @@ class MultipleFileUploadXBlock(
 		#return Response(json_body=self.staff_grading_data())
 
 	@XBlock.handler
+	@unit_of_work
 	def staff_remove_grade(self, request, suffix=''):
 		if not self.is_course_staff():
 			return Response(status=403)
@@ -334,15 +341,104 @@ class MultipleFileUploadXBlock(
 		
 		return Response(json_body=self.staff_grading_data())
 
+	@XBlock.handler
+	def staff_import_grades(self, request, suffix=''):
+		"""Enters a batch of grades, as CSV with username, score and
+		comment columns or as a JSON list of objects with those keys.
+		Nothing is entered unless every row is valid.
+
+		Keyword arguments:
+		request: the batch as the body, or as an uploaded file named
+		         grades.
+		suffix:  not used.
+		"""
+		if not self.is_course_staff():
+			return Response(status=403)
+
+		upload = request.params.get('grades')
+		if getattr(upload, 'file', None) is not None:
+			body = upload.file.read()
+			content_type = getattr(upload, 'type', None)
+		else:
+			body = request.body
+			content_type = request.content_type
+
+		try:
+			entries = parse_grades(body, content_type)
+		except ValueError as e:
+			raise ExceptionResponse.HTTPBadRequest(
+				detail='Could not read grades.',
+				comment=str(e)
+				)
+
+		imported, errors = GradeImport(self).run(entries)
+		if errors:
+			return Response(status=400, json_body={'errors': errors})
+		if imported and self.is_instructor():
+			self.schedule_grade_publishing()
+
+		return Response(json_body={'imported': imported})
+
+	@XBlock.handler
+	def staff_export_grades(self, request, suffix=''):
+		"""Returns the grading data as a CSV file, streamed a chunk of
+		students at a time.
+		"""
+		if not self.is_course_staff():
+			return Response(status=403)
+
+		return Response(
+			app_iter =            GradingDataLoader(self).iter_csv(
+				self.max_score(), get_setting('GRADING_CHUNK_SIZE')),
+			content_type =        'text/csv',
+			charset =             'utf-8',
+			content_disposition = 'attachment; filename=' +
+				self.location.name + '-grades.csv'
+		)
+
 	@XBlock.handler
 	def student_submit(self, request, suffix=''):
 		if not self.is_submitted:
 			self.is_submitted = True
 			self.submission_time = str(_now())
+			self.save_student_state()
+			self.prebuild_submission_zip()
 
 		return Response(status=204)
 
-	@XBlock.handler 
+	def prebuild_submission_zip(self):
+		"""Queues a background build of the submission's archive, so staff
+		downloads after the deadline are served from the zip cache.
+		"""
+		if not self.uploaded_files or zip_cache.cache_storage() is None or \
+				not get_setting('PREBUILD_SUBMISSION_ZIP'):
+			return
+		if get_setting('ZIP_CACHE') == 'local' and get_setting('TASK_BACKEND'):
+			#the task would fill the cache of another host.
+			return
+
+		try:
+			background.enqueue(
+				'edx_mfu.tasks.prebuild_zip',
+				self.location.to_deprecated_string(),
+				dict(self.uploaded_files)
+			)
+		except Exception:
+			#the archive is built on download instead.
+			log.warning("Could not queue archive build.", exc_info=True)
+
+	def schedule_grade_publishing(self):
+		"""Queues a run publishing the approved grades of the block.  A grade
+		the run could not be queued for stays approved, and is picked up by
+		the next schedule, at the latest when staff open the grading data.
+		"""
+		try:
+			grade_publishing.schedule(self)
+		except Exception:
+			log.warning("Could not queue grade publishing.", exc_info=True)
+
+	@XBlock.handler
+	@unit_of_work
 	def staff_reopen_submission(self, request, suffix=''):
 		#assert self.is_course_staff()
 		if not self.is_course_staff():
@@ -361,21 +457,11 @@ class MultipleFileUploadXBlock(
 		if not self.is_course_staff():
 			return Response(status=403)
 
-		query = StudentModule.objects.filter(
-			course_id=self.xmodule_runtime.course_id,
-			module_state_key=self.location
-		)
-
-		for module in query:
-			self.set_student_state(
-				module.id,
-				is_submitted = False
-			)   
-
-		return Response(status=204)
+		return self.start_job('reopen_all')
 		#return Response(json_body=self.staff_grading_data())       
 
 	@XBlock.handler
+	@unit_of_work
 	def staff_remove_submission(self, request, suffix=''):
 		if not self.is_course_staff():
 			return Response(status=403)
@@ -390,16 +476,54 @@ class MultipleFileUploadXBlock(
 		if not self.is_course_staff():
 			return Response(status=403)
 
-		query = StudentModule.objects.filter(
-			course_id=self.xmodule_runtime.course_id,
-			module_state_key=self.location
-		)
+		return self.start_job('remove_all')
+		#return Response(json_body=self.staff_grading_data())
+
+	@XBlock.handler
+	def staff_job_status(self, request, suffix=''):
+		"""Returns the progress of a job.
 
-		for module in query:
-			self.remove_submission(module.id)
+		Keyword arguments:
+		request: not used.
+		suffix:  the id of the job.
+		"""
+		if not self.is_course_staff():
+			return Response(status=403)
 
-		return Response(status=204)
-		#return Response(json_body=self.staff_grading_data())
+		job = jobs.get_job(self, suffix)
+		if job is None:
+			raise ExceptionResponse.HTTPNotFound(detail='No such job.')
+		if jobs.is_stale(job):
+			jobs.resume(job)
+
+		return Response(json_body=jobs.job_status(job))
+
+	@XBlock.handler
+	def staff_cancel_job(self, request, suffix=''):
+		"""Cancels a job.
+
+		Keyword arguments:
+		request: not used.
+		suffix:  the id of the job.
+		"""
+		if not self.is_course_staff():
+			return Response(status=403)
+
+		job = jobs.get_job(self, suffix)
+		if job is None:
+			raise ExceptionResponse.HTTPNotFound(detail='No such job.')
+		jobs.cancel(job)
+
+		return Response(json_body=jobs.job_status(job))
+
+	def start_job(self, kind):
+		"""Queues a job for every student and returns its progress.
+
+		Keyword arguments:
+		kind: one of jobs.JOB_KINDS.
+		"""
+		job = jobs.submit(self, kind)
+		return Response(status=202, json_body=jobs.job_status(job))
 
 	def enter_grade(self, module_id, grade, comment=''):
 		"""Allows staff to enter a grade for a student.
@@ -413,6 +537,10 @@ class MultipleFileUploadXBlock(
 			score_published = False,
 			score_approved = self.is_instructor()
 		)
+		if self.is_instructor():
+			#the publisher must see the approved grade.
+			self.flush_student_state()
+			self.schedule_grade_publishing()
 
 	def remove_grade(self, module_id):
 		if not self.is_course_staff():
@@ -451,16 +579,30 @@ class MultipleFileUploadXBlock(
 
 	def set_student_state(self, module_id, **fields):
 		"""Helper used to allow staff to set arbitrary student fields.
+		Inside a unit of work the change is written when the handler
+		returns, otherwise it is written immediately.
 		"""
 		assert self.is_course_staff()
-		module = StudentModule.objects.get(pk=module_id)
-		state = json.loads(module.state)
+		if self._unit_of_work is not None:
+			self._unit_of_work.set(module_id, **fields)
+		else:
+			uow = StudentStateUnitOfWork()
+			uow.set(module_id, **fields)
+			uow.flush()
 
-		for key, value in fields.iteritems():
-			state[key] = value
+	def save_student_state(self):
+		"""Saves the fields of the current student now, rather than after
+		the handler returns, and moves the grading cache on to see them.
+		"""
+		self.save()
+		grading_cache.bump(self.location)
 
-		module.state = json.dumps(state)
-		module.save()
+	def flush_student_state(self):
+		"""Writes the changes of the current unit of work, if any, so
+		queries see them.
+		"""
+		if self._unit_of_work is not None:
+			self._unit_of_work.flush()
 
 	def past_due(self):
 		"""Returns True if the assignment is past due"""
@@ -480,6 +622,13 @@ class MultipleFileUploadXBlock(
 		"""
 		return not self.past_due() and not self.is_submitted
 
+	def validate_upload_allowed(self):
+		if not self.upload_allowed():
+			raise ExceptionResponse.HTTPForbidden(
+				detail='Uploads are closed.',
+				comment='the assignment is past due or was already submitted.'
+				)
+
 	def get_module(self, module_id):
 		"""Used for staff handlers that alter the fields of a student.
 		One user cannot access the fields of another user, even staff.
@@ -487,6 +636,8 @@ class MultipleFileUploadXBlock(
 		we must do so by grabbing the student module.
 		"""
 		assert self.is_course_staff()
+		if self._unit_of_work is not None:
+			return self._unit_of_work.module(module_id)
 		return StudentModule.objects.get(pk=module_id)
 
 	def get_student_state(self, module_id):
@@ -497,6 +648,8 @@ class MultipleFileUploadXBlock(
 		module_id: the id of the student module to retrive
 		"""
 		assert self.is_course_staff()
+		if self._unit_of_work is not None:
+			return self._unit_of_work.state(module_id)
 		module = StudentModule.objects.get(pk=module_id)
 		return json.loads(module.state)
 
@@ -525,8 +678,27 @@ class MultipleFileUploadXBlock(
 
 def _resource(path):  # pragma: NO COVER
 	"""Handy helper for getting resources from our kit."""
-	data = pkg_resources.resource_string(__name__, path)
-	return data.decode("utf8")
+	return resources.resource(path)
+
+
+def _add_bundle(fragment, name):
+	"""Adds a bundle of static files to a fragment: linked when it has
+	been built and is served, otherwise inline.
+	"""
+	url = assets.bundle_url(name)
+	css = name.endswith('.css')
+	if url is not None:
+		if css:
+			fragment.add_css_url(url)
+		else:
+			fragment.add_javascript_url(url)
+		return
+
+	for path in assets.BUNDLES[name]:
+		if css:
+			fragment.add_css(_resource(path))
+		else:
+			fragment.add_javascript(_resource(path))
 
 
 def _now():
@@ -537,14 +709,20 @@ def load_resource(resource_path):
 	"""
 	Gets the content of a resource
 	"""
-	resource_content = pkg_resources.resource_string(__name__, resource_path)
-	return unicode(resource_content)
+	return resources.resource(resource_path)
 
 
 def render_template(template_path, context={}):
 	"""
 	Evaluate a template by resource path, applying the provided context
 	"""
-	template_str = load_resource(template_path)
-	template = Template(template_str)
+	template = resources.template(template_path)
 	return template.render(Context(context))
+
+
+try:
+	if get_setting('WARM_RESOURCES'):
+		resources.warm()
+except Exception:  # pragma: NO COVER
+	#the views load resources on first use instead.
+	log.warning("Could not warm resources.", exc_info=True)
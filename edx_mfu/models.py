@@ -0,0 +1,44 @@
+"""
+Database models for the MFU XBlock.
+"""
+from django.db import models
+
+class FileBlob(models.Model):
+	"""
+	A content addressed file in storage.  refcount holds the number of
+	file lists (uploaded or annotated, across all students) referring to
+	the file.
+	"""
+	key = models.CharField(max_length=40, unique=True, db_index=True)
+	refcount = models.PositiveIntegerField(default=0)
+
+	class Meta:
+		app_label = 'edx_mfu'
+
+class Job(models.Model):
+	"""
+	A long running staff operation on every student of a block.  The
+	checkpoint holds the id of the last student module processed, so an
+	interrupted job carries on from there.  See jobs.py.
+	"""
+	QUEUED = 'queued'
+	RUNNING = 'running'
+	SUCCEEDED = 'succeeded'
+	FAILED = 'failed'
+	CANCELLED = 'cancelled'
+
+	job_id = models.CharField(max_length=32, unique=True, db_index=True)
+	kind = models.CharField(max_length=32)
+	course_id = models.CharField(max_length=255)
+	location = models.CharField(max_length=255, db_index=True)
+	status = models.CharField(max_length=16, default=QUEUED)
+	progress = models.PositiveIntegerField(default=0)
+	total = models.PositiveIntegerField(null=True)
+	checkpoint = models.PositiveIntegerField(default=0)
+	attempts = models.PositiveIntegerField(default=0)
+	message = models.TextField(blank=True, default='')
+	created = models.DateTimeField(auto_now_add=True)
+	modified = models.DateTimeField(db_index=True)
+
+	class Meta:
+		app_label = 'edx_mfu'
@@ -0,0 +1,37 @@
+"""
+Bounded, ordered parallel prefetching.  Used to overlap slow storage
+reads (e.g. from S3) while an archive is being streamed.
+"""
+from collections import deque
+
+def prefetch(tasks, pool, depth=8):
+	"""Runs callables on a pool of threads, yielding their results in the
+	order the callables were given.  At most depth results are pending or
+	held at any time, so memory stays bounded however many tasks there
+	are.  The pool may be shared: tasks still pending when the consumer
+	stops are left to finish on it.
+
+	Keyword arguments:
+	tasks: an iterable of callables taking no arguments.
+	pool:  the ThreadPool running the tasks, or None to run each task
+	       when its result is wanted.
+	depth: the number of tasks run ahead of the consumer.
+	"""
+	if pool is None:
+		for task in tasks:
+			yield task()
+		return
+
+	tasks = iter(tasks)
+	pending = deque()
+	for task in tasks:
+		pending.append(pool.apply_async(task))
+		if len(pending) >= depth:
+			break
+
+	while pending:
+		result = pending.popleft().get()
+		for task in tasks:
+			pending.append(pool.apply_async(task))
+			break
+		yield result
@@ -0,0 +1,91 @@
+"""
+A process wide cache of the resources packaged with the block: decoded
+static files and compiled templates are loaded on first use and kept, so
+rendering a view neither reads nor compiles anything.
+
+	RESOURCE_RELOAD: reload a resource when its file changes.  None, the
+	                 default, follows settings.DEBUG.
+	WARM_RESOURCES:  load VIEW_RESOURCES and VIEW_TEMPLATES when the
+	                 block is imported.
+"""
+import logging
+import os
+import pkg_resources
+import threading
+
+from django.conf import settings
+from django.template import Template
+
+from config import get_setting
+
+log = logging.getLogger(__name__)
+
+VIEW_RESOURCES = (
+	'static/css/edx_mfu.css',
+	'static/js/src/edx_mfu.js',
+	'static/js/src/studio.js',
+)
+
+VIEW_TEMPLATES = (
+	'templates/multiple_file_upload/show.html',
+	'templates/multiple_file_upload/edit.html',
+)
+
+_cache = dict()
+_lock = threading.Lock()
+
+def resource(path):
+	"""Returns a packaged file decoded as UTF-8.
+
+	Keyword arguments:
+	path: the path of the file in the package.
+	"""
+	return _cached('resource', path, _read)
+
+def template(path):
+	"""Returns a packaged Django template, compiled.
+
+	Keyword arguments:
+	path: the path of the template in the package.
+	"""
+	return _cached('template', path, lambda path: Template(_read(path)))
+
+def warm():
+	"""Loads the resources and templates of the views."""
+	for path in VIEW_RESOURCES:
+		resource(path)
+	for path in VIEW_TEMPLATES:
+		template(path)
+
+def clear():
+	"""Empties the cache."""
+	with _lock:
+		_cache.clear()
+
+def _cached(kind, path, load):
+	"""Returns a cached value, loading it on first use or, when reloading,
+	once its file has changed.
+	"""
+	if _reload():
+		mtime = os.path.getmtime(
+			pkg_resources.resource_filename(__name__, path))
+	else:
+		mtime = None
+
+	entry = _cache.get((kind, path))
+	if entry is not None and entry[0] == mtime:
+		return entry[1]
+
+	value = load(path)
+	with _lock:
+		_cache[(kind, path)] = (mtime, value)
+	return value
+
+def _reload():
+	reload = get_setting('RESOURCE_RELOAD')
+	if reload is None:
+		return getattr(settings, 'DEBUG', False)
+	return reload
+
+def _read(path):
+	return pkg_resources.resource_string(__name__, path).decode('utf8')
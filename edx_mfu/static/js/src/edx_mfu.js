@@ -11,6 +11,7 @@ function MultipleFileUploadXBlock(runtime, element)
 
         var staffDownloadUrl = runtime.handlerUrl(element, 'staff_download_file');
         var staffDownloadZippedUrl = runtime.handlerUrl(element, 'staff_download_zipped');
+        var staffDownloadAllZippedUrl = runtime.handlerUrl(element, 'staff_download_all_zipped');
 
         var annotatedUploadUrl = runtime.handlerUrl(element, 'staff_upload_annotated');
         var studentAnnotationDownloadUrl = runtime.handlerUrl(element, 'student_download_annotated');
@@ -28,6 +29,9 @@ function MultipleFileUploadXBlock(runtime, element)
         var removeSubmissionUrl = runtime.handlerUrl(element, 'staff_remove_submission')
         var reopenAllSubmissionsUrl = runtime.handlerUrl(element, 'staff_reopen_all_submissions');
         var removeAllSubmissionsUrl = runtime.handlerUrl(element, 'staff_remove_all_submissions');
+        var jobStatusUrl = runtime.handlerUrl(element, 'staff_job_status');
+        var importGradesUrl = runtime.handlerUrl(element, 'staff_import_grades');
+        var exportGradesUrl = runtime.handlerUrl(element, 'staff_export_grades');
 
         
         var template = _.template($(element).find("#mfu-tmpl").text());
@@ -90,6 +94,22 @@ function MultipleFileUploadXBlock(runtime, element)
             });
         }
 
+        //polls a background job until it finishes, then reloads the
+        //grading data if the job did not succeed.
+        function pollJob(job)
+        {
+            if (job.status == "queued" || job.status == "running") {
+                setTimeout(function() {
+                    $.get(jobStatusUrl + "/" + job.job_id).success(pollJob);
+                }, 2000);
+            } else if (job.status != "succeeded") {
+                $.ajax({
+                    url: getStaffGradingUrl,
+                    success: renderStaffGrading
+                });
+            }
+        }
+
         function renderStaffGrading(data) 
         {
             $(".grade-modal").hide();
@@ -99,7 +119,9 @@ function MultipleFileUploadXBlock(runtime, element)
 
             // Add download urls to template context
             data.downloadUrl = staffDownloadUrl;
-            data.downloadZippedUrl = staffDownloadZippedUrl;            //data.removeSubmissionUrl = removeSubmissionUrl;
+            data.downloadZippedUrl = staffDownloadZippedUrl;
+            data.downloadAllZippedUrl = staffDownloadAllZippedUrl;
+            data.exportGradesUrl = exportGradesUrl;            //data.removeSubmissionUrl = removeSubmissionUrl;
 
             // Render template
             $(element).find("#grade-info")
@@ -128,7 +150,8 @@ function MultipleFileUploadXBlock(runtime, element)
                 {
                     var url = removeAllSubmissionsUrl;
                     
-                    $.get(url).success(function() {
+                    $.get(url).success(function(job) {
+                        pollJob(job);
                         $.each(allStudentData.assignments, function(i, val) {
                             removeSubmission(val)
                         });
@@ -137,13 +160,40 @@ function MultipleFileUploadXBlock(runtime, element)
                     });
                 });
 
+            //enter the grades in a CSV or JSON file.
+            $(element).find(".import-grades-input")
+                .on("change", function()
+                {
+                    var form = new FormData();
+                    form.append("grades", this.files[0]);
+
+                    $.ajax({
+                        url: importGradesUrl,
+                        type: "POST",
+                        data: form,
+                        processData: false,
+                        contentType: false
+                    }).success(function() {
+                        $.ajax({
+                            url: getStaffGradingUrl,
+                            success: renderStaffGrading
+                        });
+                    }).error(function(xhr) {
+                        var errors = (xhr.responseJSON || {}).errors || [];
+                        alert($.map(errors, function(error) {
+                            return error.line + ": " + error.username + ": " + error.message;
+                        }).join("\n"));
+                    });
+                });
+
             //reopen all submissions for the asingment.
             $(element).find(".reopen-all-submissions-button")
                 .on("click", function()
                 {
                     var url = reopenAllSubmissionsUrl;
                     
-                    $.get(url).success(function() {
+                    $.get(url).success(function(job) {
+                        pollJob(job);
                         $.each(allStudentData.assignments, function(i, val) {
                             reopenSubmission(val);
                         });
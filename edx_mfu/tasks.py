@@ -0,0 +1,41 @@
+"""
+Background tasks for the MFU XBlock.  See background.enqueue.
+"""
+import logging
+
+import grade_publishing
+import file_management_mixin
+from file_management_mixin import build_cached_zip
+
+log = logging.getLogger(__name__)
+
+def prebuild_zip(location, manifest):
+	"""Builds the archive of a submitted file list into the zip cache, so
+	staff downloads are served from the cache.  Does nothing if the
+	archive is already cached.
+
+	Keyword arguments:
+	location: the location of the block owning the files.
+	manifest: the file list as it was when it was submitted.
+	"""
+	fingerprint = build_cached_zip(location, manifest)
+	log.info("Prebuilt archive %s for %s", fingerprint, location)
+
+def publish_grades(course_id, location):
+	"""Publishes the approved grades of a block.  See grade_publishing.
+
+	Keyword arguments:
+	course_id: the course key of the block.
+	location:  the usage key of the block.
+	"""
+	grade_publishing.publish_grades(course_id, location)
+
+def remove_stale_uploads(location):
+	"""Removes the expired resumable uploads of a block.  See
+	file_management_mixin.remove_stale_uploads.
+
+	Keyword arguments:
+	location: the location of the block.
+	"""
+	removed = file_management_mixin.remove_stale_uploads(location)
+	log.info("Removed %d stale uploads for %s", removed, location)
@@ -4,13 +4,41 @@ import mock
 import os
 import pkg_resources
 import pytz
+import shutil
+import socket
 import tempfile
+import time
 import unittest
+import webob.exc
+import webob.multidict
+
+from StringIO import StringIO
+from zipfile import ZipFile
 
 from courseware.models import StudentModule
 from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.base import ContentFile
 from django.core.files.storage import FileSystemStorage
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.test.utils import override_settings
+from django.utils.dateparse import parse_datetime
 from student.models import UserProfile
+from edx_mfu import (assets, background, benchmark, blob_store,
+    file_management_mixin, file_serving, grading_cache, instrumentation, jobs,
+    resources, unit_of_work, zip_cache)
+from edx_mfu.bulk import BulkStateChange
+from edx_mfu.file_management_mixin import compressed_members
+from edx_mfu.grade_publishing import publish_grades
+from edx_mfu.grading import GradingDataLoader
+from edx_mfu.jobs import run_job
+from edx_mfu.management.commands import mfu_benchmark
+from edx_mfu.models import FileBlob, Job
+from edx_mfu.zipstream import (ZIP_DEFLATED, ZIP_STORED, ZipMember,
+    compress_member, compression_for, stream_zip)
+from webob import Request
 from xblock.field_data import DictFieldData
 from opaque_keys.edx.locations import Location, SlashSeparatedCourseKey
 
@@ -46,12 +74,17 @@ class MultipleFileUploadXblockTests(unittest.TestCase):
         )
         self.runtime = mock.Mock(course_id=self.course_id)
         self.scope_ids = mock.Mock()
-        tmp = tempfile.mkdtemp()
-        patcher = mock.patch(
-            "edx_mfu.mfu.default_storage",
-            FileSystemStorage(tmp))
-        patcher.start()
-        self.addCleanup(patcher.stop)
+        self.storage = FileSystemStorage(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.storage.location)
+        for module in ('blob_store', 'bulk', 'file_annotation_mixin',
+                'file_management_mixin', 'file_serving', 'file_submission_mixin'):
+            patcher = mock.patch(
+                "edx_mfu.%s.default_storage" % module,
+                self.storage)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        cache.clear()
+        grading_cache.grading_cache().clear()
 
     def make_one(self, **kw):
         from edx_mfu.mfu import MultipleFileUploadXBlock as cls
@@ -128,12 +161,11 @@ class MultipleFileUploadXblockTests(unittest.TestCase):
 
     @mock.patch('edx_mfu.mfu._resource', DummyResource)
     @mock.patch('edx_mfu.mfu.Fragment')
-    def test_student_view_publish_grade(self, Fragment):
+    def test_student_view_does_not_publish_grade(self, Fragment):
         block = self.make_one(score=9, points=10, score_published=False)
         block.student_view()
-        self.runtime.publish.assert_called_once_with(block, 'grade', {
-            'value': 9, 'max_value': 10})
-        self.assertEqual(block.score_published, True)
+        self.assertFalse(self.runtime.publish.called)
+        self.assertEqual(block.score_published, False)
 
     @mock.patch('edx_mfu.mfu._resource', DummyResource)
     @mock.patch('edx_mfu.mfu.render_template')
@@ -294,3 +326,977 @@ class MultipleFileUploadXblockTests(unittest.TestCase):
         block = self.make_one()
         block.due = datetime.datetime(2010, 5, 12, 2, 42, tzinfo=pytz.utc)
         self.assertTrue(block.past_due())
+
+    def test_store_file_single_pass(self):
+        path = pkg_resources.resource_filename(__package__, 'tests.py')
+        expected = open(path, 'rb').read()
+        storage = self.storage
+        block = self.make_one()
+        filelist = {}
+        upload = DummyUpload(path, 'test.txt')
+        with mock.patch.object(upload, 'seek') as seek:
+            key, metadata = block.store_file(filelist, upload, 'test.txt')
+            self.assertFalse(seek.called)
+        stored = file_management_mixin._file_storage_path(
+            block.location.to_deprecated_string(), key, 'test.txt')
+        self.assertEqual(storage.open(stored).read(), expected)
+        self.assertEqual(filelist[key], metadata)
+        self.assertEqual(metadata.filename, 'test.txt')
+        self.assertEqual(metadata.mimetype, 'text/plain')
+
+    def test_content_addressed_storage(self):
+        path = pkg_resources.resource_filename(__package__, 'tests.py')
+        storage = self.storage
+        block = self.make_one()
+        fred, barney = {}, {}
+        with override_settings(EDX_MFU={'CONTENT_ADDRESSED_STORAGE': True}):
+            key, _ = block.store_file(fred, DummyUpload(path, 'a.txt'), 'a.txt')
+            key2, _ = block.store_file(barney, DummyUpload(path, 'b.txt'), 'b.txt')
+            block.store_file(barney, DummyUpload(path, 'b.txt'), 'b.txt')
+            self.assertEqual(key, key2)
+            self.assertEqual(FileBlob.objects.get(key=key).refcount, 2)
+            blob = blob_store.blob_storage_path(key)
+            self.assertEqual(block.file_storage_path(key, 'a.txt'), blob)
+
+            block.delete_file(fred, key)
+            self.assertEqual(fred, {})
+            self.assertTrue(storage.exists(blob))
+            block.delete_all(barney)
+            self.assertEqual(barney, {})
+            self.assertFalse(storage.exists(blob))
+            self.assertFalse(FileBlob.objects.filter(key=key).exists())
+
+            #the same file is uploaded again before the deletion runs.
+            block.store_file(fred, DummyUpload(path, 'a.txt'), 'a.txt')
+            deletions = []
+            with mock.patch.object(blob_store, '_after_commit', deletions.append):
+                block.delete_all(fred)
+            block.store_file(barney, DummyUpload(path, 'b.txt'), 'b.txt')
+            deletions[0]()
+            self.assertTrue(storage.exists(blob))
+            self.assertEqual(FileBlob.objects.get(key=key).refcount, 1)
+            self.assertEqual(storage.listdir(os.path.dirname(blob))[1], [key])
+
+            #the storage keeps a new file under another name.
+            with mock.patch.object(storage, 'save', return_value='elsewhere'), \
+                    mock.patch.object(storage, 'delete') as delete:
+                with self.assertRaises(IOError):
+                    block.store_file({}, StringIO('other'), 'c.txt')
+            self.assertEqual(delete.call_args_list, [mock.call('elsewhere')])
+
+    def test_chunked_upload(self):
+        storage = self.storage
+        block = self.make_one()
+        filelist = {}
+        owner = block.upload_owner()
+        with mock.patch.object(file_management_mixin, 'background') as background:
+            with self.assertRaises(webob.exc.HTTPBadRequest):
+                block.begin_chunked_upload('video.txt', None, owner)
+            upload_id = block.begin_chunked_upload('video.txt', 10, owner)
+            background.enqueue.assert_called_once_with(
+                'edx_mfu.tasks.remove_stale_uploads',
+                block.location.to_deprecated_string())
+            status = block.store_chunk(upload_id, 0, StringIO('hello'), owner)
+            self.assertEqual(status['received'], 5)
+            with self.assertRaises(webob.exc.HTTPNotFound):
+                block.store_chunk(upload_id, 5, StringIO('world'), 'someone else')
+            with self.assertRaises(webob.exc.HTTPConflict):
+                block.store_chunk(upload_id, 0, StringIO('hello'), owner)
+            with self.assertRaises(webob.exc.HTTPBadRequest):
+                block.store_chunk(upload_id, 5, StringIO('world!'), owner)
+            with self.assertRaises(webob.exc.HTTPConflict):
+                block.finish_chunked_upload(filelist, upload_id, owner)
+
+            block.store_chunk(upload_id, 5, StringIO('world'), owner)
+            status = block.chunked_upload_status(upload_id, owner)
+            self.assertEqual(status['received'], 10)
+            self.assertEqual(status['filename'], 'video.txt')
+
+            #a duplicate the storage renamed on a collision.
+            storage.save(file_management_mixin._chunked_upload_path(
+                block.location.to_deprecated_string(), upload_id, '0000000005_x'),
+                ContentFile('world'))
+            key, metadata = block.finish_chunked_upload(filelist, upload_id, owner)
+            path = block.file_storage_path(key, metadata.filename)
+            self.assertEqual(storage.open(path).read(), 'helloworld')
+            with self.assertRaises(webob.exc.HTTPNotFound):
+                block.chunked_upload_status(upload_id, owner)
+            self.assertEqual(storage.listdir(file_management_mixin._chunked_upload_path(
+                block.location.to_deprecated_string(), upload_id, '')), ([], []))
+
+    def test_chunked_upload_expiry(self):
+        storage = self.storage
+        block = self.make_one()
+        owner = block.upload_owner()
+        location = block.location.to_deprecated_string()
+        with mock.patch.object(file_management_mixin, 'background'):
+            stale = block.begin_chunked_upload('a.txt', 10, owner)
+            block.store_chunk(stale, 0, StringIO('hello'), owner)
+            fresh = block.begin_chunked_upload('b.txt', 10, owner)
+            with override_settings(EDX_MFU={'CHUNKED_UPLOAD_EXPIRY': -1}):
+                with self.assertRaises(webob.exc.HTTPNotFound):
+                    block.chunked_upload_status(stale, owner)
+            self.assertFalse(storage.exists(
+                file_management_mixin._chunked_upload_path(location, stale, 'manifest.json')))
+
+            block.store_chunk(fresh, 0, StringIO('hello'), owner)
+            self.assertEqual(file_management_mixin.remove_stale_uploads(location), 0)
+            with override_settings(EDX_MFU={'CHUNKED_UPLOAD_EXPIRY': -1}):
+                self.assertEqual(file_management_mixin.remove_stale_uploads(location), 1)
+            self.assertEqual(storage.listdir(
+                file_management_mixin._chunked_upload_path(location, fresh, '')), ([], []))
+
+        block.is_submitted = True
+        with self.assertRaises(webob.exc.HTTPForbidden):
+            block.student_upload_init(mock.Mock(params={'filename': 'c.txt', 'size': '3'}))
+
+    def test_download_file_conditional_and_range(self):
+        block = self.make_one()
+        filelist = {}
+        key, _ = block.store_file(filelist, StringIO('0123456789'), 'a.txt')
+        response = block.download_file(filelist, key, Request.blank('/'))
+        self.assertEqual(response.body, '0123456789')
+        self.assertEqual(response.headers['ETag'], '"%s"' % key)
+        self.assertEqual(response.content_length, 10)
+
+        response = block.download_file(filelist, key, Request.blank(
+            '/', headers={'If-None-Match': '"%s"' % key}))
+        self.assertEqual(response.status_int, 304)
+
+        response = block.download_file(filelist, key, Request.blank(
+            '/', headers={'Range': 'bytes=2-4'}))
+        self.assertEqual(response.status_int, 206)
+        self.assertEqual(response.body, '234')
+        self.assertEqual(response.headers['Content-Range'], 'bytes 2-4/10')
+
+        response = block.download_file(filelist, key, Request.blank(
+            '/', headers={'Range': 'bytes=0-1,-2'}))
+        self.assertEqual(response.status_int, 206)
+        self.assertIn('Content-Range: bytes 8-9/10\r\n\r\n89', response.body)
+        self.assertEqual(len(response.body), response.content_length)
+
+        response = block.download_file(filelist, key, Request.blank(
+            '/', headers={'Range': 'bytes=20-'}))
+        self.assertEqual(response.status_int, 416)
+
+        parse = file_serving.parse_range_header
+        self.assertEqual(parse('bytes=-5', 0), [])
+        self.assertEqual(parse('bytes=0-', 0), [])
+        self.assertEqual(parse('bytes=--5', 10), None)
+        self.assertEqual(parse('bytes=-', 10), None)
+        self.assertEqual(parse('bytes=1-2-3', 10), None)
+        self.assertEqual(parse('bytes=-20', 10), [(0, 9)])
+
+    def test_serve_file_modes(self):
+        storage = self.storage
+        storage.save('dir/a b.txt', ContentFile('0123456789'))
+
+        def serve(request=None, **kwargs):
+            return file_serving.serve_file(
+                request, 'dir/a b.txt', 'text/plain', 'a.txt', 'tag',
+                storage=storage, **kwargs)
+
+        with override_settings(EDX_MFU={'FILE_SERVING_MODE': 'x-accel-redirect'}):
+            response = serve(Request.blank('/', headers={'Range': 'bytes=2-4'}))
+            self.assertEqual(response.status_int, 200)
+            self.assertEqual(response.headers['X-Accel-Redirect'],
+                '/edx_mfu_protected/dir/a%20b.txt')
+            self.assertEqual(response.headers['ETag'], '"tag"')
+            self.assertEqual(response.headers['Content-Disposition'],
+                'attachment; filename=a.txt')
+            self.assertNotIn('Content-Length', response.headers)
+            self.assertEqual(response.body, '')
+            self.assertEqual(serve(accel_prefix='/zips/').headers['X-Accel-Redirect'],
+                '/zips/dir/a%20b.txt')
+
+            #non-ASCII names, from a storage which need not hold them.
+            named = mock.Mock()
+            named.path.return_value = u'/files/dir/caf\xe9.txt'
+            named.size.return_value = 6
+            self.assertEqual(file_serving.serve_file(None, u'dir/caf\xe9.txt',
+                'text/plain', 'cafe.txt', 'tag', storage=named
+                ).headers['X-Accel-Redirect'], '/edx_mfu_protected/dir/caf%C3%A9.txt')
+
+        with override_settings(EDX_MFU={'FILE_SERVING_MODE': 'x-sendfile'}):
+            response = serve()
+            self.assertEqual(response.headers['X-Sendfile'], storage.path('dir/a b.txt'))
+            self.assertEqual(file_serving.serve_file(None, u'dir/caf\xe9.txt',
+                'text/plain', 'cafe.txt', 'tag', storage=named
+                ).headers['X-Sendfile'], '/files/dir/caf\xc3\xa9.txt')
+            self.assertEqual(response.headers['Content-Type'], 'text/plain; charset=UTF-8')
+            self.assertNotIn('Content-Length', response.headers)
+            self.assertEqual(response.body, '')
+
+            #storages without local files are streamed from python.
+            remote = mock.Mock()
+            remote.path.side_effect = NotImplementedError
+            remote.size.return_value = 10
+            remote.open.return_value = StringIO('0123456789')
+            response = file_serving.serve_file(
+                None, 'a.txt', 'text/plain', 'a.txt', 'tag', storage=remote)
+            self.assertNotIn('X-Sendfile', response.headers)
+            self.assertEqual(response.body, '0123456789')
+
+        file_wrapper = mock.Mock(return_value=['0123456789'])
+        request = Request.blank('/', environ={'wsgi.file_wrapper': file_wrapper})
+        response = serve(request)
+        afile, block_size = file_wrapper.call_args[0]
+        self.assertEqual(afile.name, storage.path('dir/a b.txt'))
+        self.assertEqual(block_size, file_serving.BLOCK_SIZE)
+        afile.close()
+        self.assertEqual(response.content_length, 10)
+        self.assertEqual(response.headers['Accept-Ranges'], 'bytes')
+        self.assertNotIn('X-Accel-Redirect', response.headers)
+        self.assertNotIn('X-Sendfile', response.headers)
+
+        #ranges are read from storage, not handed to the file wrapper.
+        file_wrapper.reset_mock()
+        response = serve(Request.blank('/', headers={'Range': 'bytes=2-4'},
+            environ={'wsgi.file_wrapper': file_wrapper}))
+        self.assertEqual(response.body, '234')
+        self.assertFalse(file_wrapper.called)
+
+    def test_download_zipped_streams(self):
+        block = self.make_one()
+        filelist = {}
+        block.store_file(filelist, StringIO('hello'), 'a.txt')
+        block.store_file(filelist, StringIO('x' * 100000), 'b.py')
+        response = block.download_zipped(filelist, 'assignment')
+        self.assertFalse(isinstance(response.app_iter, list))
+        archive = ZipFile(StringIO(response.body))
+        self.assertEqual(archive.testzip(), None)
+        self.assertEqual(sorted(archive.namelist()), ['a.txt', 'b.py'])
+        self.assertEqual(archive.read('b.py'), 'x' * 100000)
+
+    def test_staff_download_all_zipped(self):
+        storage = self.storage
+        block = self.make_one()
+        block.is_course_staff = lambda: True
+        fred, barney, notes = {}, {}, {}
+        block.store_file(fred, StringIO('fred'), 'f.txt')
+        block.store_file(notes, StringIO('notes'), 'notes.txt')
+        block.store_file(barney, StringIO('zed'), 'z.txt')
+        key, _ = block.store_file(barney, StringIO('ay'), 'a.txt')
+        self.make_student_module(block, "fred", is_submitted=True,
+            uploaded_files=fred, annotated_files=notes)
+        self.make_student_module(block, "barney", is_submitted=True,
+            uploaded_files=barney)
+
+        def download():
+            response = block.staff_download_all_zipped(
+                Request.blank('/?annotated=1'))
+            self.assertFalse(isinstance(response.app_iter, list))
+            archive = ZipFile(StringIO(response.body))
+            self.assertEqual(archive.testzip(), None)
+            return archive
+
+        archive = download()
+        self.assertEqual(archive.namelist(), ['barney/a.txt', 'barney/z.txt',
+            'fred/f.txt', 'fred/annotated/notes.txt'])
+        self.assertEqual(archive.read('fred/annotated/notes.txt'), 'notes')
+
+        #a file gone from storage is left out, on the pool or not.
+        storage.delete(block.file_storage_path(key, 'a.txt'))
+        for workers in (2, 0):
+            with override_settings(EDX_MFU={'ZIP_WORKERS': workers}):
+                archive = download()
+            self.assertEqual(archive.namelist(), ['barney/z.txt',
+                'fred/f.txt', 'fred/annotated/notes.txt'])
+            self.assertEqual(archive.read('barney/z.txt'), 'zed')
+
+    def test_stream_zip_zip64(self):
+        members = [
+            ZipMember('big.txt', ['a' * 1000, 'b' * 1000], ZIP_DEFLATED),
+            ZipMember(u'caf\xe9.txt', ['coffee'], size=6),
+        ]
+        archive = ZipFile(StringIO(''.join(stream_zip(members))))
+        self.assertEqual(archive.testzip(), None)
+        self.assertEqual(archive.read('big.txt'), 'a' * 1000 + 'b' * 1000)
+        self.assertEqual(archive.read(u'caf\xe9.txt'), 'coffee')
+
+    def test_download_zipped_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        block = self.make_one()
+        filelist = {}
+        with override_settings(EDX_MFU={'ZIP_CACHE': 'local', 'ZIP_CACHE_DIR': cache_dir}):
+            block.store_file(filelist, StringIO('hello'), 'a.txt')
+            fingerprint = zip_cache.fingerprint(
+                block.location.to_deprecated_string(), filelist)
+            body = block.download_zipped(filelist).body
+            self.assertEqual(os.listdir(cache_dir), [fingerprint])
+
+            with mock.patch.object(file_management_mixin, 'stream_zip') as stream:
+                self.assertEqual(block.download_zipped(filelist).body, body)
+                self.assertFalse(stream.called)
+
+            #evicted between the lookup and serving it.
+            with mock.patch.object(zip_cache, 'lookup',
+                    return_value=(zip_cache.cache_storage(), 'gone')):
+                self.assertEqual(block.download_zipped(filelist).body, body)
+
+            block.store_file(filelist, StringIO('world'), 'b.txt')
+            self.assertEqual(os.listdir(cache_dir), [])
+
+    def test_zip_cache_eviction(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        with override_settings(EDX_MFU={'ZIP_CACHE': 'local',
+                'ZIP_CACHE_DIR': cache_dir, 'ZIP_CACHE_MAX_BYTES': 10}):
+            cache.delete(zip_cache._total_key())
+            storage = zip_cache.cache_storage()
+            with mock.patch.object(zip_cache, 'evict', wraps=zip_cache.evict) as evict:
+                zip_cache.store('a', StringIO('aaaa'))
+                zip_cache.store('a', StringIO('aaaa'))
+                zip_cache.store('b', StringIO('bbbb'))
+                #only when the total is unknown.
+                self.assertEqual(evict.call_count, 1)
+                self.assertEqual(cache.get(zip_cache._total_key()), 8)
+                self.assertEqual(sorted(os.listdir(cache_dir)), ['a', 'b'])
+
+                #within the grace period nothing is evicted.
+                zip_cache.store('c', StringIO('cccc'))
+                self.assertEqual(evict.call_count, 2)
+                self.assertEqual(sorted(os.listdir(cache_dir)), ['a', 'b', 'c'])
+
+                with mock.patch.object(zip_cache, 'EVICTION_GRACE', -10):
+                    zip_cache.store('d', StringIO('dddd'))
+                self.assertEqual(sorted(os.listdir(cache_dir)), ['c', 'd'])
+                self.assertEqual(cache.get(zip_cache._total_key()), 8)
+
+            #a concurrent store of the same archive.
+            with mock.patch.object(storage.__class__, 'exists', return_value=False):
+                zip_cache.store('c', StringIO('cccc'))
+            self.assertEqual(sorted(os.listdir(cache_dir)), ['c', 'd'])
+
+    @mock.patch('edx_mfu.mfu.background')
+    def test_student_submit_prebuilds_zip(self, background):
+        block = self.make_one(uploaded_files={'abc': ['a.txt', 'text/plain', 'now']})
+        with override_settings(EDX_MFU={'ZIP_CACHE': 'local'}):
+            block.student_submit(None)
+        self.assertFalse(background.enqueue.called)
+
+        block.is_submitted = False
+        with override_settings(EDX_MFU={'ZIP_CACHE': 'local',
+                'PREBUILD_SUBMISSION_ZIP': True, 'TASK_BACKEND': 'some.backend'}):
+            block.student_submit(None)
+        self.assertFalse(background.enqueue.called)
+
+        block.is_submitted = False
+        with override_settings(EDX_MFU={'ZIP_CACHE': 'local',
+                'PREBUILD_SUBMISSION_ZIP': True}):
+            block.student_submit(None)
+            background.enqueue.assert_called_once_with(
+                'edx_mfu.tasks.prebuild_zip',
+                block.location.to_deprecated_string(),
+                {'abc': ['a.txt', 'text/plain', 'now']})
+            block.student_submit(None)
+        self.assertEqual(background.enqueue.call_count, 1)
+
+    def test_run_task_retries(self):
+        task = mock.Mock(side_effect=[ValueError, ValueError, 'done'])
+        with mock.patch.object(background, 'resolve', return_value=task), \
+                override_settings(EDX_MFU={'TASK_RETRY_DELAY': 0}):
+            self.assertEqual(background.run_task('some.task', (1,), 2), 'done')
+        self.assertEqual(task.call_count, 3)
+
+    def test_compressed_members(self):
+        self.assertEqual(compression_for('text/x-python'), ZIP_DEFLATED)
+        self.assertEqual(compression_for(None), ZIP_DEFLATED)
+        self.assertEqual(compression_for('image/jpeg'), ZIP_STORED)
+        self.assertEqual(compression_for('application/pdf'), ZIP_STORED)
+        members = [
+            compress_member(ZipMember('a.py', ['x' * 10000], ZIP_DEFLATED)),
+            compress_member(ZipMember('b.jpg', ['y' * 100], ZIP_STORED)),
+        ]
+        archive = ZipFile(StringIO(''.join(stream_zip(members))))
+        self.assertEqual(archive.testzip(), None)
+        self.assertLess(archive.getinfo('a.py').compress_size, 10000)
+        self.assertEqual(archive.getinfo('b.jpg').compress_size, 100)
+        self.assertEqual(archive.read('a.py'), 'x' * 10000)
+
+    def test_compressed_members_parallel(self):
+        def slow(data, delay):
+            time.sleep(delay)
+            yield data
+
+        def archive():
+            return ''.join(stream_zip(compressed_members(
+                ZipMember('f%d.txt' % i, slow(str(i) * (100 * i), 0.01 * (i % 3)),
+                    ZIP_DEFLATED, datetime.datetime(2020, 1, 1))
+                for i in range(10))))
+
+        with override_settings(EDX_MFU={'ZIP_WORKERS': 0}):
+            serial = archive()
+        with override_settings(EDX_MFU={'ZIP_WORKERS': 3, 'ZIP_READ_AHEAD': 4}):
+            self.assertEqual(archive(), serial)
+
+    def test_staff_grading_data_query_count(self):
+        block = self.make_one()
+        created = 0
+        for size in (1, 10, 50):
+            while created < size:
+                self.make_student_module(
+                    block, "grading%d" % created, is_submitted=True)
+                created += 1
+            with CaptureQueriesContext(connection) as queries, \
+                    override_settings(EDX_MFU={'GRADING_CACHE': None}):
+                data = block.staff_grading_data()
+            self.assertEqual(len(data['assignments']), size)
+            self.assertEqual(len(queries), 1)
+
+    def test_staff_grading_page(self):
+        block = self.make_one()
+        for i in range(5):
+            self.make_student_module(block, "page%d" % i, is_submitted=True, score=i)
+        for i in range(3):
+            self.make_student_module(block, "pageopen%d" % i)
+
+        with CaptureQueriesContext(connection) as queries:
+            data = block.get_staff_grading_page(mock.Mock(params=webob.multidict.MultiDict(
+                page_size='2', filter='submitted'))).json_body
+        self.assertEqual(len(queries), 2)
+        self.assertEqual(data['total'], 5)
+        self.assertEqual([row['username'] for row in data['assignments']], ['page0', 'page1'])
+
+        data = block.get_staff_grading_page(mock.Mock(params=webob.multidict.MultiDict(
+            page_size='2', filter='submitted', cursor=data['next_cursor']))).json_body
+        self.assertEqual([row['username'] for row in data['assignments']], ['page2', 'page3'])
+        cursor = data['next_cursor']
+
+        data = block.get_staff_grading_page(mock.Mock(params=webob.multidict.MultiDict(
+            page_size='3', sort='-score'))).json_body
+        self.assertEqual(data['total'], 8)
+        self.assertEqual([row['score'] for row in data['assignments']], [4, 3, 2])
+        self.assertEqual(data['next_cursor'], None)
+        #other sorts page through the cached table.
+        with mock.patch.object(GradingDataLoader, 'module_row') as module_row:
+            data = block.get_staff_grading_page(mock.Mock(params=webob.multidict.MultiDict(
+                page='2', page_size='3', sort='-score'))).json_body
+        self.assertFalse(module_row.called)
+        self.assertEqual([row['score'] for row in data['assignments']], [1, 0, None])
+        with self.assertRaises(webob.exc.HTTPBadRequest):
+            block.get_staff_grading_page(mock.Mock(params=webob.multidict.MultiDict(
+                page_size='3', sort='-score', cursor=cursor)))
+
+        data = block.get_staff_grading_page(mock.Mock(params=webob.multidict.MultiDict(
+            filter='ungraded'))).json_body
+        self.assertEqual(data['total'], 3)
+
+    def test_staff_grading_changes(self):
+        block = self.make_one()
+        fred = self.make_student_module(block, "delta1", is_submitted=True)
+        self.make_student_module(block, "delta2", is_submitted=True)
+        data = block.get_staff_grading_changes(mock.Mock(params={})).json_body
+        self.assertEqual(len(data['assignments']), 2)
+
+        block.set_student_state(fred.id, score=7)
+        data = block.get_staff_grading_changes(mock.Mock(params={
+            'since': data['watermark']})).json_body
+        changed = [row for row in data['assignments'] if row['score'] == 7]
+        self.assertEqual([row['module_id'] for row in changed], [fred.id])
+        #held back, so a write committing late is not skipped.
+        modified = StudentModule.objects.get(pk=fred.id).modified
+        self.assertLess(parse_datetime(data['watermark']), modified)
+        data = block.get_staff_grading_changes(mock.Mock(params={
+            'since': data['watermark']})).json_body
+        self.assertIn(fred.id, [row['module_id'] for row in data['assignments']])
+
+        with override_settings(EDX_MFU={'GRADING_CHANGES_LAG': 0}):
+            data = block.get_staff_grading_changes(mock.Mock(params={
+                'since': data['watermark']})).json_body
+        self.assertEqual(data['watermark'], modified.isoformat())
+
+    def test_get_staff_grading_data_stream(self):
+        block = self.make_one()
+        for i in range(7):
+            self.make_student_module(block, "stream%d" % i, is_submitted=True)
+        with override_settings(EDX_MFU={'GRADING_CHUNK_SIZE': 3}):
+            response = block.get_staff_grading_data(Request.blank('/?stream=1'))
+            with CaptureQueriesContext(connection) as queries:
+                chunks = list(response.app_iter)
+        self.assertEqual(len(queries), 3)
+        self.assertEqual(json.loads(''.join(chunks)), block.staff_grading_data())
+
+    @override_settings(EDX_MFU={'GRADING_CACHE': None})
+    def test_staff_handlers_write_state_once(self):
+        path = pkg_resources.resource_filename(__package__, 'tests.py')
+        block = self.make_one()
+        block.is_course_staff = lambda: True
+        fred = self.make_student_module(block, "uow1", is_submitted=True)
+        self.make_student_module(block, "uow2", is_submitted=True)
+
+        def statements(handler, suffix='', request=None, **params):
+            with CaptureQueriesContext(connection) as queries:
+                handler(request or mock.Mock(params=params), suffix)
+            return [kind for query in queries for kind in ('SELECT', 'UPDATE')
+                    if kind + ' ' in query['sql'][:20] and
+                    'courseware_studentmodule' in query['sql']]
+
+        self.assertEqual(statements(block.staff_enter_grade,
+            module_id=fred.id, grade='8'), ['SELECT', 'UPDATE'])
+        self.assertEqual(statements(block.staff_remove_grade,
+            module_id=fred.id), ['SELECT', 'UPDATE', 'SELECT'])
+        self.assertEqual(statements(block.staff_reopen_submission,
+            module_id=fred.id), ['SELECT', 'UPDATE'])
+
+        self.assertEqual(statements(block.staff_upload_annotated,
+            module_id=fred.id,
+            uploadedFile=mock.Mock(file=DummyUpload(path, 'test.txt'))),
+            ['SELECT', 'UPDATE'])
+        key = json.loads(StudentModule.objects.get(
+            pk=fred.id).state)['annotated_files'].keys()[0]
+        download = Request.blank('/?module_id=%d' % fred.id)
+        self.assertEqual(statements(block.staff_download_annotated, key,
+            request=download), ['SELECT'])
+        self.assertEqual(statements(block.staff_download_annotated_zipped,
+            request=download), ['SELECT'])
+        self.assertEqual(statements(block.staff_delete_annotated, key,
+            module_id=fred.id), ['SELECT', 'UPDATE', 'SELECT'])
+
+        owner = block.upload_owner(fred.id)
+        upload_id = block.begin_chunked_upload('a.txt', 5, owner)
+        block.store_chunk(upload_id, 0, StringIO('hello'), owner)
+        self.assertEqual(statements(block.staff_upload_annotated_finalize,
+            upload_id, module_id=fred.id), ['SELECT', 'UPDATE'])
+
+        uploaded = {}
+        key = block.store_file(uploaded, StringIO('submitted'), 'b.txt')[0]
+        block.set_student_state(fred.id, uploaded_files=uploaded)
+        block.flush_student_state()
+        self.assertEqual(statements(block.staff_download_file, key,
+            request=download), ['SELECT'])
+        self.assertEqual(statements(block.staff_download_zipped,
+            request=download), ['SELECT'])
+        self.assertEqual(statements(block.staff_delete_file, key,
+            module_id=fred.id), ['SELECT', 'UPDATE'])
+        self.assertEqual(statements(block.staff_remove_submission,
+            module_id=fred.id), ['SELECT', 'UPDATE'])
+
+        state = json.loads(StudentModule.objects.get(pk=fred.id).state)
+        self.assertEqual(state['score'], None)
+        self.assertFalse(state['is_submitted'])
+
+    def test_staff_remove_all_submissions(self):
+        storage = self.storage
+        block = self.make_one()
+        block.is_course_staff = lambda: True
+        modules = []
+        with override_settings(EDX_MFU={'BULK_CHUNK_SIZE': 2}):
+            for i in range(5):
+                uploaded = {}
+                block.store_file(uploaded, StringIO('file %d' % i), 'a.txt')
+                modules.append(self.make_student_module(
+                    block, "bulk%d" % i, is_submitted=True, score=i,
+                    uploaded_files=uploaded))
+            paths = [block.file_storage_path(key, 'a.txt')
+                for module in modules
+                for key in json.loads(module.state)['uploaded_files']]
+
+            change = BulkStateChange(self.course_id, block.location)
+            with CaptureQueriesContext(connection) as queries:
+                change.run(dict(is_submitted=False))
+            selects = [query for query in queries
+                if 'SELECT ' in query['sql'][:20]]
+            self.assertEqual(len(selects), 3)
+
+            with mock.patch('edx_mfu.jobs.background'):
+                job = block.staff_remove_all_submissions(
+                    mock.Mock(params={})).json_body
+            run_job(job['job_id'])
+
+        for module in modules:
+            state = json.loads(StudentModule.objects.get(pk=module.id).state)
+            self.assertFalse(state['is_submitted'])
+            self.assertEqual(state['score'], None)
+            self.assertEqual(state['uploaded_files'], {})
+        for path in paths:
+            self.assertFalse(storage.exists(path))
+
+    @mock.patch('edx_mfu.jobs.background')
+    def test_jobs(self, background):
+        block = self.make_one()
+        block.is_course_staff = lambda: True
+        modules = [self.make_student_module(block, "job%d" % i, is_submitted=True)
+            for i in range(4)]
+
+        response = block.staff_reopen_all_submissions(mock.Mock(params={}))
+        self.assertEqual(response.status_int, 202)
+        job_id = response.json_body['job_id']
+        background.enqueue.assert_called_with('edx_mfu.jobs.run_job', job_id)
+        self.assertEqual(block.staff_reopen_all_submissions(
+            mock.Mock(params={})).json_body['job_id'], job_id)
+
+        #another request holds the lock and never creates its job.
+        cache.add(jobs._submit_key(unicode(block.location), 'remove_all'), True)
+        with mock.patch.object(jobs, 'SUBMIT_WAIT', 0):
+            with self.assertRaises(webob.exc.HTTPConflict):
+                block.staff_remove_all_submissions(mock.Mock(params={}))
+        cache.delete(jobs._submit_key(unicode(block.location), 'remove_all'))
+        self.assertFalse(Job.objects.filter(kind='remove_all').exists())
+
+        #as if a worker stopped after the first two students.
+        Job.objects.filter(job_id=job_id).update(
+            checkpoint=modules[1].id, progress=2)
+        with override_settings(EDX_MFU={'BULK_CHUNK_SIZE': 1}):
+            run_job(job_id)
+        self.assertEqual(
+            [json.loads(StudentModule.objects.get(pk=module.id).state)['is_submitted']
+                for module in modules],
+            [True, True, False, False])
+        data = block.staff_job_status(mock.Mock(params={}), job_id).json_body
+        self.assertEqual(data['status'], 'succeeded')
+        self.assertEqual((data['progress'], data['total']), (4, 4))
+
+        job_id = block.staff_remove_all_submissions(
+            mock.Mock(params={})).json_body['job_id']
+        data = block.staff_cancel_job(mock.Mock(params={}), job_id).json_body
+        self.assertEqual(data['status'], 'cancelled')
+        run_job(job_id)
+        self.assertEqual(
+            json.loads(StudentModule.objects.get(pk=modules[0].id).state)['is_submitted'],
+            True)
+
+    def test_set_student_state_conflict(self):
+        block = self.make_one()
+        block.is_course_staff = lambda: True
+        fred = self.make_student_module(block, "cas1", is_submitted=True)
+
+        uow = unit_of_work.StudentStateUnitOfWork()
+        uow.set(fred.id, score=5)
+        #another request reopens the submission before the write.
+        block.set_student_state(fred.id, is_submitted=False)
+        before = unit_of_work.state_write_stats()
+        uow.flush()
+        after = unit_of_work.state_write_stats()
+
+        state = json.loads(StudentModule.objects.get(pk=fred.id).state)
+        self.assertEqual(state['score'], 5)
+        self.assertFalse(state['is_submitted'])
+        self.assertEqual(after['conflicts'] - before['conflicts'], 1)
+        self.assertEqual(after['writes'] - before['writes'], 1)
+
+        with mock.patch.object(unit_of_work, '_write_if_unchanged',
+                return_value=False):
+            with self.assertRaises(webob.exc.HTTPConflict):
+                block.set_student_state(fred.id, score=6)
+        self.assertEqual(unit_of_work.state_write_stats()['failures'],
+            after['failures'] + 1)
+
+        #a modified time stored less precisely than it was read still matches.
+        module = StudentModule.objects.get(pk=fred.id)
+        module.modified += datetime.timedelta(microseconds=1)
+        before = unit_of_work.state_write_stats()
+        unit_of_work.compare_and_set(module, dict(
+            json.loads(module.state), score=7), {'score': 7})
+        self.assertEqual(unit_of_work.state_write_stats()['conflicts'],
+            before['conflicts'])
+
+    def test_set_student_state_conflict_merges_files(self):
+        block = self.make_one()
+        fred = self.make_student_module(block, "cas2", is_submitted=True,
+            uploaded_files={'a': ['a.txt', 'text/plain', 'then']})
+
+        uow = unit_of_work.StudentStateUnitOfWork()
+        uow.set(fred.id, is_submitted=False, uploaded_files={
+            'c': ['c.txt', 'text/plain', 'now']})
+        #another request uploads a file before the write.
+        block.set_student_state(fred.id, uploaded_files={
+            'a': ['a.txt', 'text/plain', 'then'],
+            'b': ['b.txt', 'text/plain', 'now']})
+        uow.flush()
+
+        state = json.loads(StudentModule.objects.get(pk=fred.id).state)
+        self.assertEqual(sorted(state['uploaded_files']), ['b', 'c'])
+        self.assertFalse(state['is_submitted'])
+
+    @mock.patch('edx_mfu.grade_publishing._load_descriptor')
+    @mock.patch('edx_mfu.grade_publishing._bind')
+    @mock.patch('edx_mfu.grade_publishing.background')
+    def test_publish_grades(self, background, bind, load_descriptor):
+        block = self.make_one(points=10)
+        block.is_course_staff = lambda: True
+        block.is_instructor = lambda: True
+        modules = [self.make_student_module(block, "publish%d" % i,
+            is_submitted=True, score_published=False) for i in range(3)]
+        for module in modules:
+            block.staff_enter_grade(mock.Mock(params={
+                'module_id': module.id, 'grade': '7'}))
+        self.assertEqual(background.enqueue.call_count, 1)
+
+        args = background.enqueue.call_args[0]
+        self.assertEqual(args[0], 'edx_mfu.tasks.publish_grades')
+        #points changed after the grades were approved.
+        bound = bind.return_value
+        bound.max_score.return_value = 12
+        bound.runtime.publish.side_effect = [None, None, Exception('down')]
+        self.assertEqual(publish_grades(*args[1:]), 2)
+        self.assertEqual(load_descriptor.call_count, 1)
+        self.assertEqual(bound.runtime.publish.call_args_list[:2],
+            [mock.call(bound, 'grade', {'value': 7, 'max_value': 12})] * 2)
+        self.assertEqual([module.student for module in modules],
+            [call[0][2] for call in bind.call_args_list])
+        self.assertEqual([json.loads(StudentModule.objects.get(
+            pk=module.id).state)['score_published'] for module in modules],
+            [True, True, False])
+
+        bound.runtime.publish.side_effect = None
+        self.assertEqual(publish_grades(*args[1:]), 1)
+        self.assertEqual(publish_grades(*args[1:]), 0)
+
+        #a grade whose run could not be queued is still entered.
+        background.enqueue.side_effect = Exception('broker down')
+        block.staff_enter_grade(mock.Mock(params={
+            'module_id': modules[0].id, 'grade': '8'}))
+        self.assertEqual(json.loads(StudentModule.objects.get(
+            pk=modules[0].id).state)['score'], 8)
+
+    @mock.patch('edx_mfu.grade_publishing.background')
+    def test_import_export_grades(self, background):
+        block = self.make_one(points=10)
+        block.is_course_staff = lambda: True
+        block.is_instructor = lambda: True
+        fred = self.make_student_module(block, "import1", is_submitted=True)
+        barney = self.make_student_module(block, "import2", is_submitted=True)
+
+        def import_grades(body, content_type='text/csv'):
+            return block.staff_import_grades(Request.blank(
+                '/', POST=body, content_type=content_type))
+
+        response = import_grades(
+            'username,score,comment\nimport1,7,Good\nimport2,11,\nnobody,3,\n')
+        self.assertEqual(response.status_int, 400)
+        self.assertEqual(
+            [(error['line'], error['username']) for error in response.json_body['errors']],
+            [(3, 'import2'), (4, 'nobody')])
+        self.assertNotIn('score', json.loads(
+            StudentModule.objects.get(pk=fred.id).state))
+
+        with CaptureQueriesContext(connection) as queries:
+            response = import_grades(
+                'username,score,comment\nimport1,7,"Good, really"\nimport2,,\n')
+        self.assertEqual(response.json_body, {'imported': 1})
+        self.assertEqual(len([query for query in queries
+            if 'SELECT ' in query['sql'][:20]]), 1)
+        response = import_grades(json.dumps([{'username': 'import2', 'score': 4}]),
+            'application/json')
+        self.assertEqual(response.json_body, {'imported': 1})
+
+        response = block.staff_export_grades(Request.blank('/'))
+        self.assertEqual(response.content_type, 'text/csv')
+        exported = ''.join(response.app_iter)
+        self.assertIn('import1,import1,7.0,10,"Good, really",True,False,True,,', exported)
+        self.assertEqual(import_grades(exported).json_body, {'imported': 2})
+        state = json.loads(StudentModule.objects.get(pk=barney.id).state)
+        self.assertEqual((state['score'], state['score_approved']), (4, True))
+
+        with self.assertRaises(webob.exc.HTTPBadRequest):
+            import_grades('username,score\nimport1,\x005\n')
+
+        self.assertEqual(import_grades(
+            'username,score,comment\nimport1,6,=HYPERLINK("x")\n').json_body, {'imported': 1})
+        exported = ''.join(block.staff_export_grades(Request.blank('/')).app_iter)
+        self.assertIn('"\'=HYPERLINK(""x"")"', exported)
+        import_grades(exported)
+        self.assertEqual(json.loads(StudentModule.objects.get(
+            pk=fred.id).state)['comment'], '=HYPERLINK("x")')
+
+        #a row which cannot be written rolls back the rows before it.
+        conflict = [unit_of_work.compare_and_set,
+            mock.Mock(side_effect=webob.exc.HTTPConflict())]
+        with mock.patch('edx_mfu.grade_import.compare_and_set',
+                side_effect=lambda *args: conflict.pop(0)(*args)), \
+                override_settings(EDX_MFU={'BULK_CHUNK_SIZE': 1}):
+            with self.assertRaises(webob.exc.HTTPConflict):
+                import_grades('username,score\nimport1,1\nimport2,2\n')
+        self.assertEqual([json.loads(StudentModule.objects.get(
+            pk=module.id).state)['score'] for module in (fred, barney)], [6, 4])
+
+    @override_settings(EDX_MFU={'GRADING_CACHE': 'default'})
+    def test_grading_cache(self):
+        block = self.make_one()
+        block.is_course_staff = lambda: True
+        modules = [self.make_student_module(block, "cached%d" % i,
+            is_submitted=True, score=i) for i in range(3)]
+        block.staff_grading_data()
+
+        with CaptureQueriesContext(connection) as queries:
+            data = block.staff_grading_data()
+        self.assertEqual(len(queries), 0)
+        self.assertEqual(data['assignments'], GradingDataLoader(block).rows())
+
+        block.set_student_state(modules[1].id, score=9)
+        with CaptureQueriesContext(connection) as queries:
+            data = block.staff_grading_data()
+        #the modified time of every module, then the one changed module.
+        self.assertEqual(len(queries), 2)
+        self.assertEqual([row['score'] for row in data['assignments']], [0, 9, 2])
+
+        #a write in the same second, and a renamed student.
+        module = StudentModule.objects.get(pk=modules[2].id)
+        StudentModule.objects.filter(pk=module.id).update(
+            state=module.state.replace('"score": 2', '"score": 8'),
+            modified=module.modified)
+        UserProfile.objects.filter(user=module.student).update(name='Renamed')
+        grading_cache.bump(block.location)
+        data = block.staff_grading_data()
+        self.assertEqual([row['score'] for row in data['assignments']], [0, 9, 8])
+        self.assertEqual(data['assignments'][0]['fullname'], 'cached0')
+        self.assertEqual(data['assignments'][2]['fullname'], 'Renamed')
+
+    @override_settings(EDX_MFU={'GRADING_CACHE': 'local'})
+    def test_grading_cache_local(self):
+        block = self.make_one()
+        block.is_course_staff = lambda: True
+        module = self.make_student_module(block, "local0",
+            is_submitted=True, score=1)
+        module = StudentModule.objects.get(pk=module.id)
+        grading_cache._local_cache.clear()
+
+        #built within the second of the latest write.
+        with mock.patch('edx_mfu.grading_cache.timezone') as timezone:
+            timezone.now.return_value = module.modified
+            block.staff_grading_data()
+        #another process writes in that second.
+        StudentModule.objects.filter(pk=module.id).update(
+            state=module.state.replace('"score": 1', '"score": 4'),
+            modified=module.modified)
+        with mock.patch('edx_mfu.grading_cache.timezone') as timezone:
+            timezone.now.return_value = module.modified + datetime.timedelta(seconds=1)
+            data = block.staff_grading_data()
+        self.assertEqual(data['assignments'][0]['score'], 4)
+
+        with CaptureQueriesContext(connection) as queries:
+            data = block.staff_grading_data()
+        #the summary only.
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(data['assignments'][0]['score'], 4)
+
+    def test_resources_cached(self):
+        resources.clear()
+        path = 'templates/multiple_file_upload/show.html'
+        with override_settings(EDX_MFU={'RESOURCE_RELOAD': False}):
+            with mock.patch('edx_mfu.resources.pkg_resources') as pkg:
+                pkg.resource_string.return_value = 'v1'
+                template = resources.template(path)
+                self.assertIs(resources.template(path), template)
+                self.assertEqual(resources.resource(path), u'v1')
+                self.assertEqual(pkg.resource_string.call_count, 2)
+
+        with override_settings(EDX_MFU={'RESOURCE_RELOAD': True}):
+            with mock.patch('os.path.getmtime', return_value=1):
+                template = resources.template(path)
+                self.assertIs(resources.template(path), template)
+            with mock.patch('os.path.getmtime', return_value=2):
+                self.assertIsNot(resources.template(path), template)
+        resources.clear()
+
+    @mock.patch('edx_mfu.mfu.render_template')
+    @mock.patch('edx_mfu.mfu.Fragment')
+    def test_asset_bundles(self, Fragment, render_template):
+        self.assertEqual(assets.minify_css('a {\n  color: red; /* x */\n}\n'), 'a{color:red}')
+        self.assertEqual(
+            assets.minify_js('var a = "//x"; // y\n\n  b = a.split(/\\//);\n'),
+            'var a = "//x";\nb = a.split(/\\//);')
+
+        directory = tempfile.mkdtemp()
+        try:
+            manifest = assets.build(directory)
+            self.assertEqual(sorted(manifest), sorted(assets.BUNDLES))
+            self.assertTrue(os.path.exists(os.path.join(directory, manifest['edx_mfu.js'])))
+
+            block = self.make_one()
+            with override_settings(EDX_MFU={'ASSET_URL': '/static/edx_mfu/', 'ASSET_DIR': directory}):
+                fragment = block.student_view()
+            fragment.add_javascript_url.assert_any_call(
+                '/static/edx_mfu/' + manifest['edx_mfu.js'])
+            fragment.add_css_url.assert_called_once_with(
+                '/static/edx_mfu/' + manifest['edx_mfu.css'])
+            self.assertFalse(fragment.add_javascript.called)
+        finally:
+            shutil.rmtree(directory)
+            assets._manifest.clear()
+
+    @override_settings(EDX_MFU={'INSTRUMENTATION': ['histogram'], 'GRADING_CACHE': None})
+    def test_instrumentation(self):
+        class MeteredStorage(FileSystemStorage):
+            pass
+
+        #only the throwaway class is metered, not default_storage's.
+        patcher = mock.patch.object(instrumentation, '_installed', [True])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        storage = MeteredStorage(self.storage.location)
+        storage.save('a.txt', ContentFile('hello'))
+        instrumentation.meter_storage(MeteredStorage)
+        self.assertFalse(hasattr(FileSystemStorage.open.__func__, '_edx_mfu_metered'))
+        instrumentation.reset()
+        block = self.make_one()
+        block.is_course_staff = lambda: True
+        self.make_student_module(block, "measured", is_submitted=True)
+        staff_grading_data = block.staff_grading_data
+        block.staff_grading_data = lambda: dict(
+            staff_grading_data(), extra=storage.open('a.txt').read())
+
+        #the connection's query log is already full.
+        queries_log = connection.queries_log
+        connection.queries_log = type(queries_log)([{}] * 5, maxlen=5)
+        try:
+            block.get_staff_grading_data(None)
+        finally:
+            connection.queries_log = queries_log
+        histograms = instrumentation.histograms()
+        prefix = 'handler.get_staff_grading_data.'
+        self.assertEqual(histograms[prefix + 'time'].count, 1)
+        self.assertGreater(histograms[prefix + 'queries'].max, 0)
+        self.assertEqual(histograms[prefix + 'storage.open'].max, 1)
+        self.assertEqual(histograms[prefix + 'storage_bytes'].max, 5)
+
+        listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.settimeout(5)
+        address = '127.0.0.1:%d' % listener.getsockname()[1]
+        with override_settings(EDX_MFU={'INSTRUMENTATION': ['statsd'], 'STATSD_ADDRESS': address}):
+            block.get_staff_grading_data(None)
+        self.assertIn('edx_mfu.handler.get_staff_grading_data.time:', listener.recv(4096))
+        listener.close()
+
+        instrumentation.reset()
+        with override_settings(EDX_MFU={}):
+            block.get_staff_grading_data(None)
+        self.assertEqual(instrumentation.histograms(), {})
+
+    def test_benchmark(self):
+        results = benchmark.run_suite(
+            students=3, files=1, file_size=1024, repeat=1, warmup=0,
+            scenarios=['staff_grading_data', 'download_zipped', 'remove_submission'])
+        self.assertEqual(list(results['results']),
+            ['staff_grading_data', 'download_zipped', 'remove_submission'])
+        self.assertGreater(results['results']['download_zipped']['bytes'], 1024)
+        self.assertEqual(results['parameters']['students'], 3)
+        self.assertFalse(User.objects.filter(
+            username__startswith=benchmark.USERNAME_PREFIX).exists())
+
+        baseline = {'results': {
+            'staff_grading_data': {'median_ms': 10.0},
+            'download_zipped': {'median_ms': 1000.0}}}
+        current = {'results': {
+            'staff_grading_data': {'median_ms': 20.0},
+            'download_zipped': {'median_ms': 990.0},
+            'remove_submission': {'median_ms': 1.0}}}
+        comparison = benchmark.compare(current, baseline)
+        self.assertEqual(comparison['staff_grading_data']['verdict'], 'slower')
+        self.assertEqual(comparison['staff_grading_data']['change'], 1.0)
+        self.assertEqual(comparison['download_zipped']['verdict'], 'unchanged')
+        self.assertEqual(comparison['remove_submission']['verdict'], 'new')
+
+    def test_benchmark_command_requires_test_settings(self):
+        self.assertTrue(mfu_benchmark.is_test_settings('lms.envs.test'))
+        self.assertTrue(mfu_benchmark.is_test_settings('cms.envs.test_static_optimized'))
+        self.assertFalse(mfu_benchmark.is_test_settings('lms.envs.aws'))
+        self.assertFalse(mfu_benchmark.is_test_settings(None))
+        with override_settings(SETTINGS_MODULE='lms.envs.aws'), \
+                mock.patch.object(mfu_benchmark, 'connection') as connection:
+            with self.assertRaises(CommandError):
+                mfu_benchmark.Command().handle(baseline=None)
+        self.assertFalse(connection.creation.create_test_db.called)
@@ -0,0 +1,233 @@
+"""
+A request scoped unit of work for student state.  Staff handlers read
+and change the state of other students through StudentModule rows; the
+unit of work loads and parses each row once, applies changes to the
+parsed state in memory and writes each changed row with a single UPDATE
+when the handler is done.
+
+Writes are compare-and-swap: the UPDATE only applies if the row still
+holds the state it was read with.  When another request changed the row
+in between, it is read again, under a row lock, the changed fields are
+applied to it and the write is retried, up to STATE_WRITE_RETRIES times.
+File lists are merged rather than replaced: only the files the request
+added and removed are applied, so files uploaded by the other request
+are kept.
+"""
+import collections
+import datetime
+import functools
+import json
+import logging
+import pytz
+import threading
+
+from django.db import transaction
+
+import webob.exc as ExceptionResponse
+
+from courseware.models import StudentModule
+
+import grading_cache
+from config import get_setting
+
+log = logging.getLogger(__name__)
+
+#fields holding file lists, merged on a conflict.
+FILE_LISTS = ('uploaded_files', 'annotated_files')
+
+_stats = collections.Counter()
+_stats_lock = threading.Lock()
+
+class StudentStateUnitOfWork(object):
+	"""
+	Student modules and their parsed state, keyed by module id.
+	"""
+	def __init__(self):
+		self.modules = dict()
+		self.states = dict()
+		self.changes = dict()
+
+	def add(self, module):
+		"""Registers a module already loaded by the caller, so it is not
+		fetched again.  Modules already in the unit of work are kept.
+
+		Keyword arguments:
+		module: a student module.
+		"""
+		if module.id not in self.modules:
+			self.modules[module.id] = module
+
+	def module(self, module_id):
+		"""Returns a student module, fetching it on first use.
+
+		Keyword arguments:
+		module_id: the id of the student module.
+		"""
+		module_id = int(module_id)
+		if module_id not in self.modules:
+			self.modules[module_id] = StudentModule.objects \
+				.select_related('student').get(pk=module_id)
+		return self.modules[module_id]
+
+	def state(self, module_id):
+		"""Returns the parsed state of a student module.  Changes to it
+		are only written if set is called for the module.
+
+		Keyword arguments:
+		module_id: the id of the student module.
+		"""
+		module_id = int(module_id)
+		if module_id not in self.states:
+			self.states[module_id] = json.loads(self.module(module_id).state)
+		return self.states[module_id]
+
+	def set(self, module_id, **fields):
+		"""Sets fields in the state of a student module.
+
+		Keyword arguments:
+		module_id: the id of the student module.
+		fields:    the fields to set.
+		"""
+		self.state(module_id).update(fields)
+		self.changes.setdefault(int(module_id), dict()).update(fields)
+
+	def flush(self):
+		"""Writes every changed module with one UPDATE each, in a single
+		transaction.
+		"""
+		if not self.changes:
+			return
+
+		with transaction.atomic():
+			for module_id in sorted(self.changes):
+				self.states[module_id] = compare_and_set(
+					self.modules[module_id],
+					self.states[module_id],
+					self.changes[module_id]
+				)
+
+		locations = set(self.modules[module_id].module_state_key
+			for module_id in self.changes)
+		for location in locations:
+			grading_cache.bump(location)
+		self.changes.clear()
+
+def unit_of_work(handler):
+	"""Runs a block method inside a unit of work, flushed when the method
+	returns.  Nested calls share the outer unit of work.  Nothing is
+	written if the method raises.
+	"""
+	@functools.wraps(handler)
+	def wrapper(self, *args, **kwargs):
+		if getattr(self, '_unit_of_work', None) is not None:
+			return handler(self, *args, **kwargs)
+
+		self._unit_of_work = StudentStateUnitOfWork()
+		try:
+			result = handler(self, *args, **kwargs)
+			self._unit_of_work.flush()
+			return result
+		finally:
+			self._unit_of_work = None
+	return wrapper
+
+def compare_and_set(module, state, fields):
+	"""Writes the state of a student module if the stored row is unchanged
+	since the module was read.  On a conflict the row is read again, the
+	changed fields are applied to it and the write is retried.  Returns the
+	state written, and updates the module to match.
+
+	Keyword arguments:
+	module: the student module, as it was read.
+	state:  the new state of the module.
+	fields: the fields changed, applied again on a conflict.
+	"""
+	read = json.loads(module.state)
+	for attempt in range(get_setting('STATE_WRITE_RETRIES') + 1):
+		if attempt:
+			with transaction.atomic():
+				#a locking read sees the latest row inside a transaction.
+				current = StudentModule.objects.select_for_update() \
+					.get(pk=module.id)
+				module.state = current.state
+				module.modified = current.modified
+				state = json.loads(current.state)
+				state.update(merge_fields(read, state, fields))
+				written = _write_if_unchanged(module, state)
+		else:
+			written = _write_if_unchanged(module, state)
+
+		_record('conflicts' if not written else 'writes')
+		if written:
+			return state
+		log.info("Student module %s changed while being written.", module.id)
+
+	_record('failures')
+	raise ExceptionResponse.HTTPConflict(
+		detail='Student state changed while being saved.',
+		comment='Try again.'
+		)
+
+def merge_fields(read, current, fields):
+	"""Returns the changed fields to apply to a state changed by another
+	request.  File lists get the files added and removed since the state
+	was read applied to their current value.
+
+	Keyword arguments:
+	read:    the state the fields were changed from.
+	current: the state as it is now.
+	fields:  the fields changed.
+	"""
+	merged = dict(fields)
+	for name in FILE_LISTS:
+		if name not in fields:
+			continue
+		before = read.get(name) or dict()
+		after = fields[name] or dict()
+		filelist = dict(current.get(name) or dict())
+		for key in before:
+			if key not in after:
+				filelist.pop(key, None)
+		for key, metadata in after.iteritems():
+			if key not in before:
+				filelist[key] = metadata
+		merged[name] = filelist
+	return merged
+
+def state_write_stats():
+	"""Returns the number of state writes, conflicts and writes given up
+	since the process started, and the share of attempts that conflicted.
+	"""
+	with _stats_lock:
+		stats = dict(
+			writes=_stats['writes'],
+			conflicts=_stats['conflicts'],
+			failures=_stats['failures']
+		)
+	attempts = stats['writes'] + stats['conflicts']
+	stats['conflict_rate'] = float(stats['conflicts']) / attempts if attempts else 0.0
+	return stats
+
+def _write_if_unchanged(module, state):
+	"""Updates the row of a module, conditioned on the state it was read
+	with, as grade publishing does.  The modified time is not compared: a
+	database storing it with less precision than it was written with would
+	never match it again.  Returns True if the row was written.
+	"""
+	now = _now()
+	text = json.dumps(state)
+	updated = StudentModule.objects.filter(
+		pk=module.id,
+		state=module.state
+	).update(state=text, modified=now)
+	if updated:
+		module.state = text
+		module.modified = now
+	return bool(updated)
+
+def _record(name):
+	with _stats_lock:
+		_stats[name] += 1
+
+def _now():
+	return datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
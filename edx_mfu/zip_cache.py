@@ -0,0 +1,246 @@
+"""
+A cache of built zip archives.  Archives are keyed by a fingerprint of
+the file list they were built from (the keys and timestamps of its
+files), kept on the local disk or in default_storage, and evicted least
+recently used first once the cache grows past its size budget.
+
+The size of the cache is kept as a running total in the Django cache, so
+the entries are only listed when the total passes the budget, or when
+the total was lost.  Entries used within EVICTION_GRACE seconds are not
+evicted, so an archive being handed to the proxy is not deleted under
+it.  Archives are written under a temporary name and renamed into place,
+so a concurrent lookup never finds a partly written archive.
+
+Settings:
+	ZIP_CACHE:           'local', 'storage' or None to disable the cache.
+	ZIP_CACHE_DIR:       the directory of the 'local' cache.
+	ZIP_CACHE_MAX_BYTES: the size budget of the cache.
+"""
+import hashlib
+import logging
+import os
+import socket
+import tempfile
+import time
+import uuid
+
+from django.core.cache import cache
+from django.core.files import File
+from django.core.files.storage import default_storage, FileSystemStorage
+
+from config import get_setting
+
+log = logging.getLogger(__name__)
+
+#prefix of cache entries in default_storage for the 'storage' cache.
+STORAGE_PREFIX = 'edx_mfu/zip_cache'
+
+#seconds after its last use during which an entry is not evicted.
+EVICTION_GRACE = 60
+
+#suffix of archives being written.
+TEMP_SUFFIX = '.tmp'
+
+def fingerprint(location, filelist):
+	"""Returns the fingerprint of the archive of a file list.
+
+	Keyword arguments:
+	location: the location of the block owning the files.
+	filelist: A dictionary containing file metadata.
+	"""
+	sha1 = hashlib.sha1(location.encode('utf-8'))
+	for key in sorted(filelist):
+		sha1.update(key)
+		sha1.update(str(filelist[key][2])) #the timestamp
+	return sha1.hexdigest()
+
+def lookup(fingerprint):
+	"""Returns (storage, path) of a cached archive, or None.  A hit marks
+	the entry as recently used.
+
+	Keyword arguments:
+	fingerprint: the fingerprint of the archive.
+	"""
+	storage = cache_storage()
+	if storage is None:
+		return None
+
+	path = _entry_path(fingerprint)
+	if not storage.exists(path):
+		return None
+
+	_touch(path)
+	return (storage, path)
+
+def tee(fingerprint, chunks):
+	"""Yields the chunks of an archive being built, and adds the archive
+	to the cache once every chunk has been yielded.  An archive whose
+	download is abandoned part way is not cached.
+
+	Keyword arguments:
+	fingerprint: the fingerprint of the archive.
+	chunks:      an iterable of byte strings.
+	"""
+	storage = cache_storage()
+	if storage is None:
+		for chunk in chunks:
+			yield chunk
+		return
+
+	spool = tempfile.TemporaryFile()
+	try:
+		for chunk in chunks:
+			spool.write(chunk)
+			yield chunk
+
+		spool.seek(0)
+		store(fingerprint, spool)
+	finally:
+		spool.close()
+
+def store(fingerprint, archive):
+	"""Adds an archive to the cache and evicts entries over budget.
+
+	Keyword arguments:
+	fingerprint: the fingerprint of the archive.
+	archive:     a file-like object holding the archive.
+	"""
+	storage = cache_storage()
+	if storage is None:
+		return
+
+	path = _entry_path(fingerprint)
+	try:
+		if not storage.exists(path):
+			archive = File(archive)
+			size = archive.size
+			_save_entry(storage, path, archive)
+			_add_to_total(size)
+		_touch(path)
+
+		total = cache.get(_total_key())
+		if total is None or total > get_setting('ZIP_CACHE_MAX_BYTES'):
+			evict(storage)
+	except Exception:
+		#a failure to cache must never fail the download.
+		log.warning("Could not cache archive %s", fingerprint, exc_info=True)
+
+def discard(fingerprint):
+	"""Removes an archive from the cache.  The running total is left as
+	is: it is corrected by the next eviction.
+
+	Keyword arguments:
+	fingerprint: the fingerprint of the archive.
+	"""
+	storage = cache_storage()
+	if storage is not None:
+		storage.delete(_entry_path(fingerprint))
+		cache.delete(_recency_key(_entry_path(fingerprint)))
+
+def evict(storage):
+	"""Deletes the least recently used archives until the cache is within
+	ZIP_CACHE_MAX_BYTES, and resets the running total.
+	"""
+	try:
+		_, names = storage.listdir(_entry_path(''))
+	except OSError: #cache directory not created yet.
+		return
+
+	entries = []
+	total = 0
+	for name in names:
+		path = _entry_path(name)
+		try:
+			size = storage.size(path)
+		except OSError: #evicted or renamed meanwhile.
+			continue
+		total += size
+		entries.append((_recency(storage, path), size, path))
+
+	budget = get_setting('ZIP_CACHE_MAX_BYTES')
+	recent = time.time() - EVICTION_GRACE
+	for used, size, path in sorted(entries):
+		if total <= budget or used > recent:
+			break
+		storage.delete(path)
+		cache.delete(_recency_key(path))
+		total -= size
+	cache.set(_total_key(), total, None)
+
+def cache_storage():
+	"""Returns the storage holding cached archives, or None when the cache
+	is disabled.
+	"""
+	backend = get_setting('ZIP_CACHE')
+	if backend == 'local':
+		return FileSystemStorage(location=get_setting('ZIP_CACHE_DIR'))
+	elif backend == 'storage':
+		return default_storage
+	return None
+
+def accel_prefix():
+	"""Returns the proxy location mapped onto the cache, or None to use
+	X_ACCEL_REDIRECT_PREFIX.
+	"""
+	if get_setting('ZIP_CACHE') == 'local':
+		return get_setting('ZIP_CACHE_X_ACCEL_PREFIX')
+	return None
+
+def _entry_path(name):
+	if get_setting('ZIP_CACHE') == 'storage':
+		return STORAGE_PREFIX + '/' + name
+	return name
+
+def _save_entry(storage, path, archive):
+	"""Saves an archive so that it appears whole at its path."""
+	try:
+		target = storage.path(path)
+	except NotImplementedError:
+		target = None
+
+	if target is None:
+		#remote storages make an object visible once it is fully written.
+		name = storage.save(path, archive)
+		if name != path: #stored by another worker meanwhile.
+			storage.delete(name)
+		return
+
+	temp = storage.save(path + '.' + uuid.uuid4().hex + TEMP_SUFFIX, archive)
+	os.rename(storage.path(temp), target)
+
+def _total_key():
+	"""Returns the key of the running total of the cache.  A 'local'
+	cache is a directory on each host, with its own total.
+	"""
+	if get_setting('ZIP_CACHE') == 'local':
+		return 'edx_mfu.zip_cache.total.' + hashlib.sha1(
+			socket.gethostname() + get_setting('ZIP_CACHE_DIR')).hexdigest()
+	return 'edx_mfu.zip_cache.total'
+
+def _add_to_total(size):
+	try:
+		cache.incr(_total_key(), size)
+	except ValueError: #lost: the next store lists the cache.
+		pass
+
+def _recency_key(path):
+	return 'edx_mfu.zip_cache.' + hashlib.sha1(path).hexdigest()
+
+def _touch(path):
+	"""Marks a cache entry as used now."""
+	cache.set(_recency_key(path), time.time(), None)
+
+def _recency(storage, path):
+	"""Returns when a cache entry was last used.  Falls back to the time
+	it was written when the Django cache has lost track of it.
+	"""
+	used = cache.get(_recency_key(path))
+	if used is not None:
+		return used
+
+	modified_time = getattr(storage, 'get_modified_time', None) or \
+		getattr(storage, 'modified_time', None)
+	try:
+		return time.mktime(modified_time(path).timetuple())
+	except Exception:
+		return 0
@@ -0,0 +1,309 @@
+"""
+A streaming zip archive writer.  The archive is produced as a sequence
+of byte strings: each member's local header, its data and a data
+descriptor holding the crc and sizes, followed by the central directory.
+Sizes are never needed up front and memory use is bounded by the read
+block size, no matter how large the archive is.
+
+Members may instead be compressed ahead of the writer with
+compress_member, on other threads, in which case their sizes are written
+in the local header.
+"""
+import datetime
+import struct
+import tempfile
+import zlib
+
+from zipfile import ZIP_STORED, ZIP_DEFLATED, LargeZipFile
+
+BLOCK_SIZE = 2**10 * 64  # 64kb
+
+ZIP64_LIMIT = (1 << 31) - 1
+ZIP_FILECOUNT_LIMIT = 0xffff
+ZIP_MAX = 0xffffffff
+
+#media types which compress well despite their prefix.
+COMPRESSIBLE_MEDIA_TYPES = frozenset((
+	'image/svg+xml', 'image/bmp', 'image/x-ms-bmp', 'image/tiff',
+	'audio/x-wav', 'audio/wav',
+))
+
+INCOMPRESSIBLE_PREFIXES = ('image/', 'video/', 'audio/',
+	'application/vnd.openxmlformats-officedocument.',
+	'application/vnd.oasis.opendocument.')
+
+INCOMPRESSIBLE_TYPES = frozenset((
+	'application/pdf', 'application/zip', 'application/x-zip-compressed',
+	'application/gzip', 'application/x-gzip', 'application/x-bzip2',
+	'application/x-xz', 'application/x-7z-compressed',
+	'application/x-rar-compressed', 'application/java-archive',
+	'application/x-tar-gz', 'application/epub+zip',
+))
+
+#general purpose flags.
+FLAG_DATA_DESCRIPTOR = 0x08
+FLAG_UTF8 = 0x800
+
+class ZipMember(object):
+	"""
+	A file to be written to a streamed archive.
+
+	Keyword arguments:
+	arcname:     the name of the file in the archive.
+	chunks:      an iterable of byte strings holding the contents.
+	compression: ZIP_STORED or ZIP_DEFLATED.
+	date_time:   (optional) the modification time of the file.
+	size:        (optional) the expected size, used to decide whether the
+	             member needs zip64 extensions.
+	"""
+	def __init__(self, arcname, chunks, compression=ZIP_STORED,
+			date_time=None, size=None):
+		self.arcname = arcname
+		self.chunks = chunks
+		self.compression = compression
+		self.date_time = date_time or datetime.datetime.utcnow()
+		self.zip64 = size is None or size > ZIP64_LIMIT
+
+		#set by compress_member; chunks then hold the compressed data.
+		self.crc = None
+		self.size = size
+		self.compressed_size = None
+
+	@property
+	def precompressed(self):
+		return self.crc is not None
+
+def stream_zip(members):
+	"""Yields the bytes of a zip archive holding the given members.
+
+	Keyword arguments:
+	members: an iterable of ZipMember.
+	"""
+	offset = 0
+	central = []
+
+	for member in members:
+		name, flags = _encode_name(member.arcname)
+		dos_time, dos_date = _dos_date_time(member.date_time)
+		version = 45 if member.zip64 else 20
+
+		if member.precompressed:
+			#sizes are known, so they go in the local header.
+			crc = member.crc
+			size = member.size
+			compressed_size = member.compressed_size
+			if member.zip64:
+				extra = struct.pack('<HHQQ', 0x0001, 16, size, compressed_size)
+				header_sizes = (ZIP_MAX, ZIP_MAX)
+			else:
+				extra = b''
+				header_sizes = (compressed_size, size)
+		else:
+			#sizes follow in the data descriptor, a zip64 extra field
+			#marks them as 64 bit.
+			flags |= FLAG_DATA_DESCRIPTOR
+			crc = 0
+			if member.zip64:
+				extra = struct.pack('<HHQQ', 0x0001, 16, 0, 0)
+				header_sizes = (ZIP_MAX, ZIP_MAX)
+			else:
+				extra = b''
+				header_sizes = (0, 0)
+
+		header = struct.pack('<IHHHHHIIIHH',
+			0x04034b50, version, flags, member.compression,
+			dos_time, dos_date, crc, header_sizes[0], header_sizes[1],
+			len(name), len(extra)) + name + extra
+		yield header
+
+		if member.precompressed:
+			for chunk in member.chunks:
+				yield chunk
+			descriptor = b''
+		else:
+			crc, size, compressed_size = 0, 0, 0
+			for chunk in _compress(member):
+				if isinstance(chunk, tuple):
+					crc, size = chunk
+					continue
+				compressed_size += len(chunk)
+				yield chunk
+
+			if not member.zip64 and max(size, compressed_size) > ZIP64_LIMIT:
+				raise LargeZipFile(
+					member.arcname + ' is too large for a member without zip64')
+
+			if member.zip64:
+				descriptor = struct.pack('<IIQQ',
+					0x08074b50, crc, compressed_size, size)
+			else:
+				descriptor = struct.pack('<IIII',
+					0x08074b50, crc, compressed_size, size)
+			yield descriptor
+
+		central.append(_central_header(
+			name, flags, member.compression, version, dos_time, dos_date,
+			crc, compressed_size, size, offset))
+		offset += len(header) + compressed_size + len(descriptor)
+
+	central_offset = offset
+	central_size = 0
+	for record in central:
+		central_size += len(record)
+		yield record
+
+	for record in _end_records(len(central), central_size, central_offset):
+		yield record
+
+def compress_member(member, spool_size=2**20):
+	"""Reads and compresses a member into a spooled temporary file, and
+	returns a precompressed member whose crc and sizes are known.  Meant
+	to be run on other threads; zlib releases the GIL while compressing.
+
+	Keyword arguments:
+	member:     a ZipMember.
+	spool_size: bytes of compressed data held in memory before spilling
+	            to disk.
+	"""
+	spool = tempfile.SpooledTemporaryFile(max_size=spool_size)
+	crc, size, compressed_size = 0, 0, 0
+	for chunk in _compress(member):
+		if isinstance(chunk, tuple):
+			crc, size = chunk
+			continue
+		compressed_size += len(chunk)
+		spool.write(chunk)
+	spool.seek(0)
+
+	compressed = ZipMember(
+		member.arcname,
+		iter_chunks(spool),
+		member.compression,
+		member.date_time,
+		max(size, compressed_size)
+	)
+	compressed.crc = crc
+	compressed.size = size
+	compressed.compressed_size = compressed_size
+	return compressed
+
+def compression_for(mimetype):
+	"""Returns ZIP_STORED for already compressed types (media, archives,
+	pdf), which deflate cannot shrink, and ZIP_DEFLATED for the rest.
+
+	Keyword arguments:
+	mimetype: the mimetype of a file, or None if it is not known.
+	"""
+	if mimetype is None:
+		return ZIP_DEFLATED
+	if mimetype in COMPRESSIBLE_MEDIA_TYPES:
+		return ZIP_DEFLATED
+	if mimetype in INCOMPRESSIBLE_TYPES or \
+			mimetype.startswith(INCOMPRESSIBLE_PREFIXES):
+		return ZIP_STORED
+	return ZIP_DEFLATED
+
+def iter_chunks(fileobj, block_size=BLOCK_SIZE):
+	"""Yields the contents of a file-like object in blocks, closing it at
+	the end.
+	"""
+	try:
+		while True:
+			block = fileobj.read(block_size)
+			if not block:
+				break
+			yield block
+	finally:
+		fileobj.close()
+
+def _compress(member):
+	"""Yields the compressed data of a member, then a (crc, size) tuple
+	for its uncompressed data.
+	"""
+	crc, size = 0, 0
+	if member.compression == ZIP_DEFLATED:
+		compressor = zlib.compressobj(
+			zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+	else:
+		compressor = None
+
+	for chunk in member.chunks:
+		if not chunk:
+			continue
+		crc = zlib.crc32(chunk, crc)
+		size += len(chunk)
+		if compressor is not None:
+			chunk = compressor.compress(chunk)
+			if not chunk:
+				continue
+		yield chunk
+
+	if compressor is not None:
+		chunk = compressor.flush()
+		if chunk:
+			yield chunk
+
+	yield (crc & 0xffffffff, size)
+
+def _encode_name(arcname):
+	if isinstance(arcname, unicode):
+		try:
+			return (arcname.encode('ascii'), 0)
+		except UnicodeEncodeError:
+			return (arcname.encode('utf-8'), FLAG_UTF8)
+	return (arcname, 0)
+
+def _dos_date_time(value):
+	if value.year < 1980:
+		value = datetime.datetime(1980, 1, 1)
+	dos_time = (value.hour << 11) | (value.minute << 5) | (value.second // 2)
+	dos_date = ((value.year - 1980) << 9) | (value.month << 5) | value.day
+	return (dos_time, dos_date)
+
+def _central_header(name, flags, compression, version, dos_time, dos_date,
+		crc, compressed_size, size, offset):
+	"""Returns the central directory record for a member."""
+	extra_values = []
+	if size > ZIP64_LIMIT:
+		extra_values.append(size)
+		size = ZIP_MAX
+	if compressed_size > ZIP64_LIMIT:
+		extra_values.append(compressed_size)
+		compressed_size = ZIP_MAX
+	if offset > ZIP64_LIMIT:
+		extra_values.append(offset)
+		offset = ZIP_MAX
+
+	if extra_values:
+		extra = struct.pack('<HH' + 'Q' * len(extra_values),
+			0x0001, 8 * len(extra_values), *extra_values)
+		version = 45
+	else:
+		extra = b''
+
+	#made by unix (3), so the permissions in the external attributes apply.
+	return struct.pack('<IHHHHHHIIIHHHHHII',
+		0x02014b50, (3 << 8) | version, version, flags, compression,
+		dos_time, dos_date, crc, compressed_size, size,
+		len(name), len(extra), 0, 0, 0, 0o600 << 16, offset) + name + extra
+
+def _end_records(count, central_size, central_offset):
+	"""Returns the end of central directory records."""
+	records = []
+	if (count >= ZIP_FILECOUNT_LIMIT or central_size > ZIP64_LIMIT or
+			central_offset > ZIP64_LIMIT):
+		zip64_end_offset = central_offset + central_size
+		records.append(struct.pack('<IQHHIIQQQQ',
+			0x06064b50, 44, 45, 45, 0, 0,
+			count, count, central_size, central_offset))
+		records.append(struct.pack('<IIQI',
+			0x07064b50, 0, zip64_end_offset, 1))
+		count = min(count, ZIP_FILECOUNT_LIMIT)
+		if central_size > ZIP64_LIMIT:
+			central_size = ZIP_MAX
+		if central_offset > ZIP64_LIMIT:
+			central_offset = ZIP_MAX
+
+	records.append(struct.pack('<IHHHHIIH',
+		0x06054b50, 0, 0, count, count, central_size, central_offset, 0))
+	return records